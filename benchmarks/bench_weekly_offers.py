@@ -0,0 +1,291 @@
+"""Benchmarks for the Scraper parser, the DataCleaner and save_to_sql, and for the browser profiles.
+
+Synthetic inputs of the requested sizes are generated from the real offers in 'tests/offers_2024-09-25.csv'
+(or from the offers in a saved page given with --page). Every step is run twice: once to measure the time
+and once under tracemalloc to measure the peak memory, so that the tracing does not distort the timings.
+The results are written as JSON lines, one per step and size, tagged with the current git commit.
+
+Usage:
+    python -m benchmarks.bench_weekly_offers --sizes 1000 10000 100000 --output bench_results.jsonl
+    python -m benchmarks.bench_weekly_offers --sizes 1000 --compare bench_results.jsonl
+
+With --browser-url, a live offer page is also loaded in Chrome with every browser profile (see the driver
+module), recording the page-load and scroll time, the browser's resident memory (RSS, in the peak_mb field),
+the number of requests and the bytes transferred. This needs Chrome, chromedriver and psutil.
+"""
+
+import argparse
+import contextlib
+import html
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import pandas as pd
+
+# Keep benchmark runs out of logging.log, the modules below only set up logging if it is not configured yet
+logging.basicConfig(level=logging.WARNING, handlers=[logging.StreamHandler(sys.stderr)])
+
+from fetch_weekly_offers.utils.cleaner import DataCleaner, CLEANING_STEPS
+from fetch_weekly_offers.utils.extractor import OFFER_ITEM_SELECTOR, FIELD_SELECTORS, EXTRACTORS
+from fetch_weekly_offers.utils.funcs import save_to_sql
+from fetch_weekly_offers.utils.scraper import Scraper
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+TEMPLATE_CSV = os.path.join('tests', 'offers_2024-09-25.csv')
+
+# Rendering and parsing a page is a lot slower per offer than cleaning, so pages are capped at this size
+DEFAULT_MAX_PAGE_OFFERS = 20_000
+
+def load_template(page=None) -> list:
+    """Returns the real offers the synthetic data is built from, from a saved page or the test CSV."""
+    if page:
+        scraper = Scraper(page, replay_from=page)
+        scraper.fetch_page()
+        scraper.find_elements()
+        return scraper.extract_data()
+    return pd.read_csv(TEMPLATE_CSV, keep_default_na=False).to_dict(orient='records')
+
+def make_records(template: list, size: int) -> list:
+    """Repeats the template offers up to size records. Every repetition gets its own names, so the data
+    keeps the share of duplicates of the template instead of becoming all duplicates.
+    """
+    records = []
+    block = 0
+    while len(records) < size:
+        for record in template[:size - len(records)]:
+            records.append(dict(record, Name=f'{record["Name"]} {block}' if block else record['Name']))
+        block += 1
+    return records
+
+def render_page(records: list) -> str:
+    """Renders offer records as an offer page with the markup described by the selector tables."""
+    items = []
+    for record in records:
+        parts = []
+        for field, selector in FIELD_SELECTORS.items():
+            value = html.escape(str(record[field]))
+            if 'attr' in selector:
+                parts.append(f'<{selector["tag"]} itemprop="{selector["itemprop"]}" {selector["attr"]}="{value}">')
+            else:
+                parts.append(f'<{selector["tag"]} class="{selector["class"]} x1">{value}</{selector["tag"]}>')
+        items.append(f'<{OFFER_ITEM_SELECTOR["tag"]} class="{OFFER_ITEM_SELECTOR["class"]} x2">'
+                     f'<img src="offer.webp">{"".join(parts)}</{OFFER_ITEM_SELECTOR["tag"]}>')
+    return f'<html><head><title>Erbjudanden</title></head><body><ul>{"".join(items)}</ul></body></html>'
+
+def measure(func) -> dict:
+    """Runs func twice and returns its duration and its peak memory allocation in MB."""
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': round(seconds, 6), 'peak_mb': round(peak / 1024 ** 2, 3)}
+
+def bench_cleaner(records: list) -> list:
+    """Measures every DataCleaner step. The steps before it are replayed untimed, so each step 
+    starts from the same state as in DataCleaner.clean().
+    """
+    results = []
+    for index, step in enumerate(CLEANING_STEPS):
+        def prepare():
+            cleaner = DataCleaner(records)
+            for previous in CLEANING_STEPS[:index]:
+                getattr(cleaner, previous)()
+            return cleaner
+
+        cleaner = prepare()
+        start = time.perf_counter()
+        getattr(cleaner, step)()
+        seconds = time.perf_counter() - start
+
+        cleaner = prepare()
+        tracemalloc.start()
+        try:
+            getattr(cleaner, step)()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results.append({'benchmark': f'cleaner.{step}', 'seconds': round(seconds, 6),
+                        'peak_mb': round(peak / 1024 ** 2, 3)})
+    return results
+
+def bench_parser(records: list) -> list:
+    """Measures find_elements and extract_data of every extraction backend on a static page."""
+    page = render_page(records)
+    results = []
+    for name in EXTRACTORS:
+        scraper = Scraper('benchmark', extractor=name)
+        scraper.full_content = page
+
+        def parse(scraper=scraper):
+            scraper.offers = None
+            scraper.find_elements()
+        results.append({'benchmark': f'scraper.find_elements[{name}]', **measure(parse)})
+
+        def extract(scraper=scraper):
+            scraper.data = []
+            scraper.extract_data()
+        results.append({'benchmark': f'scraper.extract_data[{name}]', **measure(extract)})
+    return results
+
+def bench_sql(records: list) -> list:
+    """Measures save_to_sql against a SQLite database, replacing the table and upserting into it."""
+    cleaned = DataCleaner(records).clean()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        db_url = f'sqlite:///{os.path.join(directory, "offers.db")}'
+        for mode in ['replace', 'upsert']:
+            results.append({'benchmark': f'save_to_sql[{mode}]',
+                            **measure(lambda: save_to_sql(cleaned, db_url=db_url, mode=mode))})
+    return results
+
+# Returns the number of requests the page made and the megabytes they transferred
+RESOURCES_JS = '''
+const entries = performance.getEntriesByType('resource').concat(performance.getEntriesByType('navigation'));
+return [entries.length, entries.reduce((total, entry) => total + (entry.transferSize || 0), 0) / 1048576];
+'''
+
+def browser_rss_mb(driver) -> float:
+    """Returns the resident memory of all browser processes started by the driver's chromedriver, in MB."""
+    import psutil
+    rss = 0
+    for process in psutil.Process(driver.service.process.pid).children(recursive=True):
+        try:
+            rss += process.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss / 1024 ** 2
+
+def bench_browser(url: str, profiles=None) -> list:
+    """Loads and scrolls the offer page at url in a fresh browser of every profile and measures the time
+    of both steps, the browser RSS once all offers are loaded and the requests the page made.
+    """
+    from fetch_weekly_offers.utils.driver import BROWSER_PROFILES, DriverPool
+    results = []
+    for profile in profiles or BROWSER_PROFILES:
+        with DriverPool(size=1, profile=profile) as pool:
+            scraper = Scraper(url, pool=pool)
+            scraper.set_up_driver()
+            if scraper.driver is None:
+                raise RuntimeError(f'Could not start a browser with the {profile} profile.')
+            try:
+                start = time.perf_counter()
+                scraper.load_page()
+                load_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                scraper.scroll_to_bottom()
+                scroll_seconds = time.perf_counter() - start
+                rss = browser_rss_mb(scraper.driver)
+                requests, transfer_mb = scraper.driver.execute_script(RESOURCES_JS)
+            finally:
+                scraper.close_driver()
+        details = {'peak_mb': round(rss, 3), 'offers': scraper.scroll_stats.get('offer_count'),
+                   'requests': requests, 'transfer_mb': round(transfer_mb, 3)}
+        results.append({'benchmark': f'browser.load_page[{profile}]', 'seconds': round(load_seconds, 6), **details})
+        results.append({'benchmark': f'browser.scroll_to_bottom[{profile}]', 'seconds': round(scroll_seconds, 6),
+                        **details})
+    return results
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+def _print_result(result: dict) -> None:
+    print(f'{result["benchmark"]:<40} {result["size"]:>9} {result["seconds"]:>10.4f} s {result["peak_mb"]:>10.2f} MB',
+          file=sys.stderr)
+
+def run_benchmarks(sizes, groups, max_page_offers=DEFAULT_MAX_PAGE_OFFERS, page=None, browser_url=None,
+                   browser_profiles=None) -> list:
+    """Runs the benchmark groups ('cleaner', 'parser', 'sql') for every size and returns the results.
+    With a browser_url, the browser profiles are measured on that page as well (as size 1, one page).
+    """
+    template = load_template(page)
+    context = {'commit': git_commit(), 'timestamp': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'pandas': pd.__version__}
+    results = []
+    if browser_url:
+        with contextlib.redirect_stdout(sys.stderr):
+            browser_results = bench_browser(browser_url, browser_profiles)
+        for result in browser_results:
+            result = {**result, 'size': 1, 'url': browser_url, **context}
+            _print_result(result)
+            results.append(result)
+    for size in sizes:
+        records = make_records(template, size)
+        for group in groups:
+            if group == 'parser' and size > max_page_offers:
+                print(f'Skipping parser benchmarks for {size} offers (above --max-page-offers).', file=sys.stderr)
+                continue
+            bench = {'cleaner': bench_cleaner, 'parser': bench_parser, 'sql': bench_sql}[group]
+            # The steps print progress messages of their own, which would mix with the JSON output
+            with contextlib.redirect_stdout(sys.stderr):
+                group_results = bench(records)
+            for result in group_results:
+                result = {**result, 'size': size, **context}
+                _print_result(result)
+                results.append(result)
+    return results
+
+def compare(results: list, baseline_path: str) -> None:
+    """Prints the change in time and memory of every result against the latest matching baseline result."""
+    baseline = {}
+    with open(baseline_path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                entry = json.loads(line)
+                baseline[(entry['benchmark'], entry['size'])] = entry
+    for result in results:
+        old = baseline.get((result['benchmark'], result['size']))
+        if old is None or not old['seconds']:
+            continue
+        print(f'{result["benchmark"]:<40} {result["size"]:>9} '
+              f'time x{result["seconds"] / old["seconds"]:.2f}  '
+              f'memory x{result["peak_mb"] / old["peak_mb"] if old["peak_mb"] else float("nan"):.2f}  '
+              f'(vs {old["commit"]})')
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the parser, the DataCleaner and save_to_sql.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Numbers of offers to generate (default: 1000 10000 100000).')
+    parser.add_argument('--groups', nargs='+', choices=['cleaner', 'parser', 'sql'],
+                        default=['cleaner', 'parser', 'sql'], help='Benchmark groups to run (default: all).')
+    parser.add_argument('--max-page-offers', type=int, default=DEFAULT_MAX_PAGE_OFFERS,
+                        help='Largest page to run the parser benchmarks on (default: 20000).')
+    parser.add_argument('--page', default=None, help='Saved page or snapshot to take the template offers from.')
+    parser.add_argument('--browser-url', default=None,
+                        help='Live offer page to compare the browser profiles on (needs Chrome and psutil).')
+    parser.add_argument('--browser-profiles', nargs='+', choices=['default', 'lean'], default=None,
+                        help='Browser profiles to measure with --browser-url (default: all).')
+    parser.add_argument('--output', default=None, help='JSON lines file to append the results to.')
+    parser.add_argument('--compare', default=None, help='JSON lines file with earlier results to compare against.')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.groups, args.max_page_offers, args.page, args.browser_url,
+                             args.browser_profiles)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as file:
+            for result in results:
+                file.write(json.dumps(result) + '\n')
+    else:
+        for result in results:
+            print(json.dumps(result))
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+"""Entry point for 'python -m fetch_weekly_offers', see the cli module."""
+
+import sys
+from fetch_weekly_offers.cli import main
+
+sys.exit(main())
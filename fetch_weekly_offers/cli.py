@@ -0,0 +1,323 @@
+"""Command line interface of the weekly offers pipeline.
+
+    python -m fetch_weekly_offers run                          Scrape, clean and save all stores (the scheduled job)
+    python -m fetch_weekly_offers scrape --output raw.csv      Scrape the raw offers only
+    python -m fetch_weekly_offers clean raw.csv --output cleaned.parquet
+    python -m fetch_weekly_offers load cleaned.parquet         Save cleaned offers to the database
+    python -m fetch_weekly_offers replay snapshots/            Clean and save offers from saved pages
+    python -m fetch_weekly_offers benchmark --sizes 1000       Run the benchmarks (see benchmarks/)
+    python -m fetch_weekly_offers coordinate                   Queue one job per store, wait for the workers and save
+    python -m fetch_weekly_offers worker                       Scrape and clean queued stores, on as many hosts as wanted
+    python -m fetch_weekly_offers serve --port 8000            Answer offer queries over HTTP from an in-memory index
+
+The URLs, the database target and option defaults come from the config file (see the config module).
+Every command imports only what it needs: cleaning a file does not load Selenium or SQLAlchemy, and
+loading a file does not load Selenium, so the stages can be run separately without the startup cost
+of the whole pipeline.
+"""
+
+import argparse
+import sys
+from datetime import datetime
+from .config import load_config
+
+def _common_options() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--config', default=None,
+                        help='JSON config file with the URLs, the database and option defaults '
+                             '(default: $WEEKLY_OFFERS_CONFIG or weekly_offers.json if it exists).')
+    parser.add_argument('--metrics-file', default=None,
+                        help='JSON lines file to record the duration, rows and peak memory of every stage in.')
+    parser.add_argument('--no-memory-metrics', action='store_true',
+                        help='Do not track peak memory in the metrics (tracking slows the run down).')
+    return parser
+
+def _scrape_options() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--urls', nargs='+', default=None, help='Store URLs to scrape (default: from the config).')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of stores to scrape concurrently, each in its own browser (default: 1).')
+    parser.add_argument('--snapshot-dir', default=None,
+                        help='Directory to archive every scraped page in as a compressed snapshot.')
+    parser.add_argument('--fetch-mode', choices=['browser', 'http', 'auto'], default=None,
+                        help='Load the pages in Chrome, with plain HTTP requests, or over HTTP with Chrome as fallback (default: browser).')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Seconds a store\'s page may take to load and scroll before it is given up on (default: 180).')
+    parser.add_argument('--retries', type=int, default=None,
+                        help='Number of times a failed store is retried (default: 2).')
+    parser.add_argument('--retry-backoff', type=float, default=None,
+                        help='Seconds to wait before the first retry, doubled for every next retry (default: 5).')
+    parser.add_argument('--browser-profile', choices=['default', 'lean'], default=None,
+                        help='Browser to load the pages in: the default Chrome, or a lean headless Chrome without '
+                             'images, media, fonts and trackers (default: default).')
+    return parser
+
+def _save_options() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--db-url', default=None,
+                        help='SQLAlchemy URL of the database (default: from the config, $WEEKLY_OFFERS_DB_URL or the MSSQL server).')
+    parser.add_argument('--load-mode', choices=['upsert', 'replace'], default=None,
+                        help='Merge new and changed offers into the table, or replace the whole table (default: upsert).')
+    parser.add_argument('--archive-dir', default=None,
+                        help='Directory of the Parquet archive to add the cleaned offers to.')
+    parser.add_argument('--products-file', default=None,
+                        help='JSON file with the product IDs of earlier runs, used to match offers across stores and weeks.')
+    return parser
+
+def _queue_options() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--queue-url', default=None,
+                        help='SQLAlchemy URL of the job queue database, shared by the coordinator and the workers '
+                             '(default: sqlite:///job_queue.db).')
+    parser.add_argument('--lease', type=float, default=None,
+                        help='Seconds a worker holds a job without a heartbeat before it goes back to the queue (default: 120).')
+    parser.add_argument('--run-id', default=None,
+                        help='Run to enqueue the jobs in or to take jobs from (default: a new run, or any run for workers).')
+    return parser
+
+def build_parser() -> argparse.ArgumentParser:
+    common, scrape_options, save_options = _common_options(), _scrape_options(), _save_options()
+    queue_options = _queue_options()
+    parser = argparse.ArgumentParser(prog='python -m fetch_weekly_offers',
+                                     description='Scrape, clean and save the weekly offers.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', parents=[common, scrape_options, save_options],
+                              help='Scrape, clean and save the offers of all stores.')
+    run.add_argument('--stream', action='store_true',
+                     help='Save every cleaned chunk as soon as it is ready instead of all data at the end (always upserts).')
+    run.add_argument('--chunk-size', type=int, default=None,
+                     help='Number of offers per chunk in streaming mode (default: 500).')
+    run.add_argument('--cache-file', default=None,
+                     help='JSON file with the flyer fingerprints of the last run, stores with unchanged offers are skipped.')
+    run.add_argument('--checkpoint-dir', default=None,
+                     help='Directory to save every store\'s cleaned offers in as soon as they are done (default: checkpoints).')
+    run.add_argument('--resume', action='store_true',
+                     help='Continue the latest checkpointed run, only redoing the stores that failed or never finished.')
+
+    scrape = commands.add_parser('scrape', parents=[common, scrape_options],
+                                 help='Scrape the raw offers of all stores to a CSV file, without cleaning or saving them.')
+    scrape.add_argument('--output', default=None, help='CSV file to write (default: raw_offers_<date>.csv).')
+
+    clean = commands.add_parser('clean', parents=[common], help='Clean raw offers from a CSV file.')
+    clean.add_argument('input', help='CSV file with raw offers, e.g. from the scrape command.')
+    clean.add_argument('--output', default='cleaned_offers.csv',
+                       help='CSV or .parquet file to write the cleaned offers to (default: cleaned_offers.csv).')
+
+    load = commands.add_parser('load', parents=[common, save_options],
+                               help='Save cleaned offers from a CSV or Parquet file to the database.')
+    load.add_argument('input', help='CSV or .parquet file with cleaned offers, e.g. from the clean command.')
+
+    replay = commands.add_parser('replay', parents=[common, save_options],
+                                 help='Clean and save the offers of saved pages instead of scraping them.')
+    replay.add_argument('snapshots', nargs='+',
+                        help='Snapshot or HTML files, or snapshot directories to replay the latest snapshot of every URL from.')
+    replay.add_argument('--output', default=None,
+                        help='CSV or .parquet file to write the cleaned offers to instead of saving them to the database.')
+
+    coordinate = commands.add_parser('coordinate', parents=[common, save_options, queue_options],
+                                     help='Queue one job per store, wait for the workers to finish them and save all offers at once.')
+    coordinate.add_argument('--urls', nargs='+', default=None, help='Store URLs to scrape (default: from the config).')
+    coordinate.add_argument('--local-workers', type=int, default=0,
+                            help='Number of worker processes to start on this host as well (default: 0).')
+    coordinate.add_argument('--wait-timeout', type=float, default=None,
+                            help='Seconds to wait for the workers before giving up (default: no limit).')
+
+    worker = commands.add_parser('worker', parents=[common, queue_options],
+                                 help='Scrape and clean the queued stores until the queue is empty.')
+    worker.add_argument('--fetch-mode', choices=['browser', 'http', 'auto'], default=None,
+                        help='Load the pages in Chrome, with plain HTTP requests, or over HTTP with Chrome as fallback (default: browser).')
+    worker.add_argument('--timeout', type=float, default=None,
+                        help='Seconds a store\'s page may take to load and scroll before it is given up on (default: 180).')
+    worker.add_argument('--browser-profile', choices=['default', 'lean'], default=None,
+                        help='Browser to load the pages in: the default Chrome, or a lean headless Chrome without '
+                             'images, media, fonts and trackers (default: default).')
+    worker.add_argument('--worker-id', default=None, help='Name of the worker in the queue (default: <host>-<pid>).')
+    worker.add_argument('--max-idle', type=float, default=0.0,
+                        help='Seconds to keep waiting for new jobs once the queue is empty (default: 0, stop at once).')
+
+    serve = commands.add_parser('serve', parents=[common],
+                                help='Load the offers into memory and answer queries over HTTP, e.g. GET /offers?store=Hemköp&unit=kg&max_unit_price=100.')
+    serve.add_argument('--db-url', default=None,
+                       help='SQLAlchemy URL of the database to load the offers from (default: from the config, $WEEKLY_OFFERS_DB_URL or the MSSQL server).')
+    serve.add_argument('--archive-dir', default=None,
+                       help='Load the offers from this Parquet archive instead of the database.')
+    serve.add_argument('--history', action='store_true', help='Keep the offers that are no longer valid as well.')
+    serve.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1).')
+    serve.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000).')
+    serve.add_argument('--refresh-interval', type=float, default=300.0,
+                       help='Seconds between loading the offers of new runs (default: 300).')
+
+    benchmark = commands.add_parser('benchmark', help='Run the benchmarks, the arguments are passed on to benchmarks.bench_weekly_offers.')
+    benchmark.add_argument('args', nargs=argparse.REMAINDER, help='Arguments for the benchmark script (see its --help).')
+    return parser
+
+def _settings(args) -> dict:
+    """Returns the config file settings, updated with the options given on the command line."""
+    settings = load_config(args.config)
+    for key in settings:
+        if getattr(args, key, None) is not None:
+            settings[key] = getattr(args, key)
+    return settings
+
+def _save(df, settings) -> bool:
+    """Adds product IDs and saves cleaned offers to the database and the archive, as configured."""
+    from .utils.funcs import save_to_sql, logger
+    if settings['products_file']:
+        from .utils.matching import ProductIndex
+        index = ProductIndex(settings['products_file'])
+        df = index.assign(df)
+        index.save()
+    saved = save_to_sql(df, db_url=settings['db_url'], mode=settings['load_mode'])
+    if settings['archive_dir']:
+        from .utils.archive import write_archive
+        try:
+            write_archive(df, settings['archive_dir'])
+        except Exception as e:
+            logger.error('%s: Failed to archive the data.', e)
+    return saved
+
+def run_command(args, settings) -> bool:
+    from .run_weekly import run, run_streaming
+    if args.stream:
+        rows = run_streaming(settings['urls'], chunk_size=settings['chunk_size'], snapshot_dir=settings['snapshot_dir'],
+                             db_url=settings['db_url'], fetch_mode=settings['fetch_mode'],
+                             products_file=settings['products_file'], browser_profile=settings['browser_profile'])
+        return rows > 0
+    return run(settings['urls'], max_workers=settings['workers'], snapshot_dir=settings['snapshot_dir'],
+               db_url=settings['db_url'], load_mode=settings['load_mode'], archive_dir=settings['archive_dir'],
+               cache_file=settings['cache_file'], fetch_mode=settings['fetch_mode'], 
+               products_file=settings['products_file'], checkpoint_dir=settings['checkpoint_dir'], resume=args.resume, 
+               retries=settings['retries'], retry_backoff=settings['retry_backoff'], timeout=settings['timeout'], 
+               browser_profile=settings['browser_profile'])
+
+def scrape_command(args, settings) -> bool:
+    import pandas as pd
+    from .run_weekly import scrape_all
+    results = scrape_all(settings['urls'], max_workers=settings['workers'], snapshot_dir=settings['snapshot_dir'],
+                         fetch_mode=settings['fetch_mode'], clean=False, retries=settings['retries'], 
+                         retry_backoff=settings['retry_backoff'], timeout=settings['timeout'], 
+                         browser_profile=settings['browser_profile'])
+    raw_data = [df for df in results.values() if not df.empty]
+    if not raw_data:
+        return False
+    output = args.output or f'raw_offers_{datetime.now().strftime("%Y-%m-%d")}.csv'
+    pd.concat(raw_data, ignore_index=True).to_csv(output, index=False)
+    print(f'Raw offers saved to {output}')
+    return True
+
+def clean_command(args, settings) -> bool:
+    import pandas as pd
+    from .utils.cleaner import DataCleaner, write_offers
+    raw_data = pd.read_csv(args.input, keep_default_na=False).to_dict(orient='records')
+    cleaned_data = DataCleaner(raw_data).clean()
+    if cleaned_data.empty:
+        return False
+    write_offers(cleaned_data, args.output)
+    print(f'Cleaned offers saved to {args.output}')
+    return True
+
+def load_command(args, settings) -> bool:
+    from .utils.cleaner import read_offers, validate_offers
+    cleaned_data = read_offers(args.input)
+    validate_offers(cleaned_data)
+    return _save(cleaned_data, settings)
+
+def replay_command(args, settings) -> bool:
+    import os
+    from .utils.cleaner import DataCleaner, concat_offers, write_offers
+    from .utils.scraper import Scraper
+    from .utils.snapshot import list_snapshots
+
+    pages = []
+    for path in args.snapshots:
+        if os.path.isdir(path):
+            # The latest snapshot of every URL in the manifest
+            latest = {entry['url']: entry['path'] for entry in list_snapshots(path)}
+            pages.extend((url, page) for url, page in latest.items())
+        else:
+            pages.append((path, path))
+
+    cleaned = []
+    for url, page in pages:
+        raw_data = Scraper(url, replay_from=page).scrape()
+        if raw_data:
+            cleaned.append(DataCleaner(raw_data).clean())
+    cleaned_data = concat_offers(cleaned)
+    if cleaned_data.empty:
+        return False
+    if args.output:
+        write_offers(cleaned_data, args.output)
+        print(f'Cleaned offers saved to {args.output}')
+        return True
+    return _save(cleaned_data, settings)
+
+def _worker_options(args, settings) -> dict:
+    return {'queue_url': settings['queue_url'], 'lease': settings['lease'], 'run_id': args.run_id,
+            'fetch_mode': settings['fetch_mode'], 'timeout': settings['timeout'],
+            'browser_profile': settings['browser_profile']}
+
+def coordinate_command(args, settings) -> bool:
+    import multiprocessing
+    from .utils.job_queue import JobQueue, coordinate, run_worker
+    # Enqueue before the local workers start, so they find the jobs instead of an empty queue
+    run_id = JobQueue(settings['queue_url']).enqueue(settings['urls'], run_id=args.run_id)
+    workers = [multiprocessing.Process(target=run_worker, kwargs={**_worker_options(args, settings), 'run_id': run_id})
+               for _ in range(args.local_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        counts = coordinate(settings['urls'], queue_url=settings['queue_url'], run_id=run_id,
+                            timeout=args.wait_timeout, writer=lambda df: _save(df, settings))
+    finally:
+        for worker in workers:
+            worker.join()
+    return counts['done'] > 0
+
+def worker_command(args, settings) -> bool:
+    from .utils.job_queue import run_worker
+    run_worker(worker_id=args.worker_id, max_idle=args.max_idle, **_worker_options(args, settings))
+    return True
+
+def serve_command(args, settings) -> bool:
+    from .utils.offers_index import OffersIndex, serve
+    if settings['archive_dir']:
+        index = OffersIndex.from_archive(settings['archive_dir'], history=args.history)
+    else:
+        index = OffersIndex.from_sql(settings['db_url'], history=args.history)
+    serve(index, host=args.host, port=args.port, refresh_interval=args.refresh_interval)
+    return True
+
+def benchmark_command(args, settings) -> bool:
+    from benchmarks.bench_weekly_offers import main as benchmark_main
+    benchmark_main(args.args)
+    return True
+
+COMMANDS = {'run': run_command, 'scrape': scrape_command, 'clean': clean_command, 'load': load_command,
+            'replay': replay_command, 'coordinate': coordinate_command, 'worker': worker_command,
+            'serve': serve_command, 'benchmark': benchmark_command}
+
+def main(argv=None) -> int:
+    """Runs the command given in argv (sys.argv by default) and returns the exit code."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'benchmark':
+        return 0 if benchmark_command(args, None) else 1
+    try:
+        settings = _settings(args)
+    except (OSError, ValueError) as e:
+        parser.error(f'Could not read the config file: {e}')
+
+    # The metrics module is light, but imports pandas through the logging helpers, like every command does
+    from .utils.metrics import metrics
+    if settings['metrics_file']:
+        metrics.enable(settings['metrics_file'], track_memory=not args.no_memory_metrics)
+    try:
+        with metrics.stage(args.command):
+            succeeded = COMMANDS[args.command](args, settings)
+    finally:
+        metrics.write_summary()
+    return 0 if succeeded else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
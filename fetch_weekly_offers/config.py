@@ -0,0 +1,61 @@
+"""Module providing the configuration of the weekly run, read from a JSON file.
+
+The file holds the store URLs, the database target and defaults for the command line options, e.g.
+
+    {
+        "urls": ["https://ereklamblad.se/Hemkop/erbjudanden"],
+        "db_url": "sqlite:///offers.db",
+        "workers": 3,
+        "cache_file": "flyer_cache.json"
+    }
+
+Keys that are left out fall back to the defaults below, and options given on the command line win over the file.
+"""
+
+import json
+import os
+
+CONFIG_FILE = 'weekly_offers.json'
+
+# The config file can also be chosen with this environment variable, e.g. in the scheduled task
+CONFIG_ENV_VAR = 'WEEKLY_OFFERS_CONFIG'
+
+DEFAULT_URLS = ['https://ereklamblad.se/ICA-Maxi-Stormarknad/erbjudanden',
+                'https://ereklamblad.se/Hemkop/erbjudanden',
+                'https://ereklamblad.se/ICA-Supermarket/erbjudanden']
+
+DEFAULTS = {
+    'urls': DEFAULT_URLS,
+    'db_url': None,
+    'load_mode': 'upsert',
+    'workers': 1,
+    'fetch_mode': 'browser',
+    'chunk_size': 500,
+    'snapshot_dir': None,
+    'archive_dir': None,
+    'cache_file': None,
+    'products_file': None,
+    'metrics_file': None,
+    'checkpoint_dir': 'checkpoints',
+    'retries': 2,
+    'retry_backoff': 5.0,
+    'timeout': 180,
+    'browser_profile': 'default',
+    'queue_url': 'sqlite:///job_queue.db',
+    'lease': 120,
+}
+
+def load_config(path=None) -> dict:
+    """Returns the defaults updated with the settings in the config file. Without a path, the file in
+    the environment variable or 'weekly_offers.json' is read if it exists. Raises ValueError for unknown keys.
+    """
+    if path is None:
+        path = os.environ.get(CONFIG_ENV_VAR) or CONFIG_FILE
+        if not os.path.exists(path):
+            return dict(DEFAULTS)
+    with open(path, encoding='utf-8') as file:
+        settings = json.load(file)
+    unknown = sorted(set(settings) - set(DEFAULTS))
+    if unknown:
+        raise ValueError(f'Unknown setting(s) in {path}: {", ".join(unknown)}.')
+    return {**DEFAULTS, **settings}
@@ -1,58 +1,278 @@
 """Main script that will run automatically every Sunday kl. 10:00 through Windows Task Scheduler."""
 
 from fetch_weekly_offers.utils.scraper import Scraper
-from fetch_weekly_offers.utils.cleaner import DataCleaner
+from fetch_weekly_offers.utils.cleaner import DataCleaner, clean_chunks, concat_offers
 from fetch_weekly_offers.utils.funcs import set_up_logging, logger, save_to_sql
+from fetch_weekly_offers.utils.archive import write_archive
+from fetch_weekly_offers.utils.cache import FlyerCache
+from fetch_weekly_offers.utils.matching import ProductIndex
+from fetch_weekly_offers.utils.checkpoint import RunCheckpoint
+from fetch_weekly_offers.utils.metrics import metrics
+from fetch_weekly_offers.utils.http_fetch import HttpFetcher
+from fetch_weekly_offers.config import DEFAULT_URLS
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+import sys
+import time
 import pandas as pd
 
 set_up_logging()
 
-if __name__ == '__main__':
-    
-    urls = ['https://ereklamblad.se/ICA-Maxi-Stormarknad/erbjudanden',
-        'https://ereklamblad.se/Hemkop/erbjudanden',
-        'https://ereklamblad.se/ICA-Supermarket/erbjudanden']
-    
-    all_scraped_data = []
-
-    for url in urls:
-        logger.info('Processing URL: %s', url)
-        
-        # Instantiate Scraper and scrape data for one URL at a time
-        scraper = Scraper(url)
-        scraped_data = scraper.scrape()
-
-        if scraped_data:
-            logger.info('Scraping was successful for URL: %s. Proceeding to data cleaning.', url)
-            
-            # Instantiate DataCleaner with the newly scraped data
-            data_cleaner = DataCleaner(scraped_data)
-            
-            # Convert the scraped data to DataFrame and proceed with data cleaning
-            cleaned_data = data_cleaner.clean()
-            
-            if not cleaned_data.empty:
-                logger.info('Data cleaning completed for URL: %s. Proceeding to save data to SQL database.', url)
-                
-                # Save the cleaned data to SQL
-                all_scraped_data.append(cleaned_data)
-            else:
-                logger.error('An error occured. No data to save after cleaning for URL: %s.', url)
+# The URLs are read from the config file by the command line interface, these are the defaults
+URLS = DEFAULT_URLS
+
+def open_driver_pool(fetch_mode='browser', **options):
+    """Returns a DriverPool with the given options, or an empty context without a pool in fetch mode 'http', 
+    which never starts a browser. Selenium is only imported when a pool is built.
+    """
+    if fetch_mode == 'http':
+        return nullcontext()
+    from fetch_weekly_offers.utils.driver import DriverPool
+    return DriverPool(**options)
+
+def process_url(url: str, pool=None, snapshot_dir=None, cache=None, fetch_mode='browser', fetcher=None, 
+                timeout=None) -> pd.DataFrame:
+    """Scrapes and cleans the offers for one URL. Returns an empty DataFrame if the flyer cache shows 
+    that the offers are unchanged since the last run. Raises RuntimeError if no offers could be scraped 
+    or cleaned, and TimeoutError if loading the page took longer than timeout seconds.
+    """
+    with metrics.stage('process_url', url=url) as stage:
+        cleaned_data = _scrape_and_clean(url, pool=pool, snapshot_dir=snapshot_dir, cache=cache, 
+                                         fetch_mode=fetch_mode, fetcher=fetcher, timeout=timeout)
+        stage.set(rows=len(cleaned_data))
+    return cleaned_data
+
+def _scrape_and_clean(url: str, pool=None, snapshot_dir=None, cache=None, fetch_mode='browser', 
+                      fetcher=None, timeout=None) -> pd.DataFrame:
+    logger.info('Processing URL: %s', url)
+
+    # Instantiate Scraper and scrape data for one URL at a time
+    scraper = Scraper(url, pool=pool, snapshot_dir=snapshot_dir, cache=cache, fetch_mode=fetch_mode, fetcher=fetcher, 
+                      timeout=timeout)
+    scraped_data = scraper.scrape()
+
+    if scraper.unchanged:
+        logger.info('No changes for URL: %s. Skipping data cleaning and saving.', url)
+        # Keep any newly seen fingerprint, so the next run can stop at the cheapest check
+        cache.commit([url])
+        metrics.record('skipped_unchanged', url=url)
+    elif scraped_data:
+        logger.info('Scraping was successful for URL: %s. Proceeding to data cleaning.', url)
+
+        # Instantiate DataCleaner with the newly scraped data
+        data_cleaner = DataCleaner(scraped_data)
+
+        # Convert the scraped data to DataFrame and proceed with data cleaning
+        cleaned_data = data_cleaner.clean()
+
+        if not cleaned_data.empty:
+            logger.info('Data cleaning completed for URL: %s. Proceeding to save data to SQL database.', url)
+            return cleaned_data
+        raise RuntimeError(f'No data to save after cleaning for URL: {url}.')
+    else:
+        raise RuntimeError(f'No data scraped for URL: {url}.')
+    return pd.DataFrame()
+
+def process_with_retries(process, url: str, retries=0, retry_backoff=5.0, checkpoint=None) -> pd.DataFrame:
+    """Calls process for the URL, retrying up to retries times with exponential backoff (retry_backoff, 
+    then twice as long, ...). With a RunCheckpoint, the result or the final failure is recorded in it. 
+    The error of the last attempt is raised.
+    """
+    for attempt in range(1, retries + 2):
+        try:
+            result = process(url)
+        except Exception as e:
+            if attempt > retries:
+                if checkpoint is not None:
+                    checkpoint.save_failure(url, e, attempts=attempt)
+                raise
+            delay = retry_backoff * 2 ** (attempt - 1)
+            logger.warning('%s: Attempt %d of %d failed for URL: %s. Retrying in %.1f s.', 
+                           e, attempt, retries + 1, url, delay)
+            metrics.record('retry', url=url, attempt=attempt)
+            time.sleep(delay)
         else:
-            logger.error('An error occured. No data scraped for URL: %s.', url)
-    
+            if checkpoint is not None:
+                checkpoint.save_result(url, result, attempts=attempt)
+            return result
+
+def scrape_url(url: str, pool=None, snapshot_dir=None, fetch_mode='browser', fetcher=None, timeout=None) -> pd.DataFrame:
+    """Scrapes the offers for one URL without cleaning them. Returns the raw records as a DataFrame.
+    Raises RuntimeError if no offers could be scraped.
+    """
+    with metrics.stage('scrape_url', url=url) as stage:
+        scraper = Scraper(url, pool=pool, snapshot_dir=snapshot_dir, fetch_mode=fetch_mode, fetcher=fetcher, 
+                          timeout=timeout)
+        raw_data = pd.DataFrame(scraper.scrape())
+        stage.set(rows=len(raw_data))
+    if raw_data.empty:
+        raise RuntimeError(f'No data scraped for URL: {url}.')
+    return raw_data
+
+def scrape_all(urls: list, max_workers: int = 1, process=None, max_pages_per_browser: int = 20, 
+               snapshot_dir=None, cache=None, fetch_mode='browser', clean=True, retries=0, retry_backoff=5.0, 
+               timeout=None, checkpoint=None, browser_profile='default') -> dict:
+    """Processes every URL and returns a dict mapping each URL to its cleaned DataFrame 
+    (or to its raw records with clean=False).
+
+    With max_workers=1 the URLs are processed one at a time, as before. With more workers the URLs 
+    are spread over a thread pool. Either way the browsers come from a DriverPool with one warm browser 
+    (and one isolated profile) per worker. Failed URLs are mapped to an empty DataFrame.
+    If snapshot_dir is given, every scraped page is archived there (see the snapshot module).
+    With a FlyerCache, stores whose offers are unchanged since the last run are skipped.
+    With fetch_mode 'http' or 'auto' the pages are first requested without a browser over one shared 
+    connection pool, and the browsers of the DriverPool are only started for the stores that need them.
+    A URL that fails or takes longer than timeout seconds is retried up to retries times with backoff, 
+    and with a RunCheckpoint every URL's result is saved to disk as soon as it is done.
+    The browsers are started with browser_profile, 'lean' runs them headless without images, media, 
+    fonts and trackers (see the driver module).
+    """
+    if process is None:
+        with open_driver_pool(fetch_mode, size=max(max_workers, 1), max_pages=max_pages_per_browser, 
+                              profile=browser_profile) as pool, \
+                HttpFetcher(pool_size=max(max_workers, 1)) as fetcher:
+            if clean:
+                process = partial(process_url, pool=pool, snapshot_dir=snapshot_dir, cache=cache, 
+                                  fetch_mode=fetch_mode, fetcher=fetcher, timeout=timeout)
+            else:
+                process = partial(scrape_url, pool=pool, snapshot_dir=snapshot_dir, fetch_mode=fetch_mode, 
+                                  fetcher=fetcher, timeout=timeout)
+            return scrape_all(urls, max_workers=max_workers, process=process, retries=retries, 
+                              retry_backoff=retry_backoff, checkpoint=checkpoint)
+
+    process = partial(process_with_retries, process, retries=retries, retry_backoff=retry_backoff, checkpoint=checkpoint)
+    results = {}
+    if max_workers <= 1:
+        for url in urls:
+            try:
+                results[url] = process(url)
+            except Exception as e:
+                logger.error('%s: An error occured while processing URL: %s.', e, url)
+                results[url] = pd.DataFrame()
+        return results
+
+    logger.info('Processing %d URLs with %d workers.', len(urls), max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process, url): url for url in urls}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                results[url] = future.result()
+            except Exception as e:
+                logger.error('%s: An error occured while processing URL: %s.', e, url)
+                results[url] = pd.DataFrame()
+    # Keep the input order so that the combined data looks the same as in a sequential run
+    return {url: results[url] for url in urls}
+
+def run(urls: list, max_workers: int = 1, snapshot_dir=None, db_url=None, load_mode='upsert', archive_dir=None, 
+        cache_file=None, fetch_mode='browser', products_file=None, checkpoint_dir=None, resume=False, retries=0, 
+        retry_backoff=5.0, timeout=None, browser_profile='default') -> bool:
+    """Scrapes and cleans all URLs, then saves the combined data to the SQL database in one go.
+    Returns whether the run succeeded: False if there was no data to save or saving it failed.
+    If archive_dir is given, the combined data is also added to the columnar archive (see the archive module).
+    If cache_file is given, stores whose offers are unchanged since the last run are skipped (see the cache module).
+    If products_file is given, every offer gets a ProductId shared across stores and weeks (see the matching module).
+    If checkpoint_dir is given, the cleaned offers of every store are saved there as soon as they are done, and 
+    with resume=True only the stores that failed or never finished in the latest run are done again. The 
+    checkpoint is removed once all stores are done and saved (see the checkpoint module).
+    """
+    cache = FlyerCache(cache_file) if cache_file else None
+    checkpoint = RunCheckpoint.open(checkpoint_dir, resume=resume) if checkpoint_dir else None
+    pending = checkpoint.pending(urls) if checkpoint is not None else urls
+    if checkpoint is not None and len(pending) < len(urls):
+        if not pending and checkpoint.state['saved']:
+            logger.info('All URLs of the run in %s are done and saved, nothing to resume.', checkpoint.directory)
+            checkpoint.remove()
+            return True
+        logger.info('%d of %d URLs already done in %s, processing the others.', 
+                    len(urls) - len(pending), len(urls), checkpoint.directory)
+
+    results = scrape_all(pending, max_workers=max_workers, snapshot_dir=snapshot_dir, cache=cache, 
+                         fetch_mode=fetch_mode, retries=retries, retry_backoff=retry_backoff, timeout=timeout, 
+                         checkpoint=checkpoint, browser_profile=browser_profile)
+    if checkpoint is not None:
+        results = {url: results[url] if url in results else checkpoint.load_result(url) for url in urls}
+    all_scraped_data = [df for df in results.values() if not df.empty]
+
     if all_scraped_data:
-        # Combine all cleaned data 
-        combined_data = pd.concat(all_scraped_data, ignore_index=True)
-        
+        # Combine all cleaned data
+        combined_data = concat_offers(all_scraped_data)
+
+        if products_file is not None:
+            index = ProductIndex(products_file)
+            with metrics.stage('match_products', rows=len(combined_data)):
+                combined_data = index.assign(combined_data)
+            index.save()
+
         # Save data to SQL db
         logger.info('Saving combined data to SQL database.')
-        save_to_sql(combined_data)
-    else:
-        logger.error('No data to save after processing all URLs.')
-    
+        saved = save_to_sql(combined_data, db_url=db_url, mode=load_mode)
+
+        # Only remember the fingerprints once the data behind them is safely saved
+        if saved and cache is not None:
+            cache.commit([url for url, df in results.items() if not df.empty])
+        if saved and checkpoint is not None:
+            checkpoint.mark_saved()
+            # Kept while stores failed, so that a resumed run only does those again
+            if not checkpoint.pending(urls):
+                checkpoint.remove()
+
+        if archive_dir is not None:
+            try:
+                write_archive(combined_data, archive_dir)
+            except Exception as e:
+                logger.error('%s: Failed to archive the data.', e)
+        return saved
+    if cache is not None:
+        logger.info('No new or changed data to save after processing all URLs.')
+        return True
+    logger.error('No data to save after processing all URLs.')
+    return False
+
+def run_streaming(urls: list, chunk_size: int = 500, snapshot_dir=None, db_url=None, writer=None, 
+                  scraper_factory=Scraper, fetch_mode='browser', products_file=None, browser_profile='default') -> int:
+    """Scrapes, cleans and saves the URLs one chunk at a time, so memory stays flat however many stores 
+    there are. Every chunk is committed as soon as it is cleaned (upserted by default, or passed to the 
+    given writer), so a failure at one store does not lose the stores before it. A writer that returns 
+    False, as save_to_sql does when saving fails, stops the store there. Returns the number of rows written.
+    """
+    if writer is None:
+        writer = partial(save_to_sql, db_url=db_url, mode='upsert')
+    index = ProductIndex(products_file) if products_file else None
 
-    
-        
-  
-    
\ No newline at end of file
+    rows_written = 0
+    with open_driver_pool(fetch_mode, size=1, profile=browser_profile) as pool, HttpFetcher(pool_size=1) as fetcher:
+        for url in urls:
+            logger.info('Processing URL: %s', url)
+            url_rows = 0
+            failed = False
+            with metrics.stage('process_url', url=url) as stage:
+                try:
+                    scraper = scraper_factory(url, pool=pool, snapshot_dir=snapshot_dir, fetch_mode=fetch_mode, 
+                                              fetcher=fetcher)
+                    for chunk in clean_chunks(scraper.iter_offers(batch_size=chunk_size), chunk_size=chunk_size):
+                        if index is not None:
+                            chunk = index.assign(chunk)
+                        if writer(chunk) is False:
+                            raise IOError(f'Saving {len(chunk)} rows failed, the rest of the store is skipped.')
+                        url_rows += len(chunk)
+                except Exception as e:
+                    failed = True
+                    logger.error('%s: An error occured while processing URL: %s.', e, url)
+                stage.set(rows=url_rows)
+            if failed:
+                logger.error('An error occured. %d rows saved for URL: %s before it failed.', url_rows, url)
+            elif url_rows:
+                logger.info('%d rows saved for URL: %s.', url_rows, url)
+            else:
+                logger.error('An error occured. No data saved for URL: %s.', url)
+            rows_written += url_rows
+    if index is not None:
+        index.save()
+    return rows_written
+
+if __name__ == '__main__':
+    # Kept for the existing scheduled task, the options are the ones of 'python -m fetch_weekly_offers run'
+    from fetch_weekly_offers.cli import main
+    sys.exit(main(['run', *sys.argv[1:]]))
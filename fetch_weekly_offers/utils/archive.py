@@ -0,0 +1,118 @@
+"""Module providing a columnar archive of the cleaned offers from every run.
+
+The offers are written as a Parquet (or Arrow IPC) dataset partitioned by the ISO week of their ValidFrom
+date and by store, in the directory layout 'Week=2024-W39/Store=ICA Maxi Stormarknad/part-0.parquet', so
+an offer is filed under the same week whichever run scraped it. Reading back only touches the partitions
+matching the requested weeks and stores and only loads the requested columns.
+Requires pyarrow, which is only imported when the archive is used.
+"""
+
+import os
+from datetime import date
+from urllib.parse import unquote
+import pandas as pd
+from .cleaner import cast_offers, concat_offers
+from .funcs import NATURAL_KEY, set_up_logging, logger
+
+# Set up logging
+set_up_logging()
+
+ARCHIVE_DIR = 'offers_archive'
+PARTITION_COLUMNS = ['Week', 'Store']
+FORMATS = {'parquet': 'parquet', 'ipc': 'arrow'}
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError('The offers archive requires pyarrow, install it with "pip install pyarrow".') from None
+    return pyarrow, pyarrow.dataset
+
+def iso_week(day=None) -> str:
+    """Returns the ISO week of the day (today by default) as a string, e.g. '2024-W39'."""
+    year, week, _ = (day or date.today()).isocalendar()
+    return f'{year}-W{week:02d}'
+
+def _partitioning(pa, ds):
+    return ds.partitioning(pa.schema([(column, pa.string()) for column in PARTITION_COLUMNS]), flavor='hive')
+
+def offer_weeks(df: pd.DataFrame, run_date=None) -> pd.Series:
+    """Returns the ISO week of the ValidFrom date of every offer. Offers without a ValidFrom date are
+    filed under the week of the run date (today by default).
+    """
+    fallback = iso_week(run_date)
+    return df['ValidFrom'].map(lambda day: iso_week(day.date()) if pd.notna(day) else fallback).astype(str)
+
+def write_archive(df: pd.DataFrame, root=ARCHIVE_DIR, run_date=None, format='parquet') -> list:
+    """Writes the cleaned offers of one run to the archive and returns the weeks they were filed under.
+
+    The offers are merged into the partitions that already exist for their week and store, and an
+    offer archived before (same NATURAL_KEY) is replaced, so rerunning a week does not duplicate its offers.
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Unknown archive format {format!r}, choose one of {", ".join(FORMATS)}.')
+    pa, ds = _import_pyarrow()
+
+    # Partition values have to be plain strings, the Store column may be categorical
+    df = df.assign(Week=offer_weeks(df, run_date), Store=df['Store'].astype(str))
+    weeks = sorted(df['Week'].unique())
+    count = len(df)
+    if os.path.isdir(root):
+        archived = read_archive(root, weeks=weeks, stores=set(df['Store']), format=format)
+        if not archived.empty:
+            archived = cast_offers(archived.astype({'Week': str, 'Store': str}))
+            df = concat_offers([archived, df]).drop_duplicates(NATURAL_KEY, keep='last')
+            df = df.astype({'Week': str, 'Store': str})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    ds.write_dataset(table, root, format=format, partitioning=_partitioning(pa, ds),
+                     basename_template=f'part-{{i}}.{FORMATS[format]}',
+                     existing_data_behavior='delete_matching')
+    logger.info('%d offers archived to %s for week(s) %s.', count, root, ', '.join(weeks))
+    return weeks
+
+def read_archive(root=ARCHIVE_DIR, columns=None, weeks=None, stores=None, format='parquet') -> pd.DataFrame:
+    """Reads offers from the archive. Only the given columns are loaded and only the partitions matching
+    the given weeks and stores are opened. Week and Store can be requested as columns as well.
+    """
+    pa, ds = _import_pyarrow()
+    if not os.path.isdir(root):
+        logger.error('No offers archive found in %s.', root)
+        return pd.DataFrame(columns=columns)
+
+    dataset = ds.dataset(root, format=format, partitioning=_partitioning(pa, ds))
+    expression = None
+    for column, values in (('Week', weeks), ('Store', stores)):
+        if values is not None:
+            condition = ds.field(column).isin(list(values))
+            expression = condition if expression is None else expression & condition
+
+    table = dataset.to_table(columns=columns, filter=expression)
+    logger.info('%d offers read from the archive in %s.', table.num_rows, root)
+    return table.to_pandas()
+
+def _partition_dirs(root):
+    """Yields the week, store and directory of every partition in the archive."""
+    if not os.path.isdir(root):
+        return
+    for week_dir in os.listdir(root):
+        if not week_dir.startswith('Week='):
+            continue
+        for store_dir in os.listdir(os.path.join(root, week_dir)):
+            if store_dir.startswith('Store='):
+                yield (unquote(week_dir[len('Week='):]), unquote(store_dir[len('Store='):]),
+                       os.path.join(root, week_dir, store_dir))
+
+def list_partitions(root=ARCHIVE_DIR) -> list:
+    """Returns the (week, store) pairs in the archive, sorted by week, without reading any data."""
+    return sorted((week, store) for week, store, _ in _partition_dirs(root))
+
+def partition_write_times(root=ARCHIVE_DIR) -> dict:
+    """Returns the time every (week, store) partition was last written, from the times of its files."""
+    times = {}
+    for week, store, path in _partition_dirs(root):
+        mtimes = [entry.stat().st_mtime for entry in os.scandir(path) if entry.is_file()]
+        if mtimes:
+            times[(week, store)] = pd.Timestamp.fromtimestamp(max(mtimes))
+    return times
@@ -0,0 +1,78 @@
+"""Module providing a persistent cache of flyer fingerprints, used to skip stores whose offers have not changed.
+
+Two fingerprints are kept per URL:
+- the validity window, i.e. the validFrom/validThrough meta tags of the offers visible right after the page
+  loaded, which can be checked before scrolling and parsing the page, and
+- a hash of the extracted records, which is checked before cleaning and saving them.
+
+New fingerprints are only staged while a store is processed, and are committed once its data has been
+saved, so a store whose save failed is not skipped on the next run.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+from .funcs import set_up_logging, logger, write_atomic
+
+# Set up logging
+set_up_logging()
+
+CACHE_FILE = 'flyer_cache.json'
+
+def fingerprint_records(records: list) -> str:
+    """Returns a SHA-256 hash of the extracted records that does not depend on their order."""
+    lines = sorted(json.dumps(record, sort_keys=True, default=str) for record in records)
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+def has_dates(validity) -> bool:
+    """Returns True if the validity window holds dates, [[], []] is read before any offer has rendered."""
+    return bool(validity) and all(validity)
+
+class FlyerCache:
+    """This class keeps the last fingerprints of every URL in a JSON file."""
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        self.pending = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as file:
+                    self.entries = json.load(file)
+            except (OSError, ValueError) as e:
+                logger.error('%s: Could not read the flyer cache %s, starting with an empty cache.', e, path)
+
+    def is_unchanged(self, url: str, validity=None, records_hash=None) -> bool:
+        """Returns True if the given fingerprint equals the one saved for the URL on the last run."""
+        entry = self.entries.get(url)
+        if entry is None:
+            return False
+        if validity is not None:
+            # A validity without dates says nothing about the offers, so it never matches
+            return has_dates(validity) and entry.get('validity') == validity
+        if records_hash is not None:
+            return entry.get('records_hash') == records_hash
+        return False
+
+    def stage(self, url: str, validity=None, records_hash=None) -> None:
+        """Stages new fingerprints for the URL, to be saved by commit() once its data has been saved.
+        A validity without dates is not staged.
+        """
+        with self._lock:
+            pending = self.pending.setdefault(url, {})
+            if validity is not None and has_dates(validity):
+                pending['validity'] = validity
+            if records_hash is not None:
+                pending['records_hash'] = records_hash
+
+    def commit(self, urls=None) -> None:
+        """Saves the staged fingerprints of the given URLs (all staged URLs by default) to the cache file."""
+        with self._lock:
+            for url in list(self.pending if urls is None else urls):
+                if url in self.pending:
+                    self.entries[url] = {**self.pending.pop(url), 'updated_at': datetime.now().isoformat(timespec='seconds')}
+            write_atomic(self.path, lambda file: json.dump(self.entries, file, indent=2))
+        logger.info('Flyer cache saved to %s.', self.path)
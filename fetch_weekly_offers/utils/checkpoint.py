@@ -0,0 +1,114 @@
+"""Module providing run checkpoints, so that a failed or interrupted run can be resumed store by store.
+
+Every run gets its own directory in the checkpoint root, e.g. 'checkpoints/20240925T100000/', with
+- 'state.json', recording the status ('done' or 'failed'), attempts and row count of every URL, and
+- one pickle file per finished URL with its cleaned offers (pickle keeps the dtypes of the offer schema).
+
+The state is written as soon as a URL finishes, so a resumed run only redoes the URLs that failed or
+never finished, and reads the cleaned offers of the others back from disk. Once every URL of a run is
+done and saved to the database the run directory is removed, so only runs left to resume stay on disk.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from datetime import datetime
+import pandas as pd
+from .funcs import set_up_logging, logger, write_atomic
+
+# Set up logging
+set_up_logging()
+
+CHECKPOINT_DIR = 'checkpoints'
+STATE_NAME = 'state.json'
+
+def latest_run(root=CHECKPOINT_DIR):
+    """Returns the directory of the latest run in the checkpoint root, or None if there is none."""
+    if not os.path.isdir(root):
+        return None
+    runs = sorted(name for name in os.listdir(root) if os.path.exists(os.path.join(root, name, STATE_NAME)))
+    return os.path.join(root, runs[-1]) if runs else None
+
+class RunCheckpoint:
+    """This class keeps the progress of one run in a checkpoint directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.state_path = os.path.join(directory, STATE_NAME)
+        self.state = {'created_at': datetime.now().isoformat(timespec='seconds'), 'saved': False, 'urls': {}}
+        self._lock = threading.Lock()
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as file:
+                self.state = json.load(file)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self._write()
+
+    @classmethod
+    def open(cls, root=CHECKPOINT_DIR, resume=False) -> 'RunCheckpoint':
+        """Returns the checkpoint of the latest run to resume it, or of a new run."""
+        if resume:
+            directory = latest_run(root)
+            if directory is not None:
+                logger.info('Resuming the run checkpointed in %s.', directory)
+                return cls(directory)
+            logger.warning('No run to resume in %s, starting a new run.', root)
+        return cls(os.path.join(root, datetime.now().strftime('%Y%m%dT%H%M%S')))
+
+    def status(self, url: str):
+        entry = self.state['urls'].get(url)
+        return entry['status'] if entry else None
+
+    def pending(self, urls: list) -> list:
+        """Returns the URLs that have not finished successfully yet, in the given order."""
+        return [url for url in urls if self.status(url) != 'done']
+
+    def _result_path(self, url: str) -> str:
+        return os.path.join(self.directory, f'{hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]}.pkl')
+
+    def save_result(self, url: str, df: pd.DataFrame, attempts=1) -> None:
+        """Saves the cleaned offers of a finished URL and marks it as done."""
+        path = None
+        if not df.empty:
+            path = self._result_path(url)
+            df.to_pickle(path)
+        self._update(url, {'status': 'done', 'rows': len(df), 'attempts': attempts,
+                           'path': os.path.basename(path) if path else None})
+
+    def save_failure(self, url: str, error, attempts=1) -> None:
+        """Marks a URL as failed, so a resumed run does it again."""
+        self._update(url, {'status': 'failed', 'error': str(error), 'attempts': attempts})
+
+    def load_result(self, url: str) -> pd.DataFrame:
+        """Returns the cleaned offers saved for a URL, an empty DataFrame if it had none."""
+        entry = self.state['urls'].get(url)
+        if not entry or entry['status'] != 'done' or not entry.get('path'):
+            return pd.DataFrame()
+        return pd.read_pickle(os.path.join(self.directory, entry['path']))
+
+    def mark_saved(self) -> None:
+        """Records that the results of the run were saved to the database."""
+        with self._lock:
+            self.state['saved'] = True
+            self._write()
+
+    def remove(self) -> None:
+        """Removes the run directory, and the checkpoint root once no other run is left in it."""
+        try:
+            shutil.rmtree(self.directory)
+            root = os.path.dirname(self.directory)
+            if root and not os.listdir(root):
+                os.rmdir(root)
+            logger.info('Removed the checkpoint of the finished run in %s.', self.directory)
+        except OSError as e:
+            logger.error('%s: Failed to remove the checkpoint in %s.', e, self.directory)
+
+    def _update(self, url: str, entry: dict) -> None:
+        with self._lock:
+            self.state['urls'][url] = {**entry, 'finished_at': datetime.now().isoformat(timespec='seconds')}
+            self._write()
+
+    def _write(self) -> None:
+        write_atomic(self.state_path, lambda file: json.dump(self.state, file, indent=2))
@@ -1,18 +1,148 @@
 """Module providing a DataCleaner with functionality to clean and structure data gathered by the scraper."""
 
+import re
+from collections import Counter
 import pandas as pd
 from .funcs import set_up_logging, logger
+from .metrics import metrics
 
 # Set up logging 
 set_up_logging()
 
+# The steps run by DataCleaner.clean(), in order
+CLEANING_STEPS = ['convert_to_df', 'remove_duplicates', 'clean_prices', 'clean_details', 'clean_datetime', 
+                  'number_variants', 'apply_schema']
+
+# The offers a store lists under the same name in the same week are told apart by their Variant number
+VARIANT_GROUP = ['Store', 'Name', 'ValidFrom']
+
+# The columns and dtypes of the cleaned offers. Columns with few distinct values are categorical, the dates 
+# are datetime64 (at midnight) and the counts are small integers. Amounts stay float64: float32 can not hold 
+# prices such as 49.90 exactly, which would make every saved offer look changed to the upsert.
+OFFER_SCHEMA = {
+    'Name': 'object',
+    'Price': 'float64',
+    'Store': 'category',
+    'ValidFrom': 'datetime64[ns]',
+    'ValidThrough': 'datetime64[ns]',
+    'ValidUntil': 'datetime64[ns]',
+    'Variant': 'int16',
+    'MultiBuyCount': 'int16',
+    'Quantity': 'category',
+    'ComparisonPrice': 'category',
+    'QuantityPieces': 'int16',
+    'QuantityAmount': 'float64',
+    'QuantityAmountMax': 'float64',
+    'QuantityUnit': 'category',
+    'ComparisonPriceAmount': 'float64',
+    'ComparisonUnit': 'category',
+}
+
+# A Swedish formatted number, e.g. '25', '49,90' or '1 099' (thousands separated by a (non-breaking) space)
+NUMBER = r'\d{1,3}(?:\s\d{3})*(?:[.,]\d+)?|\d+(?:[.,]\d+)?'
+
+# Prices such as '25 kr', '1 099 kr', '49,90 kr' and multi-buy prices such as '2 för 50 kr'
+PRICE_PATTERN = re.compile(rf'^\s*(?:(?P<MultiBuyCount>\d+)\s*för\s*)?(?P<Price>{NUMBER})\s*(?:kr|:-)?(?:/\w+)?\s*$')
+
+# The Details column holds the quantity and the comparison price separated by a bullet
+DETAILS_PATTERN = re.compile(r'^\s*(?P<Quantity>[^•]*?)\s*(?:•\s*(?P<ComparisonPrice>.*?)\s*)?$')
+
+# Quantities such as '400 g', '3 stycken', '2x420 g' and ranges such as '300-350 g'
+QUANTITY_PATTERN = re.compile(
+    rf'^(?:(?P<QuantityPieces>\d+)\s*x\s*)?(?P<QuantityAmount>{NUMBER})'
+    rf'(?:\s*-\s*(?P<QuantityAmountMax>{NUMBER}))?\s*(?P<QuantityUnit>[^\W\d]+)$')
+
+# Comparison prices such as '62,50 kr/kg', '15 kr/var' and 'max 73 kr/kg'
+COMPARISON_PATTERN = re.compile(rf'^(?:max\s*)?(?P<ComparisonPriceAmount>{NUMBER})\s*kr/(?P<ComparisonUnit>[^\W\d]+)$')
+
+# Units are written in different ways on the site, 'var' in a comparison price means per piece
+UNIT_ALIASES = {'stycken': 'st', 'styck': 'st', 'st': 'st', 'var': 'st', 'pack': 'förp', 'förp': 'förp'}
+
+def _as_text(series: pd.Series) -> pd.Series:
+    """Converts a column to strings while keeping missing values missing."""
+    return series.astype(str).where(series.notna())
+
+def _to_number(series: pd.Series) -> pd.Series:
+    """Converts numbers captured by the NUMBER pattern to floats, NaN where nothing was captured."""
+    return pd.to_numeric(series.str.replace(r'\s', '', regex=True).str.replace(',', '.'), errors='coerce')
+
+def _to_unit(series: pd.Series) -> pd.Series:
+    """Lower cases units and maps the different spellings of a unit to one."""
+    return series.str.lower().map(lambda unit: UNIT_ALIASES.get(unit, unit), na_action='ignore')
+
+def _to_date(series: pd.Series) -> pd.Series:
+    """Converts dates to datetime64 at midnight, NaT where the date is invalid. Dates with a UTC offset 
+    keep their date in that offset, like datetime.date() does.
+    """
+    dates = pd.to_datetime(series, errors='coerce')
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        # Mixed UTC offsets are parsed to an object column of Timestamps
+        dates = pd.to_datetime(dates.map(lambda value: value.replace(tzinfo=None), na_action='ignore'), errors='coerce')
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    return dates.dt.normalize().astype('datetime64[ns]')
+
+def validate_offers(df: pd.DataFrame, schema=OFFER_SCHEMA) -> None:
+    """Checks that a DataFrame of cleaned offers has all columns of the schema with the right dtypes. 
+    Raises ValueError listing every problem found.
+    """
+    problems = []
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            problems.append(f'column {column} is missing')
+        elif str(df[column].dtype) != dtype:
+            problems.append(f'column {column} is {df[column].dtype}, expected {dtype}')
+    if problems:
+        raise ValueError(f'The offers do not match the schema: {"; ".join(problems)}.')
+
+def concat_offers(frames: list) -> pd.DataFrame:
+    """Combines cleaned DataFrames into one. Unlike pd.concat, categorical columns stay categorical 
+    when the frames have different categories (e.g. one frame per store).
+    """
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    combined = pd.concat(frames, ignore_index=True)
+    for column in frames[0].columns:
+        if all(isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames if column in df.columns):
+            combined[column] = combined[column].astype('category')
+    return combined
+
+def read_offers(path: str) -> pd.DataFrame:
+    """Reads cleaned offers from a Parquet or CSV file and casts the schema columns back to their dtypes,
+    which a CSV file does not keep. Parquet requires pyarrow.
+    """
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path)
+    return cast_offers(df)
+
+def cast_offers(df: pd.DataFrame) -> pd.DataFrame:
+    """Casts the schema columns of cleaned offers read back from a file or the database to their dtypes."""
+    columns = [column for column in OFFER_SCHEMA if column in df.columns]
+    for column in columns:
+        if OFFER_SCHEMA[column].startswith('datetime64'):
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+    return df.astype({column: OFFER_SCHEMA[column] for column in columns})
+
+def write_offers(df: pd.DataFrame, path: str) -> None:
+    """Writes cleaned offers to a Parquet file (which keeps the dtypes, requires pyarrow) or a CSV file."""
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    logger.info('%d cleaned offers written to %s', len(df), path)
+
 class DataCleaner:
     """This class provides functionality to clean and structure data gathered 
     by the scraper, preparing it for data analysis and storage in a database.
     """
     
-    def __init__(self, data: list):
+    def __init__(self, data: list, variant_counts=None):
         self.data = data
+        # Optional Counter of the offers per VARIANT_GROUP in the earlier chunks of the same pages, see clean_chunks
+        self.variant_counts = variant_counts
         if not data:
             logger.error('No data passed to DataCleaner.')
         else:
@@ -33,11 +163,15 @@ class DataCleaner:
             return pd.DataFrame()        
         
     def remove_duplicates(self) -> pd.DataFrame:
-        """This method removes duplicate rows."""
+        """This method removes duplicate rows. Rows that only differ in whitespace (the site sometimes 
+        lists an offer twice, once as '3 stycken•15 kr/var' and once as '3 stycken• 15 kr/var') count 
+        as duplicates, since they clean to the same offer.
+        """
         if self.df is not None:
             try:
                 initial_row_count = len(self.df)
-                self.df = self.df.drop_duplicates()
+                compared = self.df.astype(str).replace(r'\s+', '', regex=True)
+                self.df = self.df[~compared.duplicated()]
                 new_row_count = len(self.df)
                 del_rows_count = initial_row_count - new_row_count
                 logger.info('Duplicates removed, %d rows were dropped.', del_rows_count)
@@ -50,15 +184,18 @@ class DataCleaner:
             return pd.DataFrame()      
                        
     def clean_prices(self) -> pd.DataFrame:
-        """This method cleans the price column and converts it to numeric."""
+        """This method parses the price column to numeric in a single regex pass. 
+        Multi-buy prices such as '2 för 50 kr' get the number of items in the MultiBuyCount column.
+        Prices that can not be parsed are set to NaN instead of leaving the whole column unconverted.
+        """
         if self.df is not None:
             try:
-                self.df['Price'] = self.df['Price'].astype(str)
-                # Remove all types of white spaces
-                self.df['Price'] = self.df['Price'].str.replace(r'\s+', '', regex=True)
-                self.df['Price'] = self.df['Price'].str.replace(',', '.')
-                self.df['Price'] = self.df['Price'].str.replace('kr', '')
-                self.df['Price'] = self.df['Price'].astype(float)
+                prices = _as_text(self.df['Price']).str.extract(PRICE_PATTERN)
+                self.df['Price'] = _to_number(prices['Price'])
+                self.df['MultiBuyCount'] = pd.to_numeric(prices['MultiBuyCount'], errors='coerce').fillna(1).astype(int)
+                invalid_count = int(self.df['Price'].isna().sum())
+                if invalid_count:
+                    logger.warning('%d prices could not be parsed and were set to NaN.', invalid_count)
                 logger.info('Price column cleaned and converted to numeric successfully.')
                 return self.df
             except Exception as e:
@@ -69,12 +206,25 @@ class DataCleaner:
             return pd.DataFrame()
             
     def clean_details(self) -> pd.DataFrame:
-        """This method cleans and splits the details column into two new columns."""
+        """This method splits the details column into Quantity and ComparisonPrice and parses both 
+        into numeric amounts and units (QuantityPieces, QuantityAmount, QuantityAmountMax, QuantityUnit, 
+        ComparisonPriceAmount and ComparisonUnit). Parts that can not be parsed are set to NaN.
+        """
         if self.df is not None:
             try: 
-                self.df['Details'] = self.df['Details'].astype(str)
-                self.df[['Quantity', 'ComparisonPrice']] = self.df['Details'].str.split('•', expand=True)
-                self.df= self.df.drop('Details', axis=1)
+                details = _as_text(self.df['Details']).str.extract(DETAILS_PATTERN)
+                quantity = details['Quantity'].str.extract(QUANTITY_PATTERN)
+                comparison = details['ComparisonPrice'].str.extract(COMPARISON_PATTERN)
+                
+                self.df['Quantity'] = details['Quantity']
+                self.df['ComparisonPrice'] = details['ComparisonPrice']
+                self.df['QuantityPieces'] = pd.to_numeric(quantity['QuantityPieces'], errors='coerce').fillna(1).astype(int)
+                self.df['QuantityAmount'] = _to_number(quantity['QuantityAmount'])
+                self.df['QuantityAmountMax'] = _to_number(quantity['QuantityAmountMax']).fillna(self.df['QuantityAmount'])
+                self.df['QuantityUnit'] = _to_unit(quantity['QuantityUnit'])
+                self.df['ComparisonPriceAmount'] = _to_number(comparison['ComparisonPriceAmount'])
+                self.df['ComparisonUnit'] = _to_unit(comparison['ComparisonUnit'])
+                self.df = self.df.drop('Details', axis=1)
                 logger.info('Details column modified and cleaned successfully.')
                 return self.df
             except Exception as e:
@@ -85,13 +235,13 @@ class DataCleaner:
             return pd.DataFrame()
             
     def clean_datetime(self) -> pd.DataFrame:
-        """This method converts the date columns to date objects."""
+        """This method converts the date columns to datetime64 dates (at midnight)."""
         if self.df is not None:
             # Any invalid date values will be set to NaT (errors='coerce')
             try:
-                self.df['ValidFrom'] = pd.to_datetime(self.df['ValidFrom'], errors='coerce').dt.date
-                self.df['ValidThrough'] = pd.to_datetime(self.df['ValidThrough'], errors='coerce').dt.date
-                self.df['ValidUntil'] = pd.to_datetime(self.df['ValidUntil'], errors='coerce').dt.date
+                self.df['ValidFrom'] = _to_date(self.df['ValidFrom'])
+                self.df['ValidThrough'] = _to_date(self.df['ValidThrough'])
+                self.df['ValidUntil'] = _to_date(self.df['ValidUntil'])
                 logger.info('Date columns converted and cleaned successfully.')
                 return self.df
             except Exception as e:
@@ -101,15 +251,55 @@ class DataCleaner:
             logger.error('No data to clean.')
             return pd.DataFrame()
             
+    def number_variants(self) -> pd.DataFrame:
+        """This method numbers the offers a store lists under the same name in the same week (e.g. two 
+        'Airfryer' at 799 and 999 kr) in the order they are listed, in the Variant column. With Store, Name 
+        and ValidFrom it identifies an offer between runs, also when its price changes (see NATURAL_KEY).
+        """
+        if self.df is not None:
+            try:
+                variants = self.df.groupby(VARIANT_GROUP, dropna=False, sort=False).cumcount()
+                if self.variant_counts is not None:
+                    groups = list(zip(*(self.df[column] for column in VARIANT_GROUP)))
+                    variants += [self.variant_counts[group] for group in groups]
+                    self.variant_counts.update(groups)
+                self.df['Variant'] = variants
+                logger.info('Offers sharing a name numbered successfully.')
+                return self.df
+            except Exception as e:
+                logger.error('%s: Failed to number the offers sharing a name.', e)
+                return self.df
+        else:
+            logger.error('No data to clean.')
+            return pd.DataFrame()
+
+    def apply_schema(self) -> pd.DataFrame:
+        """This method casts the cleaned columns to the compact dtypes in OFFER_SCHEMA and orders them 
+        as in the schema, then validates the result.
+        """
+        if self.df is not None:
+            try:
+                columns = [column for column in OFFER_SCHEMA if column in self.df.columns]
+                extra = [column for column in self.df.columns if column not in OFFER_SCHEMA]
+                self.df = self.df[columns + extra].astype({column: OFFER_SCHEMA[column] for column in columns})
+                validate_offers(self.df)
+                logger.info('Columns converted to the offer schema successfully.')
+                return self.df
+            except Exception as e:
+                logger.error('%s: Failed to apply the offer schema.', e)
+                return self.df
+        else:
+            logger.error('No data to clean.')
+            return pd.DataFrame()
+
     def clean(self) -> pd.DataFrame:
         """Run all cleaning steps."""
         if self.data:
             try: 
-                self.convert_to_df()
-                self.remove_duplicates()
-                self.clean_prices()
-                self.clean_details()
-                self.clean_datetime()
+                for step in CLEANING_STEPS:
+                    with metrics.stage(f'clean.{step}') as stage:
+                        getattr(self, step)()
+                        stage.set(rows=len(self.df))
                 logger.info('Data cleaned successfully.')
                 return self.df
             except Exception as e:
@@ -126,10 +316,28 @@ class DataCleaner:
             print(f'Cleaned data saved to {filename}')
         else:
             print('No data to save. Please load and clean the data first.')
-    
-    
-    
-
-        
-
 
+def clean_chunks(batches, chunk_size=500):
+    """Cleans an iterable of record batches (e.g. from Scraper.iter_offers) in chunks of chunk_size records 
+    and yields one cleaned DataFrame per chunk. Only one chunk is held in memory at a time.
+    Duplicates are removed across chunks too, like remove_duplicates does (only a hash per record is kept), 
+    so that the offers sharing a name are numbered as if the pages were cleaned at once.
+    """
+    chunk = []
+    seen = set()
+    variant_counts = Counter()
+    for batch in batches:
+        for record in batch:
+            fingerprint = hash(tuple(re.sub(r'\s+', '', str(value)) for value in record.values()))
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                chunk.append(record)
+        while len(chunk) >= chunk_size:
+            cleaned = DataCleaner(chunk[:chunk_size], variant_counts=variant_counts).clean()
+            chunk = chunk[chunk_size:]
+            if not cleaned.empty:
+                yield cleaned
+    if chunk:
+        cleaned = DataCleaner(chunk, variant_counts=variant_counts).clean()
+        if not cleaned.empty:
+            yield cleaned
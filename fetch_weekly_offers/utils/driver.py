@@ -0,0 +1,214 @@
+"""Module providing the Selenium WebDriver setup and a pool that lets several scrapes share warm browsers."""
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from functools import partial
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.chrome.options import Options
+from .funcs import set_up_logging, logger
+
+# Set up logging
+set_up_logging()
+
+# 'default' is the visible browser the scraper was developed with, 'lean' a headless browser that skips everything
+# the extraction does not need (images, media, fonts, ads and trackers), see create_driver
+BROWSER_PROFILES = ('default', 'lean')
+
+# URLs the lean profile never requests: media and fonts by extension, and the ad and tracker domains of the flyer pages.
+# The offers are read from the text and meta tags of the page, so none of these change the extracted data.
+BLOCKED_URL_PATTERNS = [
+    '*.mp4', '*.webm', '*.mp3', '*.m3u8',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*doubleclick.net*', '*googlesyndication.com*', '*googletagmanager.com*', '*google-analytics.com*',
+    '*googleadservices.com*', '*facebook.net*', '*facebook.com/tr*', '*hotjar.com*', '*adform.net*',
+    '*criteo.com*', '*cookielaw.org*', '*onetrust.com*', '*sentry.io*', '*newrelic.com*',
+]
+
+# The lean profile renders a fixed viewport and keeps a small disk cache per browser
+LEAN_WINDOW_SIZE = '1280,1600'
+LEAN_CACHE_BYTES = 32 * 1024 ** 2
+
+def _add_lean_options(chrome_options: Options) -> None:
+    chrome_options.add_argument('--headless=new')
+    chrome_options.add_argument(f'--window-size={LEAN_WINDOW_SIZE}')
+    chrome_options.add_argument(f'--disk-cache-size={LEAN_CACHE_BYTES}')
+    chrome_options.add_argument(f'--media-cache-size={LEAN_CACHE_BYTES}')
+    chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+    chrome_options.add_argument('--disable-remote-fonts')
+    chrome_options.add_argument('--mute-audio')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_experimental_option('prefs', {
+        'profile.managed_default_content_settings.images': 2,
+        'profile.managed_default_content_settings.media_stream': 2,
+        'profile.managed_default_content_settings.notifications': 2,
+        'profile.managed_default_content_settings.geolocation': 2,
+    })
+
+def block_urls(driver, patterns=BLOCKED_URL_PATTERNS) -> None:
+    """Makes the current tab of the driver skip every request matching the URL patterns.
+    The blocking is per tab, so reset_driver applies it again to the fresh tab it opens.
+    """
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': list(patterns)})
+    driver.blocked_urls = list(patterns)
+
+def create_driver(user_data_dir=None, profile='default') -> webdriver.Chrome:
+    """Sets up the Selenium WebDriver for automating browser interaction, with the given browser profile."""
+    if profile not in BROWSER_PROFILES:
+        raise ValueError(f'Unknown browser profile: {profile}')
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    driver_path = os.path.join(current_dir, 'chromedriver.exe')
+
+    # Creating a temp directory to ensure Chrome uses a clean user profile for every run
+    temp_user_data_dir = user_data_dir or os.path.join(os.getcwd(), 'temp_chrome_user_data')
+
+    # Initializing Options in order to customize how Chrome behaves with the new user profile
+    chrome_options = Options()
+
+    # Pointing Chrome to the new temp directory
+    chrome_options.add_argument(f'--user-data-dir={temp_user_data_dir}')
+
+    # Experimenting with different options, the following arguments ensured the Scraper runs smoothly (i.e block pop-up windows)
+    chrome_options.add_argument('--no-first-run')
+    chrome_options.add_argument('--no-default-browser-check')
+    chrome_options.add_argument('--disable-default-apps')
+    chrome_options.add_argument('--disable-extensions')
+    chrome_options.add_argument('--disable-popup-blocking')
+    chrome_options.add_argument('--disable-infobars')
+    chrome_options.add_argument('--disable-features=EnableEphemeralFlashPermission')
+    chrome_options.add_argument('--disable-background-networking')
+    chrome_options.add_argument('--disable-sync')
+    chrome_options.add_argument('--disable-translate')
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    if profile == 'lean':
+        _add_lean_options(chrome_options)
+
+    # Instantiating the driver
+    service = Service(executable_path=driver_path)
+    driver = webdriver.Chrome(service=service, options=chrome_options)
+    if profile == 'lean':
+        block_urls(driver)
+    return driver
+
+def reset_driver(driver) -> None:
+    """Clears cookies and storage and leaves the driver on a single blank tab, ready for the next page."""
+    driver.delete_all_cookies()
+    try:
+        driver.execute_script('window.localStorage.clear(); window.sessionStorage.clear();')
+    except Exception:
+        # about:blank and some error pages do not expose any storage
+        pass
+
+    # Open a fresh tab and close every other one, so nothing from the previous page keeps running
+    old_handles = driver.window_handles
+    driver.switch_to.new_window('tab')
+    new_handle = driver.current_window_handle
+    for handle in old_handles:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(new_handle)
+    if getattr(driver, 'blocked_urls', None):
+        block_urls(driver, driver.blocked_urls)
+
+class DriverPool:
+    """This class keeps a bounded number of warm browsers that Scraper objects can borrow instead of
+    starting and quitting Chrome for every URL.
+
+    Every browser gets its own temporary profile directory. A browser is reset between pages and
+    recycled (quit and replaced) after max_pages pages or when it is returned as broken. The browsers
+    are started with the given browser profile, unless a driver_factory is given.
+    """
+
+    def __init__(self, size=1, max_pages=20, driver_factory=None, profile='default'):
+        self.size = size
+        self.max_pages = max_pages
+        self.driver_factory = driver_factory or partial(create_driver, profile=profile)
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._profiles = {}
+        self._closed = False
+        logger.info('A driver pool was instantiated with size %d and max %d pages per browser (profile: %s).',
+                    size, max_pages, profile)
+
+    def acquire(self, timeout=None):
+        """Borrows a browser from the pool, starting a new one if no warm browser is idle."""
+        if self._closed:
+            raise RuntimeError('The driver pool is closed.')
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError('No browser became available in the driver pool.')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._start_driver()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, driver, broken=False) -> None:
+        """Returns a borrowed browser. Broken or worn out browsers are quit instead of reused."""
+        try:
+            with self._lock:
+                self._pages[id(driver)] = self._pages.get(id(driver), 0) + 1
+                pages = self._pages[id(driver)]
+            if broken or self._closed or pages >= self.max_pages:
+                logger.info('Recycling browser after %d pages (broken: %s).', pages, broken)
+                self._quit_driver(driver)
+                return
+            try:
+                reset_driver(driver)
+            except Exception as e:
+                logger.error('%s: Failed to reset browser, recycling it.', e)
+                self._quit_driver(driver)
+                return
+            self._idle.put(driver)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """Quits every idle browser. Browsers still borrowed are quit when they are returned."""
+        self._closed = True
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit_driver(driver)
+        logger.info('Driver pool closed.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start_driver(self):
+        profile_dir = tempfile.mkdtemp(prefix='temp_chrome_user_data_')
+        try:
+            driver = self.driver_factory(profile_dir)
+        except Exception:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            raise
+        with self._lock:
+            self._pages[id(driver)] = 0
+            self._profiles[id(driver)] = profile_dir
+        logger.info('Started a new pooled browser.')
+        return driver
+
+    def _quit_driver(self, driver) -> None:
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error('%s: Failed to quit browser.', e)
+        with self._lock:
+            self._pages.pop(id(driver), None)
+            profile_dir = self._profiles.pop(id(driver), None)
+        if profile_dir:
+            shutil.rmtree(profile_dir, ignore_errors=True)
@@ -0,0 +1,135 @@
+"""Module providing the extraction backends that turn the HTML of an offer page into offer records.
+
+All CSS class names and meta tags the scraper depends on are kept in the selector tables below,
+so that a redesign of 'ereklamblad.se' only requires the tables to be updated.
+"""
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+# The element wrapping every offer in the offer list
+OFFER_ITEM_SELECTOR = {'tag': 'li', 'class': 'OfferList__OfferListItem-sc-bj82vg-1'}
+
+# One entry per field in the offer record. Elements are matched on tag and either class or itemprop.
+# Fields with 'attr' read that attribute, the others read the text of the element.
+FIELD_SELECTORS = {
+    'Name': {'tag': 'header', 'class': 'OfferList___StyledHeader-sc-bj82vg-11'},
+    'Price': {'tag': 'span', 'class': 'OfferList___StyledSpan2-sc-bj82vg-14'},
+    'Details': {'tag': 'div', 'class': 'OfferList__OfferPcs-sc-bj82vg-7'},
+    'Store': {'tag': 'meta', 'itemprop': 'name', 'attr': 'content'},
+    'ValidFrom': {'tag': 'meta', 'itemprop': 'validFrom', 'attr': 'content'},
+    'ValidThrough': {'tag': 'meta', 'itemprop': 'validThrough', 'attr': 'content'},
+    'ValidUntil': {'tag': 'meta', 'itemprop': 'priceValidUntil', 'attr': 'content'},
+}
+
+def best_parser() -> str:
+    """Returns 'lxml' if it is installed, since it is a lot faster than the built-in 'html.parser'."""
+    try:
+        import lxml  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+class SoupExtractor:
+    """This class parses the whole page with 'html.parser' and runs one find() per field and offer.
+    It is the original extraction approach and is kept as a reference for the faster backend.
+    """
+
+    name = 'soup'
+
+    def __init__(self, item_selector=OFFER_ITEM_SELECTOR, field_selectors=FIELD_SELECTORS):
+        self.item_selector = item_selector
+        self.field_selectors = field_selectors
+
+    def find_offers(self, html: str) -> list:
+        """Returns the offer list items found in the page."""
+        soup = BeautifulSoup(html, 'html.parser')
+        return soup.find_all(self.item_selector['tag'], class_=self.item_selector['class'])
+
+    def extract_offer(self, offer) -> dict:
+        """Returns the record for one offer. Raises ValueError if a field or the attribute it reads is missing."""
+        record = {}
+        for field, selector in self.field_selectors.items():
+            if 'class' in selector:
+                element = offer.find(selector['tag'], class_=selector['class'])
+            else:
+                element = offer.find(selector['tag'], itemprop=selector['itemprop'])
+            if element is None:
+                raise ValueError(f'Missing field {field}.')
+            if 'attr' not in selector:
+                record[field] = element.get_text(strip=True)
+            elif element.has_attr(selector['attr']):
+                record[field] = element[selector['attr']]
+            else:
+                raise ValueError(f'Missing attribute {selector["attr"]} of field {field}.')
+        return record
+
+class FastExtractor(SoupExtractor):
+    """This class only builds a tree for the offer list items (using a SoupStrainer and lxml when it is
+    installed) and fills all fields of an offer in a single walk over its elements.
+    """
+
+    name = 'fast'
+
+    def __init__(self, item_selector=OFFER_ITEM_SELECTOR, field_selectors=FIELD_SELECTORS, parser=None):
+        super().__init__(item_selector, field_selectors)
+        self.parser = parser or best_parser()
+        # While parsing, the strainer sees the raw class attribute, so it is split on whitespace here
+        item_class = item_selector['class']
+        self.strainer = SoupStrainer(item_selector['tag'], 
+                                     class_=lambda value: value is not None and item_class in value.split())
+        # Precompile the selector table into a lookup on tag name, so every element is checked once
+        self.by_tag = {}
+        for field, selector in field_selectors.items():
+            if 'class' in selector:
+                matcher = ('class', selector['class'])
+            else:
+                matcher = ('itemprop', selector['itemprop'])
+            self.by_tag.setdefault(selector['tag'], []).append((field, matcher, selector.get('attr')))
+
+    def find_offers(self, html: str) -> list:
+        """Returns the offer list items found in the page."""
+        soup = BeautifulSoup(html, self.parser, parse_only=self.strainer)
+        # Only offer items are left in the tree, so its top-level tags are the offers
+        return [element for element in soup.contents if element.name == self.item_selector['tag']]
+
+    def extract_offer(self, offer) -> dict:
+        """Returns the record for one offer. Raises ValueError if a field or the attribute it reads is missing."""
+        record = {}
+        by_tag = self.by_tag
+        for element in offer.descendants:
+            candidates = by_tag.get(element.name)
+            if candidates is None:
+                continue
+            attrs = element.attrs
+            for field, (kind, value), attr in candidates:
+                if field in record:
+                    continue
+                if kind == 'class':
+                    matched = value in (attrs.get('class') or ())
+                else:
+                    matched = attrs.get('itemprop') == value
+                if not matched:
+                    continue
+                if attr is None:
+                    record[field] = element.get_text(strip=True)
+                elif attr in attrs:
+                    record[field] = attrs[attr]
+                else:
+                    raise ValueError(f'Missing attribute {attr} of field {field}.')
+        if len(record) < len(self.field_selectors):
+            missing = [field for field in self.field_selectors if field not in record]
+            raise ValueError(f'Missing field(s) {", ".join(missing)}.')
+        # Keep the column order of the selector table
+        return {field: record[field] for field in self.field_selectors}
+
+EXTRACTORS = {
+    SoupExtractor.name: SoupExtractor,
+    FastExtractor.name: FastExtractor,
+}
+
+def get_extractor(name='fast'):
+    """Returns an instance of the extraction backend with the given name."""
+    try:
+        return EXTRACTORS[name]()
+    except KeyError:
+        raise ValueError(f'Unknown extractor {name!r}, choose one of {", ".join(EXTRACTORS)}.') from None
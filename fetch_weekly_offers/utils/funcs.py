@@ -1,39 +1,226 @@
-"""This module provides functions for logging and saving data to SQL."""
+"""This module provides functions for logging, writing files safely and saving data to SQL."""
 
 import logging
+import os
+import tempfile
+import uuid
 import pandas as pd
-from sqlalchemy import create_engine
 
-# Function to configure logging 
+# Function to configure logging
 def set_up_logging():
-    logging.basicConfig(filename='logging.log', 
-                        level=logging.INFO, 
-                        filemode='a', 
+    logging.basicConfig(filename='logging.log',
+                        level=logging.INFO,
+                        filemode='a',
                         format='[%(asctime)s][%(name)s] - %(levelname)s - %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
-    
+
 logger = logging.getLogger()
 
+# The database URL can be overridden with this environment variable, e.g. 'sqlite:///offers.db' for local testing
+DB_URL_ENV_VAR = 'WEEKLY_OFFERS_DB_URL'
+
+# Columns that identify an offer between runs, used to merge new data into the existing table. A store often 
+# lists several offers under one name in the same week (e.g. two 'Airfryer' at 799 and 999 kr), the cleaner 
+# numbers them in the Variant column. The price is not part of the key, so a new price updates the offer.
+NATURAL_KEY = ['Store', 'Name', 'ValidFrom', 'Variant']
+
+# Column with the time a row was last inserted or updated, so that readers can load only the rows saved since
+# they last read the table (see offers_index). It is not compared when looking for changed rows.
+LOADED_AT = 'LoadedAt'
+
+def write_atomic(path: str, write, mode='w', opener=open) -> None:
+    """Calls write with the file opened in mode, writing to a temporary file that then replaces the file at
+    path, so an interrupted run never leaves a truncated file behind. Text is written as UTF-8.
+    Every call gets its own temporary file next to path, which is removed again if writing fails.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=f'{name}.', suffix='.tmp', delete=False) as temp:
+        temp_path = temp.name
+    try:
+        options = {} if 'b' in mode else {'encoding': 'utf-8'}
+        # Reopened with the opener, so that e.g. gzip.open can wrap the temporary file
+        with opener(temp_path, mode, **options) as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def get_db_url(db_url=None, db_name='WeeklyOffers', server='MSI') -> str:
+    """Returns the database URL to use: the given URL, the URL in the environment variable or the MSSQL default."""
+    if db_url:
+        return db_url
+    return os.environ.get(DB_URL_ENV_VAR) or \
+        f'mssql+pyodbc://{server}/{db_name}?driver=ODBC+Driver+17+for+SQL+Server&trusted_connection=yes'
+
+def create_db_engine(db_url: str):
+    """Creates a SQLAlchemy engine, with fast executemany switched on for pyodbc."""
+    # SQLAlchemy is imported where it is used, so that commands that never touch the database start faster
+    from sqlalchemy import create_engine
+    if db_url.startswith('mssql+pyodbc'):
+        return create_engine(db_url, fast_executemany=True)
+    return create_engine(db_url)
+
+# Length of the text key columns. pandas creates text columns as NVARCHAR(max) on MSSQL, which can not be indexed.
+KEY_TEXT_LENGTH = 255
+
+def _sql_types(df: pd.DataFrame, key=()) -> dict:
+    """Returns SQL column types for to_sql: datetime columns that only hold dates (like the validity 
+    dates of the cleaned offers) are saved as DATE, as the date objects they replaced were. Text columns
+    in key get a bounded length, so that the key can be indexed.
+    """
+    from sqlalchemy import Date, Unicode
+    types = {}
+    for column in df.columns:
+        if column in key and not pd.api.types.is_numeric_dtype(df[column]) \
+                and not pd.api.types.is_datetime64_dtype(df[column]):
+            types[column] = Unicode(KEY_TEXT_LENGTH)
+        elif pd.api.types.is_datetime64_dtype(df[column]):
+            dates = df[column].dropna()
+            if (dates == dates.dt.normalize()).all():
+                types[column] = Date()
+    return types
+
 # Function to save scraped and cleaned data to SQL database "WeeklyOffers"
-def save_to_sql(df: pd.DataFrame, db_name='WeeklyOffers', table_name='offers', server='MSI') -> None:
-    """Saves the cleaned DataFrame to a MSSQL database."""
+def save_to_sql(df: pd.DataFrame, db_name='WeeklyOffers', table_name='offers', server='MSI',
+                db_url=None, mode='replace', key=NATURAL_KEY, chunksize=1000) -> bool:
+    """Saves the cleaned DataFrame to a SQL database (MSSQL unless another db_url is given).
+
+    mode='replace' drops and rewrites the whole table. mode='upsert' keeps the table and only inserts
+    new offers and updates changed ones, matching rows on the columns in key. The saved rows are
+    stamped with the time in the LoadedAt column. Returns True if the data was saved, failures are logged.
+    """
     try:
-        engine = create_engine('mssql+pyodbc://MSI/WeeklyOffers?driver=ODBC+Driver+17+for+SQL+Server&trusted_connection=yes')
+        engine = create_db_engine(get_db_url(db_url, db_name, server))
         logger.info('Connection to database was successful.')
-    except Exception as e: 
+    except Exception as e:
         logger.critical('Critical: %s. Could not connect to database.', e)
-        return
-    
+        return False
+
+    # Imported here, since the metrics module depends on this module for logging
+    from .metrics import metrics
+
     try:
-        df.to_sql(table_name, con=engine, if_exists='replace', index=False)
-        logger.info('Data saved to %s in %s successfully.', db_name, table_name)
-        print('Data was successfully saved to WeeklyOffers db.')
-    except Exception as e: 
+        with metrics.stage('save_to_sql', mode=mode, rows=len(df)):
+            df = df.assign(**{LOADED_AT: pd.Timestamp.now()})
+            if mode == 'upsert':
+                upsert_to_sql(df, engine, table_name, key=key, chunksize=chunksize)
+            else:
+                df.to_sql(table_name, con=engine, if_exists='replace', index=False, chunksize=chunksize, 
+                          dtype=_sql_types(df, key))
+            _create_key_index(engine, table_name, [LOADED_AT], name='loaded_at')
+        logger.info('Data saved to %s in %s successfully.', engine.url.database, table_name)
+        return True
+    except Exception as e:
         logger.error('%s: Failed to save data to database.', e)
-        
-        
-    
+        return False
+
+def _differs(quote, left: str, right: str, column: str) -> str:
+    """Returns a SQL condition that is true when a column differs between two tables, NULLs included."""
+    left_col = f'{left}.{quote(column)}'
+    right_col = f'{right}.{quote(column)}'
+    return (f'({left_col} <> {right_col} OR ({left_col} IS NULL AND {right_col} IS NOT NULL) '
+            f'OR ({left_col} IS NOT NULL AND {right_col} IS NULL))')
+
+def _create_key_index(engine, table_name: str, key, name='key') -> None:
+    """Creates an index on the key columns unless the table already has one, so that matching rows 
+    in the merge (or finding the rows loaded since a time) is an index lookup instead of a scan of the whole table.
+    """
+    from sqlalchemy import inspect, text
+    index_name = f'ix_{table_name}_{name}'
+    try:
+        if any(index['name'] == index_name for index in inspect(engine).get_indexes(table_name)):
+            return
+        quote = engine.dialect.identifier_preparer.quote
+        columns = ', '.join(quote(column) for column in key)
+        with engine.begin() as connection:
+            connection.execute(text(f'CREATE INDEX {quote(index_name)} ON {quote(table_name)} ({columns})'))
+    except Exception as e:
+        # E.g. MSSQL can not index NVARCHAR(max) columns, the merge still works without the index
+        logger.warning('%s: Could not create index %s, merging without it.', e, index_name)
+
+def upsert_to_sql(df: pd.DataFrame, engine, table_name: str, key=NATURAL_KEY, chunksize=1000) -> tuple:
+    """Merges the DataFrame into the table: rows whose key is not in the table are inserted and rows
+    whose values have changed are updated. All other rows in the table are left untouched.
+
+    The data is first bulk loaded into a staging table and then merged with two set based statements,
+    so the work done grows with the size of the new data and not with the history in the table.
+    Rows with a missing key value are skipped. Returns the number of inserted and updated rows.
+    """
+    from sqlalchemy import inspect, text
+    missing_key = [column for column in key if column not in df.columns]
+    if missing_key:
+        raise ValueError(f'Key column(s) {", ".join(missing_key)} missing from the data.')
+
+    # Rows without a complete key can not be matched against the table
+    incomplete = df[key].isna().any(axis=1)
+    if incomplete.any():
+        logger.warning('%d rows without a complete key (%s) were not saved.', int(incomplete.sum()), ', '.join(key))
+        df = df[~incomplete]
+
+    # Identical rows are stored once. Different rows that share a key are all kept, see the UPDATE below
+    df = df.drop_duplicates()
+    shared = df.duplicated(subset=key, keep=False)
+    if shared.any():
+        logger.warning('%d rows share their key (%s) with another row, they are inserted but never updated.', 
+                       int(shared.sum()), ', '.join(key))
+
+    if not inspect(engine).has_table(table_name):
+        df.to_sql(table_name, con=engine, index=False, chunksize=chunksize, dtype=_sql_types(df, key))
+        logger.info('Table %s created with %d rows.', table_name, len(df))
+        _create_key_index(engine, table_name, key)
+        return len(df), 0
+    _create_key_index(engine, table_name, key)
+
+    # A unique staging table per call, so that concurrent writers do not overwrite each other's staging data
+    staging_name = f'{table_name}_staging_{uuid.uuid4().hex[:8]}'
+    df.to_sql(staging_name, con=engine, if_exists='replace', index=False, chunksize=chunksize, 
+              dtype=_sql_types(df, key))
+    _create_key_index(engine, staging_name, key)
+
+    quote = engine.dialect.identifier_preparer.quote
+    target, staging = quote(table_name), quote(staging_name)
+
+    try:
+        with engine.begin() as connection:
+            # Columns added to the cleaned data since the table was created are added to the table as well
+            existing_columns = {column['name'] for column in inspect(connection).get_columns(table_name)}
+            for column in inspect(connection).get_columns(staging_name):
+                if column['name'] not in existing_columns:
+                    column_type = column['type'].compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {target} ADD {quote(column["name"])} {column_type}'))
+                    logger.info('Column %s added to table %s.', column['name'], table_name)
+
+            columns = list(df.columns)
+            value_columns = [column for column in columns if column not in key]
+            match = ' AND '.join(f's.{quote(column)} = {target}.{quote(column)}' for column in key)
 
+            # A row is only updated when its values changed, a new load time alone is no change
+            compared_columns = [column for column in value_columns if column != LOADED_AT]
+            updated = 0
+            if compared_columns:
+                changed = ' OR '.join(_differs(quote, 's', target, column) for column in compared_columns)
+                assignments = ', '.join(
+                    f'{quote(column)} = (SELECT s.{quote(column)} FROM {staging} s WHERE {match})'
+                    for column in value_columns)
+                # Only keys with a single row in the new data and in the table are updated, the others would 
+                # have no single value to take or would overwrite several offers with the same values
+                same_key = ' AND '.join(f't.{quote(column)} = {target}.{quote(column)}' for column in key)
+                result = connection.execute(text(
+                    f'UPDATE {target} SET {assignments} '
+                    f'WHERE EXISTS (SELECT 1 FROM {staging} s WHERE {match} AND ({changed})) '
+                    f'AND (SELECT COUNT(*) FROM {staging} s WHERE {match}) = 1 '
+                    f'AND (SELECT COUNT(*) FROM {target} t WHERE {same_key}) = 1'))
+                updated = result.rowcount
 
+            column_list = ', '.join(quote(column) for column in columns)
+            result = connection.execute(text(
+                f'INSERT INTO {target} ({column_list}) '
+                f'SELECT {column_list} FROM {staging} s WHERE NOT EXISTS (SELECT 1 FROM {target} WHERE {match})'))
+            inserted = result.rowcount
+    finally:
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS {staging}'))
 
-        
\ No newline at end of file
+    logger.info('Upsert into %s: %d rows inserted, %d rows updated.', table_name, inserted, updated)
+    return inserted, updated
@@ -0,0 +1,171 @@
+"""Module providing a browserless way to fetch the offers, with plain pooled HTTP requests.
+
+The fields the scraper reads are schema.org Offer data. When the server response already contains it,
+either as the microdata read by the extractor backends or as JSON-LD script blocks, there is no need for
+a headless browser. The Scraper uses this module in fetch_mode 'http' or 'auto' (see Scraper.fetch_page).
+The offer pages load more offers while scrolling, so a server response can hold only the first batch:
+it only counts as complete when it says how many offers the list has (see listed_offer_count).
+"""
+
+import json
+import re
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .funcs import set_up_logging, logger
+
+# Set up logging
+set_up_logging()
+
+# The site serves the full page to regular browsers only, so the requests present themselves as one
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/128.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'sv-SE,sv;q=0.9,en;q=0.8',
+}
+
+class HttpFetcher:
+    """This class wraps a requests Session with a connection pool and retries, shared by all scrapers of a run."""
+
+    def __init__(self, timeout=15, pool_size=10, retries=2, headers=DEFAULT_HEADERS):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url: str) -> str:
+        """Returns the HTML of the page. Raises requests.RequestException on failure."""
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        # Fall back on the detected encoding, the site does not always send a charset
+        if response.encoding is None or response.encoding.lower() == 'iso-8859-1':
+            response.encoding = response.apparent_encoding
+        return response.text
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _text(value) -> str:
+    return '' if value is None else str(value)
+
+def _find_offers(data) -> list:
+    """Walks parsed JSON-LD and returns every object typed as a schema.org Offer. An offer listed under 
+    a Product gets that product as its itemOffered, so its name can be read the same way.
+    """
+    offers = []
+    stack = [(data, None)]
+    while stack:
+        item, product = stack.pop()
+        if isinstance(item, list):
+            stack.extend((child, product) for child in reversed(item))
+        elif isinstance(item, dict):
+            types = item.get('@type')
+            types = types if isinstance(types, list) else [types]
+            if 'Offer' in types:
+                offers.append(item if 'itemOffered' in item or product is None else {**item, 'itemOffered': product})
+                continue
+            if 'Product' in types:
+                product = item
+            stack.extend((child, product) for child in reversed(list(item.values())))
+    return offers
+
+def _find_list_sizes(data) -> list:
+    """Walks parsed JSON-LD and returns the numberOfItems of every object typed as a schema.org ItemList."""
+    sizes = []
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(item)
+        elif isinstance(item, dict):
+            types = item.get('@type')
+            types = types if isinstance(types, list) else [types]
+            if 'ItemList' in types and item.get('numberOfItems') is not None:
+                sizes.append(item['numberOfItems'])
+            stack.extend(item.values())
+    return sizes
+
+# Microdata element carrying the size of an ItemList, e.g. <meta itemprop="numberOfItems" content="167">
+NUMBER_OF_ITEMS_RE = re.compile(r'<[^>]*itemprop=["\']numberOfItems["\'][^>]*>', re.IGNORECASE)
+CONTENT_RE = re.compile(r'content=["\'](\d+)["\']')
+
+def listed_offer_count(html: str):
+    """Returns the number of offers the page says its offer list holds, the schema.org ItemList
+    numberOfItems in its JSON-LD or microdata, or None if the page does not say.
+    """
+    sizes = []
+    soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer('script', type='application/ld+json'))
+    for script in soup.find_all('script'):
+        try:
+            sizes.extend(_find_list_sizes(json.loads(script.string or '')))
+        except ValueError:
+            # Already reported by JsonLdExtractor.find_offers
+            pass
+    for element in NUMBER_OF_ITEMS_RE.findall(html):
+        content = CONTENT_RE.search(element)
+        if content:
+            sizes.append(content.group(1))
+    try:
+        return sum(int(size) for size in sizes) if sizes else None
+    except (TypeError, ValueError):
+        return None
+
+class JsonLdExtractor:
+    """This class is an extraction backend for pages that carry their offers as JSON-LD instead of markup.
+    It maps every schema.org Offer to the same record shape as the other backends in the extractor module.
+    """
+
+    name = 'jsonld'
+
+    def find_offers(self, html: str) -> list:
+        """Returns the Offer objects of all JSON-LD script blocks in the page."""
+        soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer('script', type='application/ld+json'))
+        offers = []
+        for script in soup.find_all('script'):
+            try:
+                offers.extend(_find_offers(json.loads(script.string or '')))
+            except ValueError as e:
+                logger.error('%s: Could not parse a JSON-LD block.', e)
+        return offers
+
+    def extract_offer(self, offer: dict) -> dict:
+        """Returns the record for one offer. Raises ValueError if it has no name or price."""
+        item = offer.get('itemOffered') or {}
+        name = item.get('name') or offer.get('name')
+        price = offer.get('price')
+        if price is None:
+            price = (offer.get('priceSpecification') or {}).get('price')
+        if not name or price is None:
+            raise ValueError('Missing field(s) Name or Price.')
+
+        # The details are written like on the page: quantity and comparison price separated by a bullet
+        quantity = offer.get('eligibleQuantity') or {}
+        quantity_text = ' '.join(_text(quantity.get(key)) for key in ('value', 'unitText') if quantity.get(key))
+        unit_price = offer.get('priceSpecification') or {}
+        comparison_text = ''
+        if unit_price.get('referenceQuantity') and unit_price.get('price') is not None:
+            reference = unit_price['referenceQuantity']
+            comparison_text = f'{_text(unit_price["price"]).replace(".", ",")} kr/{_text(reference.get("unitText"))}'
+        details = f'{quantity_text}•{comparison_text}' if comparison_text else quantity_text
+
+        seller = offer.get('seller') or offer.get('offeredBy') or {}
+        return {
+            'Name': _text(name),
+            'Price': f'{_text(price).replace(".", ",")} kr',
+            'Details': details,
+            'Store': _text(seller.get('name') if isinstance(seller, dict) else seller),
+            'ValidFrom': _text(offer.get('validFrom')),
+            'ValidThrough': _text(offer.get('validThrough')),
+            'ValidUntil': _text(offer.get('priceValidUntil')),
+        }
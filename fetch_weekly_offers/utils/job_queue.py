@@ -0,0 +1,318 @@
+"""Module providing a durable job queue, so that the stores of a run can be scraped by workers on several hosts.
+
+The queue is a table in any database SQLAlchemy can reach: a SQLite file for local runs, or e.g. the MSSQL
+server for workers on several machines. A coordinator enqueues one job per store URL and waits for them:
+
+    queue = JobQueue('sqlite:///job_queue.db')
+    run_id = queue.enqueue(urls)
+
+Workers (run_worker) claim a job, scrape and clean it with the Scraper and the DataCleaner, and hand the
+cleaned offers back through the queue. A claimed job is leased for a number of seconds and the worker
+renews the lease with heartbeats while it works. If a worker crashes the lease runs out and the job is
+handed to the next worker that asks. The coordinator (coordinate) collects the results of all jobs,
+saves them with a single save_to_sql merge and then removes them from the queue. Results are stored as
+JSON, never as pickles, so that writing to the queue table does not allow running code on the coordinator.
+
+Claims are made with a conditional UPDATE that only succeeds while the job is still free, so two workers
+can never hold the same job, whatever the database. Lease times use the clocks of the workers, so the
+hosts should keep their clocks in sync (lease times are in minutes, not milliseconds).
+"""
+
+import io
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+import pandas as pd
+from sqlalchemy import (Column, Float, Integer, LargeBinary, MetaData, String, Table, Text, UniqueConstraint,
+                        and_, create_engine, func, or_, select, update)
+from .cleaner import cast_offers, concat_offers
+from .funcs import set_up_logging, logger
+from .metrics import metrics
+
+# Set up logging
+set_up_logging()
+
+QUEUE_URL = 'sqlite:///job_queue.db'
+
+# Seconds a claimed job stays with its worker without a heartbeat
+LEASE_SECONDS = 120
+
+# Number of times a job is handed out before it is given up on
+MAX_ATTEMPTS = 3
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+class JobQueue:
+    """This class keeps the jobs of every run in the table 'scrape_jobs' of the database at queue_url."""
+
+    def __init__(self, queue_url=QUEUE_URL, max_attempts=MAX_ATTEMPTS):
+        self.queue_url = queue_url
+        self.max_attempts = max_attempts
+        if queue_url.startswith('sqlite'):
+            # Wait for the other processes' writes instead of failing with 'database is locked'
+            self.engine = create_engine(queue_url, connect_args={'timeout': 30})
+        else:
+            from .funcs import create_db_engine
+            self.engine = create_db_engine(queue_url)
+        metadata = MetaData()
+        self.jobs = Table(
+            'scrape_jobs', metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('run_id', String(32), nullable=False, index=True),
+            Column('url', String(512), nullable=False),
+            Column('status', String(16), nullable=False, index=True),
+            Column('attempts', Integer, nullable=False, default=0),
+            Column('worker', String(128)),
+            Column('lease_until', Float),
+            Column('rows', Integer),
+            Column('error', Text),
+            Column('result', LargeBinary),
+            Column('created_at', Float),
+            Column('finished_at', Float),
+            UniqueConstraint('run_id', 'url'),
+        )
+        metadata.create_all(self.engine)
+
+    def _claimable(self, now: float):
+        """The condition for a job that may be claimed: pending, or running with a lease that ran out."""
+        return or_(self.jobs.c.status == PENDING,
+                   and_(self.jobs.c.status == RUNNING, self.jobs.c.lease_until < now,
+                        self.jobs.c.attempts < self.max_attempts))
+
+    def enqueue(self, urls: list, run_id=None) -> str:
+        """Adds one job per URL to the run (a new run by default) and returns the run ID.
+        URLs that already have a job in the run are not added again.
+        """
+        run_id = run_id or datetime.now().strftime('%Y%m%dT%H%M%S')
+        with self.engine.begin() as connection:
+            existing = set(connection.execute(select(self.jobs.c.url).where(self.jobs.c.run_id == run_id)).scalars())
+            new_jobs = [{'run_id': run_id, 'url': url, 'status': PENDING, 'attempts': 0, 'created_at': time.time()}
+                        for url in dict.fromkeys(urls) if url not in existing]
+            if new_jobs:
+                connection.execute(self.jobs.insert(), new_jobs)
+        logger.info('%d jobs enqueued for run %s.', len(new_jobs), run_id)
+        return run_id
+
+    def claim(self, worker_id: str, lease=LEASE_SECONDS, run_id=None):
+        """Claims the oldest free job for the worker and returns it as a dict, or None if there is none."""
+        self.expire()
+        while True:
+            now = time.time()
+            query = select(self.jobs.c.id).where(self._claimable(now))
+            if run_id is not None:
+                query = query.where(self.jobs.c.run_id == run_id)
+            with self.engine.connect() as connection:
+                candidates = list(connection.execute(query.order_by(self.jobs.c.id).limit(5)).scalars())
+            if not candidates:
+                return None
+            for job_id in candidates:
+                with self.engine.begin() as connection:
+                    # Only succeeds if no other worker claimed the job in the meantime
+                    result = connection.execute(
+                        update(self.jobs)
+                        .where(self.jobs.c.id == job_id, self._claimable(now))
+                        .values(status=RUNNING, worker=worker_id, lease_until=now + lease,
+                                attempts=self.jobs.c.attempts + 1))
+                    if result.rowcount == 1:
+                        job = connection.execute(
+                            select(self.jobs.c.id, self.jobs.c.run_id, self.jobs.c.url, self.jobs.c.attempts)
+                            .where(self.jobs.c.id == job_id)).mappings().one()
+                        logger.info('Worker %s claimed job %d (attempt %d): %s',
+                                    worker_id, job_id, job['attempts'], job['url'])
+                        return dict(job)
+
+    def heartbeat(self, job_id: int, worker_id: str, lease=LEASE_SECONDS) -> bool:
+        """Renews the lease of a job. Returns False if the worker no longer holds the job."""
+        with self.engine.begin() as connection:
+            result = connection.execute(
+                update(self.jobs)
+                .where(self.jobs.c.id == job_id, self.jobs.c.worker == worker_id, self.jobs.c.status == RUNNING)
+                .values(lease_until=time.time() + lease))
+            return result.rowcount == 1
+
+    def complete(self, job_id: int, worker_id: str, df: pd.DataFrame) -> bool:
+        """Hands in the cleaned offers of a job. Returns False if the worker no longer held the job."""
+        with self.engine.begin() as connection:
+            result = connection.execute(
+                update(self.jobs)
+                .where(self.jobs.c.id == job_id, self.jobs.c.worker == worker_id, self.jobs.c.status == RUNNING)
+                .values(status=DONE, rows=len(df), result=_dump_offers(df), error=None, finished_at=time.time()))
+            return result.rowcount == 1
+
+    def fail(self, job_id: int, worker_id: str, error) -> None:
+        """Returns a failed job to the queue, or gives up on it after max_attempts attempts."""
+        with self.engine.begin() as connection:
+            attempts = connection.execute(select(self.jobs.c.attempts).where(self.jobs.c.id == job_id)).scalar_one()
+            status = FAILED if attempts >= self.max_attempts else PENDING
+            connection.execute(
+                update(self.jobs)
+                .where(self.jobs.c.id == job_id, self.jobs.c.worker == worker_id, self.jobs.c.status == RUNNING)
+                .values(status=status, error=str(error), lease_until=None,
+                        finished_at=time.time() if status == FAILED else None))
+
+    def expire(self) -> None:
+        """Gives up on running jobs whose lease ran out on their last attempt."""
+        with self.engine.begin() as connection:
+            result = connection.execute(
+                update(self.jobs)
+                .where(self.jobs.c.status == RUNNING, self.jobs.c.lease_until < time.time(),
+                       self.jobs.c.attempts >= self.max_attempts)
+                .values(status=FAILED, error='The lease ran out on the last attempt.', finished_at=time.time()))
+            if result.rowcount:
+                logger.error('%d jobs failed after their lease ran out %d times.', result.rowcount, self.max_attempts)
+
+    def counts(self, run_id=None) -> dict:
+        """Returns the number of jobs per status, for one run or for all runs."""
+        query = select(self.jobs.c.status, func.count()).group_by(self.jobs.c.status)
+        if run_id is not None:
+            query = query.where(self.jobs.c.run_id == run_id)
+        with self.engine.connect() as connection:
+            counts = dict(connection.execute(query).all())
+        return {status: counts.get(status, 0) for status in (PENDING, RUNNING, DONE, FAILED)}
+
+    def results(self, run_id: str) -> dict:
+        """Returns the cleaned offers of every finished job of the run, by URL."""
+        query = (select(self.jobs.c.url, self.jobs.c.result)
+                 .where(self.jobs.c.run_id == run_id, self.jobs.c.status == DONE).order_by(self.jobs.c.id))
+        with self.engine.connect() as connection:
+            return {url: _load_offers(result) for url, result in connection.execute(query) if result is not None}
+
+    def discard_results(self, run_id: str) -> None:
+        """Removes the cleaned offers of the run from the queue, once they have been saved."""
+        with self.engine.begin() as connection:
+            connection.execute(update(self.jobs).where(self.jobs.c.run_id == run_id).values(result=None))
+
+    def failures(self, run_id: str) -> dict:
+        """Returns the error of every failed job of the run, by URL."""
+        query = select(self.jobs.c.url, self.jobs.c.error).where(self.jobs.c.run_id == run_id,
+                                                                  self.jobs.c.status == FAILED)
+        with self.engine.connect() as connection:
+            return dict(connection.execute(query).all())
+
+def _dump_offers(df: pd.DataFrame) -> bytes:
+    """Serializes cleaned offers as JSON records, with enough digits to keep every price exact."""
+    return df.to_json(orient='records', date_format='iso', double_precision=15).encode('utf-8')
+
+def _load_offers(data: bytes) -> pd.DataFrame:
+    """Reads offers serialized by _dump_offers and casts them back to the offer schema."""
+    df = pd.read_json(io.StringIO(data.decode('utf-8')), orient='records', dtype=False, convert_dates=False)
+    return cast_offers(df)
+
+class _Heartbeat(threading.Thread):
+    """Renews the lease of a job every interval seconds until it is stopped."""
+
+    def __init__(self, queue, job_id, worker_id, lease, interval):
+        super().__init__(daemon=True)
+        self.queue, self.job_id, self.worker_id = queue, job_id, worker_id
+        self.lease, self.interval = lease, interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.job_id, self.worker_id, self.lease):
+                    self.lost = True
+                    logger.error('Worker %s lost the lease of job %d.', self.worker_id, self.job_id)
+                    return
+            except Exception as e:
+                logger.error('%s: Heartbeat of job %d failed.', e, self.job_id)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def run_worker(queue_url=QUEUE_URL, worker_id=None, process=None, lease=LEASE_SECONDS, heartbeat_interval=None,
+               poll_interval=5.0, max_idle=0.0, run_id=None, fetch_mode='browser', timeout=None,
+               browser_profile='default') -> int:
+    """Claims and processes jobs until the queue has been empty for max_idle seconds, and returns the
+    number of jobs done. By default a job is scraped and cleaned with process_url in one warm browser;
+    a different process(url) -> DataFrame can be given, e.g. for tests.
+    """
+    worker_id = worker_id or default_worker_id()
+    heartbeat_interval = heartbeat_interval or lease / 3
+    queue = JobQueue(queue_url)
+    if process is None:
+        from functools import partial
+        from .http_fetch import HttpFetcher
+        from ..run_weekly import open_driver_pool, process_url
+        with open_driver_pool(fetch_mode, size=1, profile=browser_profile) as pool, HttpFetcher(pool_size=1) as fetcher:
+            return run_worker(queue_url, worker_id=worker_id, lease=lease, heartbeat_interval=heartbeat_interval,
+                              poll_interval=poll_interval, max_idle=max_idle, run_id=run_id,
+                              process=partial(process_url, pool=pool, fetch_mode=fetch_mode, fetcher=fetcher,
+                                              timeout=timeout))
+
+    logger.info('Worker %s started on %s.', worker_id, queue_url)
+    done = 0
+    idle_since = time.monotonic()
+    while True:
+        job = queue.claim(worker_id, lease=lease, run_id=run_id)
+        if job is None:
+            if time.monotonic() - idle_since >= max_idle:
+                logger.info('Worker %s found no more jobs after %d done, stopping.', worker_id, done)
+                return done
+            time.sleep(poll_interval)
+            continue
+
+        heartbeat = _Heartbeat(queue, job['id'], worker_id, lease, heartbeat_interval)
+        heartbeat.start()
+        try:
+            with metrics.stage('worker.job', url=job['url'], attempt=job['attempts']) as stage:
+                cleaned_data = process(job['url'])
+                stage.set(rows=len(cleaned_data))
+        except Exception as e:
+            heartbeat.stop()
+            logger.error('%s: Job %d failed for URL: %s.', e, job['id'], job['url'])
+            queue.fail(job['id'], worker_id, e)
+        else:
+            heartbeat.stop()
+            if queue.complete(job['id'], worker_id, cleaned_data):
+                done += 1
+            else:
+                logger.error('Worker %s no longer held job %d, its result was dropped.', worker_id, job['id'])
+        idle_since = time.monotonic()
+
+def wait_for_run(queue: JobQueue, run_id: str, poll_interval=5.0, timeout=None) -> dict:
+    """Waits until every job of the run is done or failed and returns the final counts.
+    Raises TimeoutError if that takes longer than timeout seconds.
+    """
+    start = time.monotonic()
+    while True:
+        queue.expire()
+        counts = queue.counts(run_id)
+        if counts[PENDING] == 0 and counts[RUNNING] == 0:
+            return counts
+        if timeout is not None and time.monotonic() - start >= timeout:
+            raise TimeoutError(f'Run {run_id} did not finish within {timeout} s: {counts}')
+        time.sleep(poll_interval)
+
+def coordinate(urls: list, queue_url=QUEUE_URL, db_url=None, load_mode='upsert', run_id=None, poll_interval=5.0,
+               timeout=None, writer=None) -> dict:
+    """Enqueues one job per URL, waits for the workers to finish them and saves all cleaned offers with
+    a single save_to_sql merge (or passes them to the given writer), then removes them from the queue
+    unless saving returned False. Returns the final job counts.
+    """
+    from .funcs import save_to_sql
+
+    queue = JobQueue(queue_url)
+    run_id = queue.enqueue(urls, run_id=run_id)
+    with metrics.stage('coordinate.wait', run_id=run_id):
+        counts = wait_for_run(queue, run_id, poll_interval=poll_interval, timeout=timeout)
+    for url, error in queue.failures(run_id).items():
+        logger.error('%s: The job failed for URL: %s.', error, url)
+
+    combined_data = concat_offers(list(queue.results(run_id).values()))
+    if combined_data.empty:
+        logger.error('No data to save after processing all URLs of run %s.', run_id)
+    else:
+        saved = writer(combined_data) if writer is not None else save_to_sql(combined_data, db_url=db_url, mode=load_mode)
+        # Kept after a failed save, so that coordinating the run again saves them without scraping again
+        if saved is not False:
+            queue.discard_results(run_id)
+    logger.info('Run %s finished: %d jobs done, %d failed.', run_id, counts[DONE], counts[FAILED])
+    return counts
@@ -0,0 +1,159 @@
+"""Module providing cross-store product matching, so that the same product can be compared between chains.
+
+Names are free text that differ between chains ('Kaffe Gevalia 450 g' and 'Gevalia kaffe'), so they are
+first normalized to a key of sorted tokens without sizes and packaging words. A name whose key has been
+seen before gets the same product ID right away. Other names are compared only with the products they
+share character trigrams with (the blocking index), and get the ID of the most similar one if it is
+similar enough, or a new ID otherwise. The IDs are kept in a JSON file, so they stay the same across weeks.
+
+    index = ProductIndex('products.json')
+    df = index.assign(cleaned_data)
+    index.save()
+"""
+
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+import pandas as pd
+from .funcs import set_up_logging, logger, write_atomic
+
+# Set up logging
+set_up_logging()
+
+PRODUCTS_FILE = 'products.json'
+
+# Minimum trigram similarity (Jaccard) for a name to get the ID of an existing product
+MATCH_THRESHOLD = 0.75
+
+# Words that describe the packaging rather than the product
+STOPWORDS = {'i', 'och', 'med', 'ca', 'ask', 'påse', 'burk', 'flaska', 'förp', 'pack', 'st', 'styck', 'stycken'}
+
+# Sizes written in the name, e.g. '450 g', '1,5l' or '6x33 cl'
+SIZE_PATTERN = re.compile(r'\b\d+(?:[.,]\d+)?(?:\s*x\s*\d+(?:[.,]\d+)?)?\s*(?:kg|g|hg|l|dl|cl|ml|st|p|pack)?\b')
+
+NON_WORD_PATTERN = re.compile(r'[^\w]+|_')
+
+def normalize_name(name) -> str:
+    """Returns the matching key of a product name: lower case words without sizes, punctuation and
+    packaging words, sorted so that the word order does not matter.
+    """
+    text = unicodedata.normalize('NFKC', str(name)).lower()
+    text = NON_WORD_PATTERN.sub(' ', SIZE_PATTERN.sub(' ', text))
+    tokens = sorted({token for token in text.split() if token not in STOPWORDS})
+    return ' '.join(tokens) if tokens else ' '.join(text.split())
+
+def trigrams(key: str) -> set:
+    """Returns the character trigrams of every word of a key, with the word boundaries marked."""
+    grams = set()
+    for token in key.split():
+        padded = f' {token} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class ProductIndex:
+    """This class assigns product IDs to offer names and keeps them in a JSON file across runs."""
+
+    def __init__(self, path=PRODUCTS_FILE, threshold=MATCH_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        # Product ID -> the first name and key it was created with
+        self.products = {}
+        # Every key seen so far -> product ID, so known names are matched with a dict lookup
+        self.aliases = {}
+        # Trigram -> IDs of the products whose key contains it
+        self.blocks = defaultdict(set)
+        self._grams = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as file:
+                    saved = json.load(file)
+                for product in saved['products']:
+                    self._add(int(product['id']), product['name'], product['key'])
+                self.aliases.update({key: int(product_id) for key, product_id in saved['aliases'].items()})
+            except (OSError, ValueError, KeyError) as e:
+                logger.error('%s: Could not read the product index %s, starting with an empty index.', e, path)
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def _add(self, product_id: int, name: str, key: str) -> None:
+        self.products[product_id] = {'name': name, 'key': key}
+        self.aliases[key] = product_id
+        self._grams[product_id] = trigrams(key)
+        for gram in self._grams[product_id]:
+            self.blocks[gram].add(product_id)
+
+    def candidates(self, key: str) -> Counter:
+        """Returns the IDs of the products that share trigrams with the key, with the number shared."""
+        counts = Counter()
+        for gram in trigrams(key):
+            counts.update(self.blocks.get(gram, ()))
+        return counts
+
+    def lookup(self, name):
+        """Returns the product ID of a name, or None if it matches no known product."""
+        key = normalize_name(name)
+        if key in self.aliases:
+            return self.aliases[key]
+        grams = trigrams(key)
+        best_id, best_score = None, 0.0
+        for product_id, shared in self.candidates(key).items():
+            score = shared / (len(grams) + len(self._grams[product_id]) - shared)
+            if score > best_score:
+                best_id, best_score = product_id, score
+        return best_id if best_score >= self.threshold else None
+
+    def match(self, name) -> int:
+        """Returns the product ID of a name, creating a new product if it matches no known product."""
+        with self._lock:
+            key = normalize_name(name)
+            product_id = self.lookup(name)
+            if product_id is None:
+                product_id = max(self.products, default=0) + 1
+                self._add(product_id, str(name), key)
+            else:
+                self.aliases[key] = product_id
+            return product_id
+
+    def assign(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Returns the DataFrame with a ProductId column, matching every distinct name only once."""
+        ids = {name: self.match(name) for name in df['Name'].dropna().unique()}
+        return df.assign(ProductId=df['Name'].map(ids).astype('Int32'))
+
+    def save(self) -> None:
+        """Saves the products and aliases to the JSON file."""
+        with self._lock:
+            saved = {'products': [{'id': product_id, **product} for product_id, product in self.products.items()],
+                     'aliases': self.aliases}
+            write_atomic(self.path, lambda file: json.dump(saved, file, ensure_ascii=False, indent=2))
+        logger.info('Product index with %d products saved to %s.', len(self.products), self.path)
+
+def cheapest_store(history: pd.DataFrame, product, index=None) -> pd.DataFrame:
+    """Returns the latest offers of a product (an ID, or a name looked up in the index), one row per
+    store, cheapest first. Every store's latest offer is used, also when stores start their offers on
+    different days. Offers are ranked on the comparison price when there is one.
+    """
+    product_id = product if index is None or not isinstance(product, str) else index.lookup(product)
+    offers = history[history['ProductId'] == product_id]
+    if offers.empty:
+        return offers
+    latest = offers[offers['ValidFrom'] == offers.groupby('Store', observed=True)['ValidFrom'].transform('max')]
+    ranked = latest.assign(_rank=latest['ComparisonPriceAmount'].fillna(latest['Price']))
+    return (ranked.sort_values(['_rank', 'Price'])
+            .drop_duplicates('Store')
+            .drop(columns='_rank')
+            .reset_index(drop=True))
+
+def price_changes(history: pd.DataFrame) -> pd.DataFrame:
+    """Returns the lowest price of every product per store and week, with the change since the
+    previous week the product was on offer in that store.
+    """
+    weekly = (history.assign(Week=history['ValidFrom'].dt.to_period('W'))
+              .groupby(['ProductId', 'Store', 'Week'], observed=True)['Price'].min()
+              .reset_index())
+    weekly['PriceChange'] = weekly.groupby(['ProductId', 'Store'], observed=True)['Price'].diff()
+    return weekly
@@ -0,0 +1,200 @@
+"""Module providing timing and metrics instrumentation for the weekly run.
+
+Code is instrumented with stages:
+
+    with metrics.stage('scrape.scroll') as stage:
+        ...
+        stage.set(iterations=4)
+
+While metrics are disabled (the default) a stage is a shared no-op object, so the instrumentation costs
+next to nothing. Once enabled with metrics.enable('metrics.jsonl'), every finished stage is appended to
+the file as one JSON line with its duration, peak memory and any values set on it. Stages nested in a
+stage with a url inherit that url, so the scraping and cleaning of one store can be told apart.
+
+tracemalloc traces the whole process, so the peak memory of a stage is only recorded when no stage ran
+in another thread at the same time (e.g. not for the stores scraped concurrently with max_workers > 1).
+"""
+
+import json
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from .funcs import set_up_logging, logger
+
+# Set up logging
+set_up_logging()
+
+class _NullStage:
+    """Stand-in for a stage while metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **fields):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    """A running stage, created by Metrics.stage()."""
+
+    def __init__(self, metrics, name, fields):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields
+        self.peak = 0
+        # Set when a stage ran in another thread at the same time, the traced memory is theirs as well
+        self.concurrent = False
+
+    def set(self, **fields):
+        """Adds values such as row counts to the record of the stage."""
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = self.metrics._stack()
+        if stack and 'url' not in self.fields and 'url' in stack[-1].fields:
+            self.fields['url'] = stack[-1].fields['url']
+        stack.append(self)
+        if self.metrics.track_memory:
+            self.metrics._open(self, outermost=len(stack) == 1)
+            self.start_memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        stack = self.metrics._stack()
+        stack.pop()
+        record = {'stage': self.name, 'seconds': round(seconds, 6), **self.fields}
+        if self.metrics.track_memory:
+            self.metrics._close(self, outermost=not stack)
+            if not self.concurrent:
+                _, peak = tracemalloc.get_traced_memory()
+                # A nested stage resets the peak, so its peak is passed on to the stage around it
+                self.peak = max(self.peak, peak - self.start_memory)
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, self.peak + self.start_memory - stack[-1].start_memory)
+                record['peak_mb'] = round(self.peak / 1024 ** 2, 3)
+        if exc_type is not None:
+            record['error'] = f'{exc_type.__name__}: {exc_value}'
+        self.metrics._emit(record)
+        return False
+
+class Metrics:
+    """This class collects the stage records of a run and writes them to a JSON lines file."""
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.track_memory = False
+        self.run_id = None
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Stages running in any thread and the number of threads running stages, see _open
+        self._open_stages = set()
+        self._threads = 0
+
+    def enable(self, path='metrics.jsonl', track_memory=True, run_id=None) -> None:
+        """Starts recording stages to the file. Memory tracking uses tracemalloc, which slows Python code
+        down noticeably, and can be switched off with track_memory=False. Peak memory is only recorded
+        for stages that did not overlap with a stage in another thread.
+        """
+        self.enabled = True
+        self.path = path
+        self.track_memory = track_memory
+        self.run_id = run_id or datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.records = []
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        logger.info('Metrics enabled, writing to %s (run %s).', path, self.run_id)
+
+    def disable(self) -> None:
+        """Stops recording stages."""
+        if self.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.enabled = False
+        self.track_memory = False
+
+    def stage(self, name: str, **fields):
+        """Returns a context manager that records the duration (and peak memory) of the code it wraps."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, fields)
+
+    def record(self, name: str, **fields) -> None:
+        """Records a single event without a duration, e.g. a count."""
+        if self.enabled:
+            self._emit({'stage': name, **fields})
+
+    def summary(self) -> dict:
+        """Returns the number of calls, total and maximum duration, rows and peak memory per stage."""
+        summary = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            stage = summary.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stage['count'] += 1
+            seconds = record.get('seconds', 0.0)
+            stage['seconds'] = round(stage['seconds'] + seconds, 6)
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            if 'rows' in record:
+                stage['rows'] = stage.get('rows', 0) + record['rows']
+            if 'peak_mb' in record:
+                stage['peak_mb'] = max(stage.get('peak_mb', 0.0), record['peak_mb'])
+            if 'error' in record:
+                stage['errors'] = stage.get('errors', 0) + 1
+        return summary
+
+    def write_summary(self) -> dict:
+        """Appends the summary of the run to the metrics file and logs it."""
+        if not self.enabled:
+            return {}
+        summary = self.summary()
+        self._write({'stage': 'summary', 'run_id': self.run_id, 'stages': summary})
+        for name, stage in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+            logger.info('Metrics: %s ran %d times in %.2f s in total.', name, stage['count'], stage['seconds'])
+        return summary
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _open(self, stage: _Stage, outermost: bool) -> None:
+        """Registers a started stage. Once stages run in more than one thread, every running stage is
+        marked concurrent, since their peaks can no longer be told apart.
+        """
+        with self._lock:
+            self._open_stages.add(stage)
+            if outermost:
+                self._threads += 1
+            if self._threads > 1:
+                for running in self._open_stages:
+                    running.concurrent = True
+
+    def _close(self, stage: _Stage, outermost: bool) -> None:
+        with self._lock:
+            self._open_stages.discard(stage)
+            if outermost:
+                self._threads -= 1
+
+    def _emit(self, record: dict) -> None:
+        record = {'run_id': self.run_id, 'time': datetime.now().isoformat(timespec='milliseconds'), **record}
+        with self._lock:
+            self.records.append(record)
+        self._write(record)
+
+    def _write(self, record: dict) -> None:
+        if self.path is None:
+            return
+        with self._lock, open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record, default=str) + '\n')
+
+# Shared instance used by the instrumented modules
+metrics = Metrics()
@@ -0,0 +1,343 @@
+"""Module providing an in-memory index over the cleaned offers, so that dashboards can query them without
+scanning the offers table for every request.
+
+The offers are loaded once from the database (or the Parquet archive) and indexed by store, by the
+words of their names and by comparison price per unit, e.g.
+
+    index = OffersIndex.from_sql('sqlite:///offers.db')
+    index.query(store='Hemköp', unit='kg', max_unit_price=100)     # Offers under 100 kr/kg at Hemköp
+    index.query(keyword='kaffe')                                   # Also finds 'Bryggkaffe'
+    index.refresh()                                                # Picks up the offers of a new run
+
+By default only the offers that are still valid are kept, with history=True older offers are kept too.
+Every saved row is stamped with the time it was inserted or last updated (LoadedAt, see save_to_sql), so a
+refresh only loads the rows saved after the newest LoadedAt loaded before (the watermark), which is an
+index lookup of the new data instead of a scan of the table. An offer that is loaded again (the same Store,
+Name, ValidFrom and Variant, see NATURAL_KEY) replaces the old one, as the upsert does.
+"""
+
+import threading
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from .cleaner import cast_offers, concat_offers
+from .funcs import LOADED_AT, NATURAL_KEY, set_up_logging, logger
+from .matching import normalize_name
+
+# Set up logging
+set_up_logging()
+
+# Rebuild the index once more than this share of its rows were replaced or expired
+COMPACT_RATIO = 0.5
+
+def _today() -> pd.Timestamp:
+    return pd.Timestamp.today().normalize()
+
+def sql_loader(db_url=None, table_name='offers'):
+    """Returns a loader reading the offers saved after since (all offers when since is None) from the
+    offers table, only those valid on or after valid_on if it is given.
+    """
+    def load(since, valid_on=None) -> pd.DataFrame:
+        from sqlalchemy import DateTime, bindparam, text
+        from .funcs import create_db_engine, get_db_url
+        conditions, params = [], {}
+        if since is not None:
+            conditions.append(f'{LOADED_AT} > :since')
+            params['since'] = since.to_pydatetime()
+        if valid_on is not None:
+            conditions.append('ValidThrough >= :valid_on')
+            params['valid_on'] = valid_on.date()
+        query = text(f'SELECT * FROM {table_name}' + (' WHERE ' + ' AND '.join(conditions) if conditions else ''))
+        if since is not None:
+            query = query.bindparams(bindparam('since', type_=DateTime()))
+        engine = create_db_engine(get_db_url(db_url))
+        try:
+            with engine.connect() as connection:
+                df = pd.read_sql(query, connection, params=params)
+        finally:
+            engine.dispose()
+        if LOADED_AT in df.columns:
+            df[LOADED_AT] = pd.to_datetime(df[LOADED_AT])
+        return cast_offers(df)
+    return load
+
+def archive_loader(root='offers_archive'):
+    """Returns a loader reading the offers of the archive partitions written after since (all offers when
+    since is None), only those valid on or after valid_on if it is given. The time a partition was
+    written is returned as LoadedAt, partitions that did not change are not opened.
+    """
+    def load(since, valid_on=None) -> pd.DataFrame:
+        from .archive import partition_write_times, read_archive
+        written = {partition: time for partition, time in partition_write_times(root).items()
+                   if since is None or time > since}
+        if not written:
+            return pd.DataFrame()
+        df = read_archive(root, weeks={week for week, _ in written}, stores={store for _, store in written})
+        if df.empty:
+            return df
+        df[LOADED_AT] = [written.get(partition) for partition in zip(df['Week'].astype(str), df['Store'].astype(str))]
+        df = cast_offers(df[df[LOADED_AT].notna()].drop(columns=['Week']))
+        if valid_on is not None:
+            df = df[df['ValidThrough'] >= valid_on]
+        return df.reset_index(drop=True)
+    return load
+
+class OffersIndex:
+    """This class keeps the cleaned offers in memory with indexes by store, name keyword and unit price.
+
+    Rows are only ever appended, so positions stay valid between refreshes. Replaced and expired rows
+    are marked dead in a mask and left out of the results until the next compaction.
+    """
+
+    def __init__(self, loader=None, history=False):
+        # loader(since, valid_on) returns the offers saved after since (all offers when since is None) that
+        # are valid on or after the day valid_on (all offers when valid_on is None), with their LoadedAt
+        self.loader = loader
+        self.history = history
+        # The newest LoadedAt loaded so far
+        self.watermark = None
+        self._lock = threading.RLock()
+        self._clear()
+
+    @classmethod
+    def from_sql(cls, db_url=None, table_name='offers', history=False) -> 'OffersIndex':
+        index = cls(sql_loader(db_url, table_name), history=history)
+        index.refresh()
+        return index
+
+    @classmethod
+    def from_archive(cls, root='offers_archive', history=False) -> 'OffersIndex':
+        index = cls(archive_loader(root), history=history)
+        index.refresh()
+        return index
+
+    def _clear(self) -> None:
+        self.offers = pd.DataFrame()
+        self._alive = np.zeros(0, dtype=bool)
+        self._valid_from = np.zeros(0, dtype='datetime64[ns]')
+        self._valid_through = np.zeros(0, dtype='datetime64[ns]')
+        self._unit_price = np.zeros(0, dtype='float64')
+        # Positions of the offers by their key, the offers of the last call that added the key
+        self._keys = {}
+        self._by_store = defaultdict(list)
+        self._by_word = defaultdict(list)
+        self._by_unit = defaultdict(list)
+        # Words by their character trigrams, to find the words that contain a keyword
+        self._words_by_gram = defaultdict(set)
+        # Unit price order per unit and position arrays per store, rebuilt lazily after every change
+        self._price_order = {}
+        self._store_positions = {}
+
+    def __len__(self) -> int:
+        return int(self._alive.sum())
+
+    def refresh(self, day=None) -> int:
+        """Loads the offers saved since the previous refresh (all offers the first time) and adds them.
+        Without history only the offers still valid on the day are loaded. Returns the number of offers loaded.
+        """
+        if self.loader is None:
+            raise RuntimeError('The offers index has no loader to refresh from.')
+        day = pd.Timestamp(day or _today()).normalize()
+        df = self.loader(self.watermark, None if self.history else day)
+        added = self.add(df)
+        if added and LOADED_AT in df.columns and df[LOADED_AT].notna().any():
+            newest = df[LOADED_AT].max()
+            self.watermark = newest if self.watermark is None else max(self.watermark, newest)
+        if not self.history:
+            self.expire(day)
+        logger.info('Offers index refreshed: %d offers loaded, %d offers indexed.', added, len(self))
+        return added
+
+    def add(self, df: pd.DataFrame) -> int:
+        """Adds cleaned offers to the index. Offers with the same key (NATURAL_KEY) as an offer added
+        before replace it, offers of the same call that share a key are all kept, as the upsert keeps
+        them. Returns the number of offers added.
+        """
+        if df is None or df.empty:
+            return 0
+        df = df.reset_index(drop=True)
+        with self._lock:
+            start = len(self.offers)
+            self.offers = concat_offers([self.offers, df])
+            self._alive = np.concatenate([self._alive, np.ones(len(df), dtype=bool)])
+            self._valid_from = np.concatenate([self._valid_from, df['ValidFrom'].to_numpy('datetime64[ns]')])
+            self._valid_through = np.concatenate([self._valid_through,
+                                                  df['ValidThrough'].to_numpy('datetime64[ns]')])
+            self._unit_price = np.concatenate([self._unit_price,
+                                               df['ComparisonPriceAmount'].to_numpy('float64', na_value=np.nan)])
+
+            stores = df['Store'].astype(str).to_numpy()
+            units = df['ComparisonUnit'].astype(object).to_numpy()
+            keys = zip(*(stores if column == 'Store' else df[column] for column in NATURAL_KEY))
+            for offset, key in enumerate(keys):
+                position = start + offset
+                positions = self._keys.get(key)
+                if positions is None or positions[0] < start:
+                    if positions is not None:
+                        self._alive[positions] = False
+                    self._keys[key] = [position]
+                else:
+                    positions.append(position)
+                self._by_store[stores[offset].casefold()].append(position)
+                if isinstance(units[offset], str):
+                    self._by_unit[units[offset].casefold()].append(position)
+                for word in normalize_name(key[1]).split():
+                    if word not in self._by_word:
+                        for i in range(len(word) - 2):
+                            self._words_by_gram[word[i:i + 3]].add(word)
+                    self._by_word[word].append(position)
+            self._price_order = {}
+            self._store_positions = {}
+            self._compact_if_needed()
+        return len(df)
+
+    def expire(self, day=None) -> int:
+        """Drops the offers that are no longer valid on the day (today by default). Returns their number."""
+        day = np.datetime64(pd.Timestamp(day or _today()).normalize(), 'ns')
+        with self._lock:
+            expired = self._alive & (self._valid_through < day)
+            self._alive &= ~expired
+            count = int(expired.sum())
+            if count:
+                self._compact_if_needed()
+        return count
+
+    def _compact_if_needed(self) -> None:
+        dead = len(self._alive) - int(self._alive.sum())
+        if dead and dead > COMPACT_RATIO * len(self._alive):
+            offers = self.offers[self._alive]
+            self._clear()
+            self.add(offers)
+
+    def _keyword_positions(self, keyword: str) -> np.ndarray:
+        """Returns the positions of the offers whose name has words containing every word of the keyword."""
+        result = None
+        for term in normalize_name(keyword).split():
+            if len(term) < 3:
+                words = {term} if term in self._by_word else set()
+            else:
+                grams = [self._words_by_gram.get(term[i:i + 3], set()) for i in range(len(term) - 2)]
+                words = {word for word in set.intersection(*grams) if term in word}
+            positions = np.unique(np.fromiter((p for word in words for p in self._by_word[word]), dtype=np.int64))
+            result = positions if result is None else np.intersect1d(result, positions, assume_unique=True)
+            if not len(result):
+                break
+        return result if result is not None else np.arange(len(self._alive))
+
+    def _unit_price_positions(self, unit: str, min_price=None, max_price=None) -> np.ndarray:
+        """Returns the positions of the offers in the unit with a unit price in the range, cheapest first."""
+        unit = unit.casefold()
+        if unit not in self._price_order:
+            positions = np.asarray(self._by_unit.get(unit, []), dtype=np.int64)
+            prices = self._unit_price[positions]
+            order = np.argsort(prices, kind='stable')
+            self._price_order[unit] = (prices[order], positions[order])
+        prices, positions = self._price_order[unit]
+        low = 0 if min_price is None else np.searchsorted(prices, min_price, side='left')
+        high = len(prices) if max_price is None else np.searchsorted(prices, max_price, side='right')
+        return positions[low:high]
+
+    def positions(self, store=None, keyword=None, unit=None, min_unit_price=None, max_unit_price=None,
+                  active_on=None) -> np.ndarray:
+        """Returns the positions in offers of the offers matching every given condition. With a unit
+        they are ordered by unit price, cheapest first, otherwise in the order they were added.
+        """
+        if (min_unit_price is not None or max_unit_price is not None) and unit is None:
+            raise ValueError('A unit is needed to filter on the unit price, e.g. unit="kg".')
+        with self._lock:
+            if unit is not None:
+                result = self._unit_price_positions(unit, min_unit_price, max_unit_price)
+            else:
+                result = np.arange(len(self._alive))
+            mask = self._alive[result]
+            if store is not None:
+                store = str(store).casefold()
+                if store not in self._store_positions:
+                    self._store_positions[store] = np.asarray(self._by_store.get(store, []), dtype=np.int64)
+                mask &= np.isin(result, self._store_positions[store])
+            if keyword:
+                mask &= np.isin(result, self._keyword_positions(keyword))
+            if active_on is not None:
+                day = np.datetime64(pd.Timestamp(active_on).normalize(), 'ns')
+                mask &= (self._valid_from[result] <= day) & (self._valid_through[result] >= day)
+            return result[mask]
+
+    def query(self, store=None, keyword=None, unit=None, min_unit_price=None, max_unit_price=None,
+              active_on=None, limit=None) -> pd.DataFrame:
+        """Returns the offers matching every given condition, e.g. all offers under 100 kr/kg at a store
+        with query(store='Hemköp', unit='kg', max_unit_price=100). See positions for the order.
+        """
+        with self._lock:
+            result = self.positions(store, keyword, unit, min_unit_price, max_unit_price, active_on)
+            if limit is not None:
+                result = result[:limit]
+            return self.offers.iloc[result]
+
+    def stores(self) -> list:
+        """Returns the stores with offers in the index."""
+        with self._lock:
+            return sorted({store for store in self.offers['Store'][self._alive].astype(str)}) if len(self) else []
+
+# Query parameters of the HTTP service and the types they are parsed to
+QUERY_PARAMETERS = {'store': str, 'keyword': str, 'unit': str, 'min_unit_price': float, 'max_unit_price': float,
+                    'active_on': str, 'limit': int}
+
+def make_server(index: OffersIndex, host='127.0.0.1', port=8000):
+    """Returns an HTTP server answering GET /offers?store=Hemköp&unit=kg&max_unit_price=100 (any of the
+    query parameters of OffersIndex.query) and GET /stores from the index, as JSON.
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                if url.path == '/stores':
+                    body = json.dumps(index.stores(), ensure_ascii=False)
+                elif url.path == '/offers':
+                    params = {name: QUERY_PARAMETERS[name](values[-1]) for name, values in parse_qs(url.query).items()
+                              if name in QUERY_PARAMETERS}
+                    body = index.query(**params).to_json(orient='records', date_format='iso', force_ascii=False)
+                else:
+                    self.send_error(404)
+                    return
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.info('Offers service: %s', format % args)
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+def serve(index: OffersIndex, host='127.0.0.1', port=8000, refresh_interval=300.0) -> None:
+    """Serves the index over HTTP until interrupted, refreshing it every refresh_interval seconds."""
+    server = make_server(index, host, port)
+    stopped = threading.Event()
+
+    def refresh_loop():
+        while not stopped.wait(refresh_interval):
+            try:
+                index.refresh()
+            except Exception as e:
+                logger.error('%s: Failed to refresh the offers index.', e)
+
+    threading.Thread(target=refresh_loop, daemon=True).start()
+    logger.info('Serving %d offers on http://%s:%d.', len(index), host, port)
+    print(f'Serving {len(index)} offers on http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
@@ -1,109 +1,221 @@
 """Module providing a Scraper with functionality to scrape the website 'ereklamblad.se' for weekly offers from requested urls."""
 
-from bs4 import BeautifulSoup
 import pandas as pd
 import time
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-import os
 from datetime import datetime
+from .extractor import OFFER_ITEM_SELECTOR, FIELD_SELECTORS, get_extractor
+from .http_fetch import HttpFetcher, JsonLdExtractor, listed_offer_count
+from .cache import fingerprint_records
+from .snapshot import load_snapshot, save_snapshot
 from .funcs import set_up_logging, logger
+from .metrics import metrics
 
 # Set up logging
 set_up_logging()
 
+# Limits (in seconds) for the adaptive scrolling in Scraper.scroll_to_bottom
+SCROLL_DEADLINE = 60
+SCROLL_SETTLE_TIME = 0.75
+SCROLL_IDLE_TIMEOUT = 5
+SCROLL_INITIAL_WAIT = 0.1
+
+# Wraps fetch and XMLHttpRequest once per page to count the requests that are still in flight
+TRACK_PENDING_REQUESTS_JS = '''
+if (window.__pendingRequests === undefined) {
+    window.__pendingRequests = 0;
+    const origFetch = window.fetch;
+    if (origFetch) {
+        window.fetch = function() {
+            window.__pendingRequests++;
+            return origFetch.apply(this, arguments).finally(() => { window.__pendingRequests--; });
+        };
+    }
+    const origSend = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function() {
+        window.__pendingRequests++;
+        this.addEventListener('loadend', () => { window.__pendingRequests--; });
+        return origSend.apply(this, arguments);
+    };
+}
+'''
+
+# Returns the number of loaded offers, the scroll height and the number of requests in flight in one round trip
+PAGE_STATE_JS = '''
+return [document.querySelectorAll('%s.%s').length,
+        document.body.scrollHeight,
+        window.__pendingRequests || 0];
+''' % (OFFER_ITEM_SELECTOR['tag'], OFFER_ITEM_SELECTOR['class'])
+
+# Returns the distinct validity dates of the offers loaded so far, the cheap fingerprint used by the flyer cache
+VALIDITY_JS = '''
+const values = (itemprop) => Array.from(new Set(Array.from(
+    document.querySelectorAll('%s.%s meta[itemprop="' + itemprop + '"]'), (meta) => meta.content))).sort();
+return [values('%s'), values('%s')];
+''' % (OFFER_ITEM_SELECTOR['tag'], OFFER_ITEM_SELECTOR['class'], 
+       FIELD_SELECTORS['ValidFrom']['itemprop'], FIELD_SELECTORS['ValidThrough']['itemprop'])
+
 class Scraper:
     """This class provides functionality to scrape the website 'ereklamblad.se' 
     for weekly offers from grocery stores and save it to a CSV file.
     """
     
-    def __init__(self, url):
+    def __init__(self, url, user_data_dir=None, pool=None, extractor='fast', snapshot_dir=None, replay_from=None, 
+                 cache=None, fetch_mode='browser', fetcher=None, timeout=None, browser_profile='default'):
         self.url = url
         self.data = [] 
         self.driver = None
+        self.driver_broken = False
+        self.scroll_stats = {}
+        self.full_content = None
+        self.offers = None
+        # Concurrent runs pass their own profile directory, since Chrome locks a user data dir while running
+        self.user_data_dir = user_data_dir
+        # Optional DriverPool to borrow a warm browser from instead of starting a new one
+        self.pool = pool
+        # Backend that parses the page, see the extractor module
+        self.extractor = get_extractor(extractor)
+        # Optional directory to archive every scraped page in, see the snapshot module
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_path = None
+        # Optional snapshot file to parse instead of loading the page with Selenium
+        self.replay_from = replay_from
+        # Optional FlyerCache, used to stop early when the offers have not changed since the last run
+        self.cache = cache
+        self.unchanged = False
+        # 'browser' loads the page with Selenium, 'http' with a plain HTTP request (see the http_fetch module)
+        # and 'auto' tries HTTP first and falls back to the browser unless the response holds the complete offer list
+        if fetch_mode not in ('browser', 'http', 'auto'):
+            raise ValueError(f'Unknown fetch mode: {fetch_mode}')
+        self.fetch_mode = fetch_mode
+        # Optional HttpFetcher, shared between scrapers so the connections are reused
+        self.fetcher = fetcher
+        self.fetched_with = None
+        # Optional time limit in seconds for loading and scrolling the page, see fetch_page
+        self.timeout = timeout
+        self.deadline = None
+        # Profile of the browser started without a DriverPool, see create_driver (a pool brings its own)
+        self.browser_profile = browser_profile
         logger.info('A scraper object was instantiated with URL: %s', {url})
 
     def set_up_driver(self):
-        """This method sets up the Selenium WebDriver for automating browser interaction."""
+        """This method sets up the Selenium WebDriver for automating browser interaction, 
+        borrowing a warm browser when the scraper was given a DriverPool.
+        """
         try:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            driver_path = os.path.join(current_dir, 'chromedriver.exe')
-            
-            # Creating a temp directory to ensure Chrome uses a clean user profile for every run
-            temp_user_data_dir = os.path.join(os.getcwd(), 'temp_chrome_user_data')
-
-            # Initializing Options in order to customize how Chrome behaves with the new user profile
-            chrome_options = Options()
-
-            # Pointing Chrome to the new temp directory
-            chrome_options.add_argument(f'--user-data-dir={temp_user_data_dir}')
-
-            # Experimenting with different options, the following arguments ensured the Scraper runs smoothly (i.e block pop-up windows)
-            chrome_options.add_argument('--no-first-run')
-            chrome_options.add_argument('--no-default-browser-check')
-            chrome_options.add_argument('--disable-default-apps')
-            chrome_options.add_argument('--disable-extensions')
-            chrome_options.add_argument('--disable-popup-blocking')
-            chrome_options.add_argument('--disable-infobars')
-            chrome_options.add_argument('--disable-features=EnableEphemeralFlashPermission')
-            chrome_options.add_argument('--disable-background-networking')
-            chrome_options.add_argument('--disable-sync')
-            chrome_options.add_argument('--disable-translate')
-            chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-
-            # Instantiating the driver
-            service = Service(executable_path=driver_path)
-            self.driver = webdriver.Chrome(service=service, options=chrome_options)
-            logger.info('WebDriver set up successfully.')
+            if self.pool is not None:
+                self.driver = self.pool.acquire()
+                logger.info('WebDriver borrowed from the driver pool.')
+            else:
+                # Selenium is only imported once a browser is needed, replay and HTTP mode run without it
+                from .driver import create_driver
+                self.driver = create_driver(self.user_data_dir, profile=self.browser_profile)
+                logger.info('WebDriver set up successfully.')
+            self.driver_broken = False
             
         except Exception as e:
             logger.error('An error occurred while setting up the driver: %s', e)
             self.driver = None
+            
+    def close_driver(self):
+        """This method quits the driver, or returns it to the DriverPool it was borrowed from."""
+        if self.driver is not None:
+            try:
+                if self.pool is not None:
+                    self.pool.release(self.driver, broken=self.driver_broken)
+                else:
+                    self.driver.quit()
+            except Exception as e:
+                logger.error('%s: An error occured while closing the driver.', e)
+            self.driver = None
         
     def load_page(self):
         """This method loads the requested URL."""
         if self.driver is None:
             logger.debug('Driver not instantiated.')
-            self.set_up_driver()  
+            with metrics.stage('scrape.driver_startup'):
+                self.set_up_driver()  
         if self.driver is not None:
-            self.driver.get(self.url)
-            time.sleep(0.5)
-            logger.info('Page successfully loaded.')
+            try:
+                if self.timeout is not None:
+                    self.driver.set_page_load_timeout(self.timeout)
+                with metrics.stage('scrape.load_page'):
+                    self.driver.get(self.url)
+                    time.sleep(0.5)
+                logger.info('Page successfully loaded.')
+            except Exception as e:
+                self.driver_broken = True
+                logger.error('%s: An error occured while loading the page.', e)
         else:
             logger.error('Driver setup failed, cannot load page.')
             
-    def scroll_to_bottom(self):
+    def scroll_to_bottom(self, deadline=SCROLL_DEADLINE, settle_time=SCROLL_SETTLE_TIME, 
+                         idle_timeout=SCROLL_IDLE_TIMEOUT, initial_wait=SCROLL_INITIAL_WAIT):
         """This method scrolls to the bottom of the page to ensure all offers are loaded. 
-        For further explanation see https://python-forum.io/thread-20175.html.
+        
+        Instead of sleeping a fixed time after every scroll, the page is polled with exponential backoff 
+        (starting at initial_wait) until the number of offers or the page height grows. Scrolling stops when 
+        nothing has grown for settle_time seconds while no requests are in flight, when nothing has grown for 
+        idle_timeout seconds at all, or when the hard deadline is reached. The number of scroll iterations and 
+        the time spent on each of them are saved to the scroll_stats attribute.
         """
         if self.driver is not None:
             try: 
-                # Get scroll height
-                last_height = self.driver.execute_script('return document.body.scrollHeight')
+                start = time.monotonic()
+                self.driver.execute_script(TRACK_PENDING_REQUESTS_JS)
+                last_count, last_height, _ = self.driver.execute_script(PAGE_STATE_JS)
+                self.scroll_stats = {'iterations': 0, 'iteration_times': [], 'timed_out': False}
         
                 while True:
+                    iteration_start = time.monotonic()
                     # Scroll down to bottom
                     self.driver.execute_script('window.scrollTo(0, document.body.scrollHeight);')
-                    # Wait for the page to load
-                    time.sleep(2)
-                    # Calculate new scroll height and compare with last scroll height
-                    new_height = self.driver.execute_script('return document.body.scrollHeight')
-                    if new_height == last_height:
+                    
+                    # Wait with exponential backoff until new offers show up or the page goes quiet
+                    grew = False
+                    waited = 0
+                    wait = initial_wait
+                    while True:
+                        time.sleep(wait)
+                        waited += wait
+                        count, height, pending = self.driver.execute_script(PAGE_STATE_JS)
+                        if count > last_count or height > last_height:
+                            grew = True
+                            break
+                        if (pending == 0 and waited >= settle_time) or waited >= idle_timeout:
+                            break
+                        if time.monotonic() - start >= deadline:
+                            self.scroll_stats['timed_out'] = True
+                            break
+                        wait = min(wait * 2, max(idle_timeout - waited, initial_wait))
+                    
+                    self.scroll_stats['iterations'] += 1
+                    self.scroll_stats['iteration_times'].append(round(time.monotonic() - iteration_start, 3))
+                    if not grew or self.scroll_stats['timed_out']:
+                        break
+                    if time.monotonic() - start >= deadline:
+                        self.scroll_stats['timed_out'] = True
                         break
-                    last_height = new_height
+                    last_count, last_height = count, height
+                    
+                self.scroll_stats['offer_count'] = count
+                if self.scroll_stats['timed_out']:
+                    logger.error('Scrolling stopped at the %d s deadline with %d offers loaded.', deadline, count)
+                logger.info('Scrolled %d times in %.2f s, %d offers loaded.', 
+                            self.scroll_stats['iterations'], time.monotonic() - start, count)
             
                 self.full_content = self.driver.page_source
-                self.driver.quit()
                 logger.info('The full content of the page was successfully gathered.')
             except Exception as e:
+                # A browser that failed mid-page is not handed back to the pool for reuse
+                self.driver_broken = True
                 logger.error('%s: An error occured while gathering the page content.', e)
         
     def find_elements(self):
-        """This method creates a BeautifulSoup object that parses the HTML-data."""
-        if self.full_content is not None:
-            self.soup = BeautifulSoup(self.full_content, 'html.parser')
-            self.offers = self.soup.find_all('li', class_='OfferList__OfferListItem-sc-bj82vg-1')
+        """This method parses the HTML-data and collects the offer list items, unless fetch_over_http already did."""
+        if self.offers is None and self.full_content is not None:
+            with metrics.stage('scrape.parse', extractor=self.extractor.name) as stage:
+                self.offers = self.extractor.find_offers(self.full_content)
+                stage.set(rows=len(self.offers))
             logger.info('The OfferList class was successfully parsed.')
         if not self.offers:
             logger.error('The OfferList could not be found.')
@@ -111,32 +223,34 @@ class Scraper:
     def extract_data(self):
         """This method extracts relevant data from the offers and appends them to the data attribute."""
         if self.offers is not None:
-            for offer in self.offers:
-                try:
-                    name = offer.find('header', class_='OfferList___StyledHeader-sc-bj82vg-11').get_text(strip=True)
-                    price = offer.find('span', class_='OfferList___StyledSpan2-sc-bj82vg-14').get_text(strip=True)
-                    details = offer.find('div', class_='OfferList__OfferPcs-sc-bj82vg-7').get_text(strip=True)
-                    store = offer.find('meta', itemprop='name')['content']
-                    valid_from = offer.find('meta', itemprop='validFrom')['content']
-                    valid_through = offer.find('meta', itemprop='validThrough')['content']
-                    valid_until = offer.find('meta', itemprop='priceValidUntil')['content']
-
-                    self.data.append({
-                        'Name': name,
-                        'Price': price,
-                        'Details': details,
-                        'Store': store,
-                        'ValidFrom': valid_from,
-                        'ValidThrough': valid_through,
-                        'ValidUntil': valid_until
-                    })
-                except AttributeError as e:
-                    logger.error('An error occured while extracting data from an offer: %s', e)  
+            with metrics.stage('scrape.extract', extractor=self.extractor.name) as stage:
+                for offer in self.offers:
+                    try:
+                        self.data.append(self.extractor.extract_offer(offer))
+                    except ValueError as e:
+                        logger.error('An error occured while extracting data from an offer: %s', e)  
+                stage.set(rows=len(self.data))
             print(f'Number of offers found: {len(self.offers)}') 
             return self.data  
         else:
             logger.error('An error occured while trying to extract the data. No offers found.')
                 
+    def load_snapshot(self):
+        """This method reads the page content from the snapshot file given in replay_from, without a browser."""
+        try:
+            self.full_content = load_snapshot(self.replay_from)
+            logger.info('The page content was loaded from snapshot %s', self.replay_from)
+        except Exception as e:
+            logger.error('%s: An error occured while loading the snapshot %s.', e, self.replay_from)
+
+    def save_snapshot(self):
+        """This method archives the gathered page content as a compressed snapshot in snapshot_dir."""
+        if self.full_content is not None:
+            try:
+                self.snapshot_path = save_snapshot(self.full_content, self.snapshot_dir, url=self.url)
+            except Exception as e:
+                logger.error('%s: An error occured while saving the snapshot.', e)
+
     def save_to_csv(self):
         """This method saves the extracted data to a CSV-file. Optional for manual handling of data."""
         if self.data:
@@ -149,12 +263,160 @@ class Scraper:
         else:
             print('There is no data to be saved.')
         
+    def fetch_page(self):
+        """This method gathers the full content of the page, from the browser or in replay mode from a snapshot.
+        In fetch mode 'http' or 'auto' the page is first requested without a browser (see fetch_over_http).
+        With a timeout, loading and scrolling the page in the browser is cut off after that many seconds 
+        and a TimeoutError is raised, so the caller can retry the URL instead of keeping a partial page.
+        """
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        if self.replay_from is not None:
+            self.load_snapshot()
+            return
+        if self.fetch_mode != 'browser':
+            if self.fetch_over_http():
+                self.fetched_with = 'http'
+            elif self.fetch_mode == 'auto':
+                logger.info('Falling back to the browser for URL: %s', self.url)
+        if self.fetched_with is None and self.fetch_mode != 'http':
+            # load_page sets up the driver itself, so it is only started once
+            try:
+                self.load_page()
+                if self.cache is not None and self.check_validity():
+                    return
+                with metrics.stage('scrape.scroll') as stage:
+                    self.scroll_to_bottom(deadline=self.remaining_time(SCROLL_DEADLINE))
+                    stage.set(**self.scroll_stats)
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    self.full_content = None
+                    raise TimeoutError(f'Loading the page took longer than {self.timeout} s.')
+            except TimeoutError:
+                # The page may still be loading, so the browser is not handed back to the pool for reuse
+                self.driver_broken = True
+                raise
+            finally:
+                self.close_driver()
+            self.fetched_with = 'browser'
+        if self.snapshot_dir is not None:
+            self.save_snapshot()
+
+    def remaining_time(self, limit: float) -> float:
+        """Returns the given time limit, shortened to the time left before the deadline of the URL."""
+        if self.deadline is None:
+            return limit
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f'Loading the page took longer than {self.timeout} s.')
+        return min(limit, remaining)
+
+    def fetch_over_http(self) -> bool:
+        """This method requests the page without a browser and looks for the offers in the server response, 
+        first in the markup read by the extractor and then in its JSON-LD data. Returns True if offers were found.
+        In fetch mode 'auto' they also have to be complete: the page has to list as many offers as were found,
+        otherwise the response may only hold the first batch of a page that loads more while scrolling.
+        """
+        if self.fetcher is None:
+            self.fetcher = HttpFetcher()
+        try:
+            with metrics.stage('scrape.http_fetch'):
+                content = self.fetcher.fetch(self.url)
+        except Exception as e:
+            logger.error('%s: An error occured while requesting the page over HTTP.', e)
+            return False
+
+        for extractor in (self.extractor, JsonLdExtractor()):
+            with metrics.stage('scrape.parse', extractor=extractor.name) as stage:
+                offers = extractor.find_offers(content)
+                stage.set(rows=len(offers))
+            if not offers:
+                continue
+            listed = listed_offer_count(content)
+            if listed != len(offers):
+                if self.fetch_mode == 'auto':
+                    logger.info('%d offers found in the server response of URL: %s, but the page lists %s, '
+                                'so they may be incomplete.', len(offers), self.url, listed)
+                    continue
+                logger.warning('%d offers found in the server response of URL: %s, but the page lists %s, '
+                               'they may be incomplete.', len(offers), self.url, listed)
+            self.extractor = extractor
+            self.full_content = content
+            self.offers = offers
+            logger.info('%d offers found in the server response of URL: %s', len(offers), self.url)
+            return True
+        logger.info('No complete offer list found in the server response of URL: %s', self.url)
+        return False
+
+    def check_validity(self) -> bool:
+        """This method compares the validity window of the offers on the freshly loaded page with the flyer 
+        cache and sets the unchanged attribute if it is the same as on the last run.
+        """
+        if self.driver is None or self.driver_broken:
+            return False
+        try:
+            validity = self.driver.execute_script(VALIDITY_JS)
+        except Exception as e:
+            logger.error('%s: An error occured while reading the validity of the offers.', e)
+            return False
+        if self.cache.is_unchanged(self.url, validity=validity):
+            self.unchanged = True
+            logger.info('The offers valid %s - %s are unchanged since the last run, skipping URL: %s', 
+                        min(validity[0]), max(validity[1]), self.url)
+            return True
+        self.cache.stage(self.url, validity=validity)
+        return False
+
+    def check_records(self) -> bool:
+        """This method compares a hash of the extracted records with the flyer cache and sets the unchanged 
+        attribute if they are the same as on the last run.
+        """
+        records_hash = fingerprint_records(self.data)
+        if self.cache.is_unchanged(self.url, records_hash=records_hash):
+            self.unchanged = True
+            logger.info('The extracted offers are unchanged since the last run for URL: %s', self.url)
+            return True
+        self.cache.stage(self.url, records_hash=records_hash)
+        return False
+
     def scrape(self):
-        """Run all scraping steps."""
-        self.set_up_driver()
-        self.load_page()
-        self.scroll_to_bottom()
+        """Run all scraping steps. In replay mode the page is read from a snapshot and Selenium is skipped.
+        With a flyer cache, the steps stop as soon as the offers turn out to be unchanged (see the unchanged attribute).
+        """
+        self.fetch_page()
+        if self.unchanged:
+            return self.data
         self.find_elements()
         self.extract_data()
+        if self.cache is not None and self.data:
+            self.check_records()
         return self.data
-        
+
+    def iter_offers(self, batch_size=500):
+        """Run all scraping steps, but yield the extracted offers in lists of at most batch_size records 
+        instead of collecting them all in the data attribute.
+        """
+        self.fetch_page()
+        self.find_elements()
+        # The parsed offers are all that is needed from here on
+        self.full_content = None
+        if not self.offers:
+            logger.error('An error occured while trying to extract the data. No offers found.')
+            return
+
+        batch = []
+        extracted = 0
+        for offer in self.offers:
+            try:
+                batch.append(self.extractor.extract_offer(offer))
+            except ValueError as e:
+                logger.error('An error occured while extracting data from an offer: %s', e)
+                continue
+            if len(batch) >= batch_size:
+                extracted += len(batch)
+                yield batch
+                batch = []
+        if batch:
+            extracted += len(batch)
+            yield batch
+        metrics.record('scrape.extract', extractor=self.extractor.name, rows=extracted)
+        print(f'Number of offers found: {len(self.offers)}')
@@ -0,0 +1,72 @@
+"""Module providing functions to archive scraped pages as compressed snapshots and to read them back.
+
+Snapshots are content-addressed: the file name is the SHA-256 of the page, so a page that has not
+changed since the last run is only stored once. Every capture is also appended to a manifest
+('manifest.jsonl') in the snapshot directory, recording which URL was captured when.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+from .funcs import set_up_logging, logger, write_atomic
+
+# Set up logging
+set_up_logging()
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+# Concurrent scrapers in one process share the manifest
+_manifest_lock = threading.Lock()
+
+def snapshot_path(directory: str, digest: str) -> str:
+    """Returns the path of the snapshot with the given SHA-256 digest."""
+    # Fan out over sub directories so a year of snapshots does not end up in one huge directory
+    return os.path.join(directory, digest[:2], f'{digest}.html.gz')
+
+def save_snapshot(html: str, directory: str, url=None) -> str:
+    """Saves the page as a gzip compressed snapshot, records it in the manifest and returns its path."""
+    content = html.encode('utf-8')
+    digest = hashlib.sha256(content).hexdigest()
+    path = snapshot_path(directory, digest)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, lambda file: file.write(content), mode='wb', opener=gzip.open)
+        logger.info('Snapshot saved to %s', path)
+    else:
+        logger.info('Page unchanged, snapshot %s already exists.', path)
+
+    entry = {'sha256': digest, 'url': url, 'captured_at': datetime.now().isoformat(timespec='seconds'),
+             'path': os.path.relpath(path, directory)}
+    with _manifest_lock, open(os.path.join(directory, MANIFEST_NAME), 'a', encoding='utf-8') as manifest:
+        manifest.write(json.dumps(entry) + '\n')
+    return path
+
+def load_snapshot(path: str) -> str:
+    """Returns the HTML of a snapshot file. Plain (uncompressed) HTML files are read as well."""
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as file:
+            return file.read().decode('utf-8')
+    with open(path, encoding='utf-8') as file:
+        return file.read()
+
+def list_snapshots(directory: str, url=None) -> list:
+    """Returns the manifest entries in the snapshot directory, oldest first, optionally for one URL only.
+    The 'path' of every entry is resolved against the snapshot directory.
+    """
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return []
+    entries = []
+    with open(manifest_path, encoding='utf-8') as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if url is None or entry['url'] == url:
+                entry['path'] = os.path.join(directory, entry['path'])
+                entries.append(entry)
+    return entries
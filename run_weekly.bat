@@ -2,5 +2,5 @@
 
 cd /d "C:\Users\tovat\OneDrive\Dokument\EC_utbildning\Python\Python_Project_WeeklyOffers"
 
-"C:\Users\tovat\OneDrive\Dokument\EC_utbildning\Python\Python_Project_WeeklyOffers\.venv\Scripts\python.exe" -m fetch_weekly_offers.run_weekly
+"C:\Users\tovat\OneDrive\Dokument\EC_utbildning\Python\Python_Project_WeeklyOffers\.venv\Scripts\python.exe" -m fetch_weekly_offers run
 
@@ -0,0 +1,71 @@
+"""Module providing tests for the columnar offers archive."""
+
+from datetime import date
+import pandas as pd
+import pytest
+from fetch_weekly_offers.utils.cleaner import DataCleaner
+from fetch_weekly_offers.utils.archive import write_archive, read_archive, list_partitions, iso_week, offer_weeks
+
+pytest.importorskip('pyarrow')
+
+class TestArchive:
+
+    def setup_method(self):
+        """Cleaning the real test data and splitting it over two stores."""
+        raw_data = pd.read_csv('tests/offers_2024-09-25.csv')
+        self.cleaned = DataCleaner(raw_data.to_dict(orient='records')).clean()
+        self.cleaned['Store'] = self.cleaned['Store'].cat.add_categories(['Hemköp'])
+        self.cleaned.loc[self.cleaned.index[:50], 'Store'] = 'Hemköp'
+
+    @pytest.mark.parametrize('format', ['parquet', 'ipc'])
+    def test_write_and_read(self, tmp_path, format):
+        """Test that the offers land in the partitions of their ValidFrom week and store and read back unchanged."""
+        root = str(tmp_path)
+        weeks = write_archive(self.cleaned, root, run_date=date(2024, 9, 25), format=format)
+        next_week = self.cleaned.assign(ValidFrom=self.cleaned['ValidFrom'] + pd.Timedelta(days=7))
+        write_archive(next_week, root, run_date=date(2024, 10, 2), format=format)
+
+        expected = set(zip(offer_weeks(self.cleaned), self.cleaned['Store'].astype(str))) | \
+            set(zip(offer_weeks(next_week), next_week['Store'].astype(str)))
+        assert list_partitions(root) == sorted(expected)
+        assert weeks == sorted(set(offer_weeks(self.cleaned)))
+        assert len(read_archive(root, format=format)) == 2 * len(self.cleaned)
+
+    def test_partitioned_by_valid_from(self, tmp_path):
+        """Test that an offer is filed under the week it is valid from, not the week of the run, and that
+        offers without a ValidFrom date fall back to the week of the run.
+        """
+        root = str(tmp_path)
+        offers = self.cleaned.head(3).copy()
+        offers['ValidFrom'] = pd.to_datetime(['2024-09-22', '2024-09-23', None])
+        assert write_archive(offers, root, run_date=date(2024, 10, 2)) == ['2024-W38', '2024-W39', '2024-W40']
+        df = read_archive(root, columns=['Name', 'Week'])
+        assert dict(zip(df['Name'], df['Week'])) == dict(zip(offers['Name'], ['2024-W38', '2024-W39', '2024-W40']))
+
+    def test_projection_and_pruning(self, tmp_path):
+        """Test that only the requested columns, weeks and stores are returned."""
+        root = str(tmp_path)
+        write_archive(self.cleaned, root)
+
+        df = read_archive(root, columns=['Name', 'Price', 'Week'], weeks=['2024-W39'], stores=['Hemköp'])
+        hemkop = self.cleaned[self.cleaned['Store'] == 'Hemköp']
+        assert list(df.columns) == ['Name', 'Price', 'Week']
+        assert len(df) == (offer_weeks(hemkop) == '2024-W39').sum() > 0
+        assert set(df['Week']) == {'2024-W39'}
+
+    def test_rewrite_merges_partition(self, tmp_path):
+        """Test that archiving a week again replaces the offers archived before and keeps the others."""
+        root = str(tmp_path)
+        write_archive(self.cleaned, root, run_date=date(2024, 9, 25))
+        write_archive(self.cleaned, root, run_date=date(2024, 9, 26))
+        assert len(read_archive(root)) == len(self.cleaned)
+
+        changed = self.cleaned.head(5).assign(Price=12345.0)
+        write_archive(changed, root, run_date=date(2024, 10, 2))
+        df = read_archive(root)
+        assert len(df) == len(self.cleaned)
+        assert (df['Price'] == 12345.0).sum() == 5
+
+    def test_iso_week(self):
+        assert iso_week(date(2024, 9, 25)) == '2024-W39'
+        assert iso_week(date(2025, 1, 1)) == '2025-W01'
@@ -0,0 +1,81 @@
+"""Module providing tests for the flyer cache that lets unchanged stores be skipped."""
+
+from fetch_weekly_offers.utils.cache import FlyerCache, fingerprint_records
+from fetch_weekly_offers.utils.scraper import Scraper, VALIDITY_JS
+
+class FakeDriver:
+    """Stand-in for a WebDriver on a freshly loaded page, only answering the validity query."""
+
+    def __init__(self, validity):
+        self.validity = validity
+
+    def execute_script(self, script):
+        assert script == VALIDITY_JS
+        return self.validity
+
+class TestFlyerCache:
+
+    def setup_method(self):
+        self.url = 'https://example.com/a'
+        self.validity = [['2024-09-22T22:00:00.000Z'], ['2024-09-29T22:00:00.000Z']]
+
+    def test_fingerprints_are_only_saved_on_commit(self, tmp_path):
+        """Test that staged fingerprints are not used until they are committed, and survive a reload."""
+        path = str(tmp_path / 'cache.json')
+        cache = FlyerCache(path)
+        cache.stage(self.url, validity=self.validity)
+        assert not cache.is_unchanged(self.url, validity=self.validity)
+        cache.commit()
+        assert FlyerCache(path).is_unchanged(self.url, validity=self.validity)
+        assert not FlyerCache(path).is_unchanged(self.url, validity=[['2024-09-29T22:00:00.000Z'], []])
+
+    def test_empty_validity_never_matches(self, tmp_path):
+        """Test that a page where no offers had loaded yet is never taken as unchanged."""
+        cache = FlyerCache(str(tmp_path / 'cache.json'))
+        cache.stage(self.url, validity=[[], []])
+        cache.commit()
+        assert 'validity' not in cache.entries[self.url]
+        assert not cache.is_unchanged(self.url, validity=[[], []])
+        # Also when such a validity was saved by an earlier version
+        cache.entries[self.url]['validity'] = [[], []]
+        assert not cache.is_unchanged(self.url, validity=[[], []])
+
+    def test_fingerprint_ignores_order(self):
+        records = [{'Name': 'Grönkål', 'Price': '25 kr'}, {'Name': 'Rostbiff', 'Price': '149 kr'}]
+        assert fingerprint_records(records) == fingerprint_records(records[::-1])
+        assert fingerprint_records(records) != fingerprint_records(records[:1])
+
+    def test_scraper_stops_on_unchanged_validity(self, tmp_path):
+        """Test that the scraper reports an unchanged flyer right after the page loaded."""
+        cache = FlyerCache(str(tmp_path / 'cache.json'))
+        cache.stage(self.url, validity=self.validity)
+        cache.commit()
+
+        scraper = Scraper(self.url, cache=cache)
+        scraper.driver = FakeDriver(self.validity)
+        assert scraper.check_validity()
+        assert scraper.unchanged
+
+        scraper = Scraper(self.url, cache=cache)
+        scraper.driver = FakeDriver([['2024-09-29T22:00:00.000Z'], ['2024-10-06T22:00:00.000Z']])
+        assert not scraper.check_validity()
+        assert not scraper.unchanged
+
+        # Read before any offer rendered, also against a cache entry saved that way by an earlier version
+        cache.entries[self.url]['validity'] = [[], []]
+        scraper = Scraper(self.url, cache=cache)
+        scraper.driver = FakeDriver([[], []])
+        assert not scraper.check_validity()
+        assert cache.pending[self.url]['validity'] != [[], []]
+
+    def test_scraper_stops_on_unchanged_records(self, tmp_path):
+        """Test that a second scrape of the same page is reported as unchanged once the first was committed."""
+        cache = FlyerCache(str(tmp_path / 'cache.json'))
+        first = Scraper(self.url, replay_from='tests/offers_page_2024-09-25.html', cache=cache)
+        assert len(first.scrape()) == 40
+        assert not first.unchanged
+        cache.commit()
+
+        second = Scraper(self.url, replay_from='tests/offers_page_2024-09-25.html', cache=cache)
+        second.scrape()
+        assert second.unchanged
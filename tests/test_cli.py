@@ -0,0 +1,80 @@
+"""Module providing tests for the command line interface and the config file."""
+
+import json
+import subprocess
+import sys
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from fetch_weekly_offers.cli import main, build_parser, _settings
+from fetch_weekly_offers.config import DEFAULT_URLS, load_config
+
+class TestConfig:
+
+    def test_defaults_without_file(self, tmp_path, monkeypatch):
+        """Test that the defaults are used when there is no config file."""
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.delenv('WEEKLY_OFFERS_CONFIG', raising=False)
+        assert load_config()['urls'] == DEFAULT_URLS
+
+    def test_file_and_command_line(self, tmp_path):
+        """Test that the config file overrides the defaults and the command line overrides the file."""
+        path = tmp_path / 'config.json'
+        path.write_text(json.dumps({'urls': ['https://example.com/a'], 'db_url': 'sqlite:///a.db', 'workers': 3}))
+        args = build_parser().parse_args(['run', '--config', str(path), '--db-url', 'sqlite:///b.db'])
+        settings = _settings(args)
+        assert settings['urls'] == ['https://example.com/a']
+        assert settings['workers'] == 3
+        assert settings['db_url'] == 'sqlite:///b.db'
+        assert settings['load_mode'] == 'upsert'
+
+    def test_unknown_setting(self, tmp_path):
+        """Test that a misspelled setting is reported instead of silently ignored."""
+        path = tmp_path / 'config.json'
+        path.write_text(json.dumps({'db-url': 'sqlite:///a.db'}))
+        with pytest.raises(ValueError, match='db-url'):
+            load_config(str(path))
+
+class TestCommands:
+
+    def test_clean_then_load(self, tmp_path):
+        """Test that raw offers cleaned to a file load into the database with their schema."""
+        cleaned = str(tmp_path / 'cleaned.csv')
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        assert main(['clean', 'tests/offers_2024-09-25.csv', '--output', cleaned]) == 0
+        assert main(['load', cleaned, '--db-url', db_url]) == 0
+        saved = pd.read_sql('SELECT * FROM offers', create_engine(db_url))
+        assert len(saved) == len(pd.read_csv(cleaned))
+
+    def test_replay(self, tmp_path):
+        """Test that a saved page is replayed, cleaned and written without a browser."""
+        output = str(tmp_path / 'replayed.csv')
+        assert main(['replay', 'tests/offers_page_2024-09-25.html', '--output', output]) == 0
+        assert len(pd.read_csv(output)) == 37
+
+    def test_clean_imports_no_browser_or_database(self):
+        """Test that the clean command starts without loading Selenium, bs4 or SQLAlchemy."""
+        code = ('import sys, tempfile, os\n'
+                'from fetch_weekly_offers.cli import main\n'
+                'main(["clean", "tests/offers_2024-09-25.csv", "--output", os.path.join(tempfile.mkdtemp(), "c.csv")])\n'
+                'print("loaded:" + ",".join(m for m in ("selenium", "bs4", "sqlalchemy") if m in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        assert result.stdout.strip().splitlines()[-1] == 'loaded:'
+
+    def test_http_run_imports_no_browser(self):
+        """Test that a run in fetch mode 'http' builds no driver pool and never loads Selenium."""
+        code = ('import sys\n'
+                'from fetch_weekly_offers.run_weekly import run, run_streaming\n'
+                'run([], fetch_mode="http")\n'
+                'run_streaming([], fetch_mode="http")\n'
+                'print("loaded:" + ",".join(m for m in ("selenium",) if m in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        assert result.stdout.strip().splitlines()[-1] == 'loaded:'
+
+    def test_failed_run_exit_code(self, tmp_path, monkeypatch):
+        """Test that the run command exits with 1 when there are no offers to save."""
+        from fetch_weekly_offers import run_weekly
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.delenv('WEEKLY_OFFERS_CONFIG', raising=False)
+        monkeypatch.setattr(run_weekly, 'scrape_all', lambda urls, **kwargs: {url: pd.DataFrame() for url in urls})
+        assert main(['run', '--urls', 'https://example.com/a']) == 1
@@ -8,7 +8,8 @@ Two seperate test cases are then run:
 """
 
 import pandas as pd
-from fetch_weekly_offers.utils.cleaner import DataCleaner
+from fetch_weekly_offers.utils.cleaner import DataCleaner, OFFER_SCHEMA, validate_offers, concat_offers, clean_chunks
+from fetch_weekly_offers.utils.funcs import NATURAL_KEY
 from datetime import date
 import pytest
 
@@ -109,4 +110,74 @@ class TestInvalidData(GeneralDataCleanerTests):
         super().test_clean_details(self.test_data)
 
     def test_clean_datetime(self):
-        super().test_clean_datetime(self.test_data)
\ No newline at end of file
+        super().test_clean_datetime(self.test_data)
+
+# Class for testing the parsing of prices and details into numeric columns
+class TestParsing:
+    
+    def setup_method(self):
+        """Instantiating DataCleaner with examples of the price and details formats found on the site."""
+        data = [
+            {'Name': 'Grönkål', 'Price': '25\xa0kr', 'Details': '400 g•62,50\xa0kr/kg'},
+            {'Name': 'Kaffe', 'Price': '1\xa0099\xa0kr', 'Details': '2x1\xa0000 g• 89,50\xa0kr/kg'},
+            {'Name': 'Korv', 'Price': '2 för 50 kr', 'Details': '2 stycken• 25\xa0kr/var'},
+            {'Name': 'Fläskfilé', 'Price': '21,90\xa0kr', 'Details': '300-350 g• max 73\xa0kr/kg'},
+            {'Name': 'K-orv', 'Price': '25SEK', 'Details': None},
+        ]
+        self.test_data = DataCleaner(data)
+        self.test_data.convert_to_df()
+        
+    def test_clean_prices(self):
+        """Test that prices are parsed row by row and that a bad row does not stop the conversion."""
+        df = self.test_data.clean_prices()
+        assert df['Price'].tolist()[:4] == [25.0, 1099.0, 50.0, 21.9]
+        assert pd.isna(df['Price'].iloc[4])
+        assert df['MultiBuyCount'].tolist() == [1, 1, 2, 1, 1]
+        
+    def test_clean_details(self):
+        """Test that quantities and comparison prices are parsed into amounts and units."""
+        df = self.test_data.clean_details()
+        assert df['Quantity'].tolist()[:4] == ['400 g', '2x1\xa0000 g', '2 stycken', '300-350 g']
+        assert df['QuantityPieces'].tolist() == [1, 2, 1, 1, 1]
+        assert df['QuantityAmount'].tolist()[:4] == [400.0, 1000.0, 2.0, 300.0]
+        assert df['QuantityAmountMax'].iloc[3] == 350.0
+        assert df['QuantityUnit'].tolist()[:4] == ['g', 'g', 'st', 'g']
+        assert df['ComparisonPriceAmount'].tolist()[:4] == [62.5, 89.5, 25.0, 73.0]
+        assert df['ComparisonUnit'].tolist()[:4] == ['kg', 'kg', 'st', 'kg']
+        assert df.iloc[4][['Quantity', 'QuantityAmount', 'ComparisonPriceAmount']].isna().all()
+
+class TestSchema:
+
+    def setup_method(self):
+        self.records = pd.read_csv('tests/offers_2024-09-25.csv', keep_default_na=False).to_dict(orient='records')
+
+    def test_clean_returns_schema(self):
+        """Test that the cleaned offers have the columns and compact dtypes of the schema."""
+        df = DataCleaner(self.records).clean()
+        assert {column: str(dtype) for column, dtype in df.dtypes.items()} == OFFER_SCHEMA
+        assert df['ValidFrom'].iloc[0] == pd.Timestamp(2024, 9, 22)
+        validate_offers(df)
+
+    def test_validate_offers(self):
+        """Test that a frame with a missing column and a wrong dtype is rejected with both problems listed."""
+        df = DataCleaner(self.records).clean().drop(columns='Store').astype({'Price': 'object'})
+        with pytest.raises(ValueError, match='Price is object.*Store is missing'):
+            validate_offers(df)
+
+    def test_concat_offers_keeps_categories(self):
+        """Test that combining stores with different categories keeps the categorical columns."""
+        df = DataCleaner(self.records).clean()
+        other = df.assign(Store=pd.Categorical(['Hemköp'] * len(df)))
+        combined = concat_offers([df, pd.DataFrame(), other])
+        assert len(combined) == 2 * len(df)
+        validate_offers(combined)
+        assert set(combined['Store'].cat.categories) == {'ICA Maxi Stormarknad', 'Hemköp'}
+
+    def test_variants(self):
+        """Test that the offers a store lists under one name are numbered in order, also across chunks."""
+        df = DataCleaner(self.records).clean()
+        assert not df.duplicated(NATURAL_KEY).any()
+        assert df.loc[df['Name'] == 'Dammsugare', 'Variant'].tolist() == [0, 1, 2]
+        assert (df.loc[df['Name'] == 'Grönkål', 'Variant'] == 0).all()
+        chunked = concat_offers(list(clean_chunks([self.records], chunk_size=25)))
+        assert chunked['Variant'].tolist() == df['Variant'].tolist()
@@ -0,0 +1,109 @@
+"""Module providing tests for the DriverPool, using fake drivers instead of Chrome."""
+
+from selenium.webdriver.chrome.options import Options
+from fetch_weekly_offers.utils.driver import DriverPool, BLOCKED_URL_PATTERNS, _add_lean_options, block_urls
+
+class FakeSwitchTo:
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def new_window(self, kind):
+        self.driver.handles.append(f'tab-{len(self.driver.handles)}')
+        self.driver.current_window_handle = self.driver.handles[-1]
+
+    def window(self, handle):
+        self.driver.current_window_handle = handle
+
+class FakeDriver:
+    """Minimal stand-in for a Selenium WebDriver."""
+
+    def __init__(self, profile_dir):
+        self.profile_dir = profile_dir
+        self.handles = ['tab-0']
+        self.current_window_handle = 'tab-0'
+        self.switch_to = FakeSwitchTo(self)
+        self.quit_called = False
+        self.cookies_cleared = 0
+        self.cdp_commands = []
+
+    @property
+    def window_handles(self):
+        return list(self.handles)
+
+    def delete_all_cookies(self):
+        self.cookies_cleared += 1
+
+    def execute_script(self, script):
+        return None
+
+    def execute_cdp_cmd(self, command, params):
+        self.cdp_commands.append((self.current_window_handle, command, params))
+
+    def close(self):
+        self.handles.remove(self.current_window_handle)
+
+    def quit(self):
+        self.quit_called = True
+
+class TestDriverPool:
+
+    def setup_method(self):
+        self.started = []
+
+    def factory(self, profile_dir):
+        driver = FakeDriver(profile_dir)
+        self.started.append(driver)
+        return driver
+
+    def test_reuses_warm_browser(self):
+        """Test that a released browser is reset and handed out again instead of starting a new one."""
+        with DriverPool(size=1, max_pages=10, driver_factory=self.factory) as pool:
+            first = pool.acquire()
+            pool.release(first)
+            second = pool.acquire()
+            pool.release(second)
+        assert first is second
+        assert len(self.started) == 1
+        assert first.cookies_cleared == 2
+        assert len(first.handles) == 1
+
+    def test_recycles_after_max_pages(self):
+        """Test that a browser is quit and replaced after max_pages pages."""
+        with DriverPool(size=1, max_pages=2, driver_factory=self.factory) as pool:
+            for _ in range(3):
+                pool.release(pool.acquire())
+        assert len(self.started) == 2
+        assert self.started[0].quit_called
+
+    def test_recycles_broken_browser(self):
+        """Test that a browser returned as broken is never reused."""
+        with DriverPool(size=1, driver_factory=self.factory) as pool:
+            broken = pool.acquire()
+            pool.release(broken, broken=True)
+            fresh = pool.acquire()
+            pool.release(fresh)
+        assert broken is not fresh
+        assert broken.quit_called
+        assert broken.profile_dir != fresh.profile_dir
+
+class TestLeanProfile:
+
+    def test_options(self):
+        """Test that the lean profile runs headless with images blocked and a capped viewport and cache."""
+        chrome_options = Options()
+        _add_lean_options(chrome_options)
+        assert '--headless=new' in chrome_options.arguments
+        assert any(argument.startswith('--window-size=') for argument in chrome_options.arguments)
+        assert any(argument.startswith('--disk-cache-size=') for argument in chrome_options.arguments)
+        assert chrome_options.experimental_options['prefs']['profile.managed_default_content_settings.images'] == 2
+
+    def test_blocking_survives_reset(self):
+        """Test that the URL blocking is applied again to the fresh tab a pooled browser gets between pages."""
+        with DriverPool(size=1, driver_factory=FakeDriver) as pool:
+            driver = pool.acquire()
+            block_urls(driver)
+            pool.release(driver)
+        blocked = [(tab, params['urls']) for tab, command, params in driver.cdp_commands
+                   if command == 'Network.setBlockedURLs']
+        assert blocked == [('tab-0', BLOCKED_URL_PATTERNS), ('tab-1', BLOCKED_URL_PATTERNS)]
@@ -0,0 +1,148 @@
+"""Module providing tests for saving data to SQL, run against a local SQLite database."""
+
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from fetch_weekly_offers.utils.cleaner import DataCleaner
+from fetch_weekly_offers.utils.funcs import save_to_sql, get_db_url, write_atomic, DB_URL_ENV_VAR
+
+def make_offers(rows):
+    df = pd.DataFrame(rows, columns=['Name', 'Price', 'Store', 'ValidFrom', 'ValidThrough'])
+    # Numbered like the cleaner numbers the offers a store lists under the same name
+    return df.assign(Variant=df.groupby(['Store', 'Name', 'ValidFrom']).cumcount())
+
+class TestSaveToSql:
+
+    def setup_method(self):
+        self.first_week = make_offers([
+            ('Grönkål', 25.0, 'ICA Maxi Stormarknad', '2024-09-22', '2024-09-29'),
+            ('Rostbiff', 149.0, 'ICA Maxi Stormarknad', '2024-09-22', '2024-09-29'),
+            ('Rostbiff', 139.0, 'Hemköp', '2024-09-22', '2024-09-29'),
+        ])
+
+    def read(self, db_url):
+        engine = create_engine(db_url)
+        return pd.read_sql('SELECT * FROM offers ORDER BY Store, Name, ValidFrom', engine)
+
+    def test_replace(self, tmp_path):
+        """Test that the default mode rewrites the table with only the new data."""
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        save_to_sql(self.first_week, db_url=db_url)
+        save_to_sql(self.first_week.head(1), db_url=db_url)
+        assert len(self.read(db_url)) == 1
+
+    def test_upsert(self, tmp_path):
+        """Test that upsert keeps history, updates changed offers and only inserts new ones."""
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        save_to_sql(self.first_week, db_url=db_url, mode='upsert')
+
+        second_week = make_offers([
+            ('Grönkål', 25.0, 'ICA Maxi Stormarknad', '2024-09-22', '2024-10-06'),
+            ('Rostbiff', 139.0, 'Hemköp', '2024-09-22', '2024-09-29'),
+            ('Rostbiff', 159.0, 'ICA Maxi Stormarknad', '2024-09-29', '2024-10-06'),
+        ])
+        save_to_sql(second_week, db_url=db_url, mode='upsert')
+
+        saved = self.read(db_url)
+        assert len(saved) == 4
+        assert saved.loc[saved['Name'] == 'Grönkål', 'ValidThrough'].tolist() == ['2024-10-06']
+        assert saved.loc[saved['Name'] == 'Rostbiff', 'Price'].tolist() == [139.0, 149.0, 159.0]
+
+    def test_upsert_updates_price(self, tmp_path):
+        """Test that a new price updates the offer instead of adding a second one, and that an offer
+        whose price could not be parsed is saved as well.
+        """
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        save_to_sql(self.first_week, db_url=db_url, mode='upsert')
+        cheaper = self.first_week.copy()
+        cheaper.loc[0, 'Price'] = 19.9
+        cheaper.loc[1, 'Price'] = float('nan')
+        save_to_sql(cheaper, db_url=db_url, mode='upsert')
+        saved = self.read(db_url)
+        assert len(saved) == 3
+        assert saved.loc[saved['Name'] == 'Grönkål', 'Price'].tolist() == [19.9]
+        assert saved.loc[(saved['Name'] == 'Rostbiff') & (saved['Store'] == 'ICA Maxi Stormarknad'), 'Price'].isna().all()
+
+    def test_upsert_keeps_offers_sharing_a_name(self, tmp_path):
+        """Test that offers a store lists under the same name in the same week are all saved, also when
+        the same data is upserted again.
+        """
+        raw_data = pd.read_csv('tests/offers_2024-09-25.csv', keep_default_na=False).to_dict(orient='records')
+        cleaned = DataCleaner(raw_data).clean()
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        for _ in range(2):
+            assert save_to_sql(cleaned, db_url=db_url, mode='upsert')
+            saved = self.read(db_url)
+            assert len(saved) == len(cleaned)
+        assert sorted(saved.loc[saved['Name'] == 'Airfryer', 'Price']) == [799.0, 999.0]
+        assert (saved['Name'] == 'Dammsugare').sum() == 3
+
+    def test_upsert_leaves_keys_shared_in_table(self, tmp_path):
+        """Test that an offer matching several rows of the table does not overwrite them all with its values."""
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        shared = make_offers([
+            ('Grönkål', 25.0, 'ICA Maxi Stormarknad', '2024-09-22', '2024-09-29'),
+            ('Grönkål', 25.0, 'ICA Maxi Stormarknad', '2024-09-22', '2024-10-06'),
+        ]).assign(Variant=0)
+        assert save_to_sql(shared, db_url=db_url, mode='upsert')
+        assert save_to_sql(shared.iloc[:1].assign(ValidThrough='2024-10-13'), db_url=db_url, mode='upsert')
+        assert sorted(self.read(db_url)['ValidThrough']) == ['2024-09-29', '2024-10-06']
+
+    def test_key_columns_can_be_indexed(self, tmp_path):
+        """Test that the text key columns get a bounded length instead of the unbounded default."""
+        from sqlalchemy import inspect
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        for mode in ('replace', 'upsert'):
+            assert save_to_sql(self.first_week, db_url=db_url, table_name=mode, mode=mode)
+            columns = {column['name']: column['type'] for column in inspect(create_engine(db_url)).get_columns(mode)}
+            assert columns['Name'].length == columns['Store'].length == 255
+
+    def test_upsert_adds_new_columns(self, tmp_path):
+        """Test that columns added to the cleaned data are added to an existing table."""
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        save_to_sql(self.first_week, db_url=db_url, mode='upsert')
+        with_unit = self.first_week.assign(ComparisonUnit='kg')
+        save_to_sql(with_unit, db_url=db_url, mode='upsert')
+        assert self.read(db_url)['ComparisonUnit'].tolist() == ['kg', 'kg', 'kg']
+
+    def test_db_url_from_environment(self, monkeypatch):
+        """Test that the database URL can be configured without changing the code."""
+        monkeypatch.setenv(DB_URL_ENV_VAR, 'sqlite:///offers.db')
+        assert get_db_url() == 'sqlite:///offers.db'
+        assert get_db_url('sqlite://') == 'sqlite://'
+        monkeypatch.delenv(DB_URL_ENV_VAR)
+        assert get_db_url().startswith('mssql+pyodbc://MSI/WeeklyOffers')
+
+class TestWriteAtomic:
+
+    def test_interrupted_write_keeps_file(self, tmp_path):
+        """Test that a write that fails halfway leaves the previous file untouched."""
+        path = str(tmp_path / 'state.json')
+        write_atomic(path, lambda file: file.write('{"urls": {}}'))
+
+        def interrupted(file):
+            file.write('{"urls": {"https://example.com": ')
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            write_atomic(path, interrupted)
+        with open(path, encoding='utf-8') as file:
+            assert file.read() == '{"urls": {}}'
+        assert os.listdir(tmp_path) == ['state.json']
+
+    def test_concurrent_writers(self, tmp_path):
+        """Test that writers of the same file each use their own temporary file."""
+        path = str(tmp_path / 'state.json')
+        temp_paths = []
+
+        def nested(file):
+            temp_paths.append(file.name)
+            write_atomic(path, lambda inner: temp_paths.append(inner.name) or inner.write('inner'))
+            file.write('outer')
+
+        write_atomic(path, nested)
+        assert temp_paths[0] != temp_paths[1]
+        with open(path, encoding='utf-8') as file:
+            assert file.read() == 'outer'
+        assert os.listdir(tmp_path) == ['state.json']
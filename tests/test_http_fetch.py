@@ -0,0 +1,116 @@
+"""Module providing tests for the browserless HTTP fetch mode, against a local stand-in HTTP server."""
+
+import json
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+import pytest
+from fetch_weekly_offers.utils.http_fetch import HttpFetcher, JsonLdExtractor
+from fetch_weekly_offers.utils.scraper import Scraper
+
+JSON_LD_OFFERS = {
+    '@context': 'https://schema.org',
+    '@type': 'ItemList',
+    'numberOfItems': 3,
+    'itemListElement': [
+        {'@type': 'Product', 'name': 'Kaffe', 'offers': {
+            '@type': 'Offer', 'price': '49.90', 'priceCurrency': 'SEK',
+            'eligibleQuantity': {'value': 450, 'unitText': 'g'},
+            'priceSpecification': {'@type': 'UnitPriceSpecification', 'price': '110.89',
+                                   'referenceQuantity': {'value': 1, 'unitText': 'kg'}},
+            'seller': {'@type': 'Organization', 'name': 'Hemköp'},
+            'validFrom': '2024-09-23T00:00:00+02:00', 'validThrough': '2024-09-29T23:59:59+02:00',
+            'priceValidUntil': '2024-09-29'}},
+        {'@type': 'Offer', 'itemOffered': {'name': 'Bananer'}, 'price': 22,
+         'seller': {'name': 'Hemköp'}},
+        {'@type': 'Offer', 'itemOffered': {'name': 'Utan pris'}},
+    ],
+}
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server(tmp_path):
+    """Serves the captured offer page and JSON-LD pages from a temporary directory."""
+    with open('tests/offers_page_2024-09-25.html', encoding='utf-8') as file:
+        markup = file.read()
+    (tmp_path / 'markup.html').write_text(markup, encoding='utf-8')
+    # The same offers, on a page that says its list holds the 41 offer items it has
+    (tmp_path / 'counted.html').write_text(
+        markup.replace('<body', '<meta itemprop="numberOfItems" content="41"><body', 1), encoding='utf-8')
+    for name, listed in (('jsonld.html', 3), ('partial.html', 167)):
+        (tmp_path / name).write_text(
+            '<html><head><script type="application/ld+json">'
+            f'{json.dumps({**JSON_LD_OFFERS, "numberOfItems": listed})}</script></head>'
+            '<body><div id="app"></div></body></html>', encoding='utf-8')
+    (tmp_path / 'empty.html').write_text('<html><body><div id="app"></div></body></html>', encoding='utf-8')
+    httpd = HTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(tmp_path)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+class TestJsonLdExtractor:
+
+    def test_maps_offers_to_records(self):
+        """Test that schema.org offers are mapped to the record shape of the other extraction backends."""
+        extractor = JsonLdExtractor()
+        offers = extractor.find_offers(f'<script type="application/ld+json">{json.dumps(JSON_LD_OFFERS)}</script>')
+        assert len(offers) == 3
+        assert extractor.extract_offer(offers[0]) == {
+            'Name': 'Kaffe', 'Price': '49,90 kr', 'Details': '450 g•110,89 kr/kg', 'Store': 'Hemköp',
+            'ValidFrom': '2024-09-23T00:00:00+02:00', 'ValidThrough': '2024-09-29T23:59:59+02:00',
+            'ValidUntil': '2024-09-29'}
+        assert extractor.extract_offer(offers[1])['Price'] == '22 kr'
+        with pytest.raises(ValueError):
+            extractor.extract_offer(offers[2])
+
+class TestHttpFetchMode:
+
+    def test_markup_in_server_response(self, server):
+        """Test that offers in the markup of the server response are extracted like in replay mode."""
+        with HttpFetcher() as fetcher:
+            scraper = Scraper(f'{server}/markup.html', fetch_mode='http', fetcher=fetcher)
+            data = scraper.scrape()
+        replayed = Scraper('replay', replay_from='tests/offers_page_2024-09-25.html').scrape()
+        assert scraper.fetched_with == 'http'
+        assert data == replayed
+        assert len(data) == 40
+
+    def test_json_ld_in_server_response(self, server):
+        """Test that the JSON-LD data is used when the markup holds no offers."""
+        scraper = Scraper(f'{server}/jsonld.html', fetch_mode='http')
+        data = scraper.scrape()
+        assert scraper.extractor.name == 'jsonld'
+        assert [record['Name'] for record in data] == ['Kaffe', 'Bananer']
+
+    def test_auto_falls_back_to_browser(self, server, monkeypatch):
+        """Test that auto mode only keeps the server response when it holds the complete offer list."""
+        loaded = []
+        monkeypatch.setattr(Scraper, 'load_page', lambda self: loaded.append(self.url))
+        for page in ('counted.html', 'jsonld.html'):
+            scraper = Scraper(f'{server}/{page}', fetch_mode='auto')
+            scraper.fetch_page()
+            assert scraper.fetched_with == 'http'
+        assert loaded == []
+        for page in ('empty.html', 'markup.html', 'partial.html'):
+            scraper = Scraper(f'{server}/{page}', fetch_mode='auto')
+            scraper.fetch_page()
+            assert scraper.fetched_with == 'browser'
+        assert loaded == [f'{server}/empty.html', f'{server}/markup.html', f'{server}/partial.html']
+
+    def test_http_mode_keeps_partial_list(self, server):
+        """Test that http mode, which has no browser to fall back to, keeps the offers of a partial list."""
+        scraper = Scraper(f'{server}/partial.html', fetch_mode='http')
+        assert [record['Name'] for record in scraper.scrape()] == ['Kaffe', 'Bananer']
+        assert scraper.fetched_with == 'http'
+
+    def test_http_mode_does_not_fall_back(self, server, monkeypatch):
+        """Test that http mode never starts a browser, also when the request fails."""
+        monkeypatch.setattr(Scraper, 'load_page', lambda self: pytest.fail('The browser was started.'))
+        scraper = Scraper(f'{server}/missing.html', fetch_mode='http', fetcher=HttpFetcher(retries=0))
+        assert scraper.scrape() == []
+        assert scraper.fetched_with is None
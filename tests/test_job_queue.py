@@ -0,0 +1,137 @@
+"""Module providing tests for the job queue, its workers and the coordinator.
+
+The workers run in separate processes like they would on separate hosts, and replay a saved page
+with the Scraper and the DataCleaner instead of opening a browser.
+"""
+
+import multiprocessing
+import os
+import pickle
+import time
+import pandas as pd
+import pytest
+from sqlalchemy import update
+from fetch_weekly_offers.utils.cleaner import DataCleaner
+from fetch_weekly_offers.utils.job_queue import JobQueue, coordinate, run_worker
+from fetch_weekly_offers.utils.scraper import Scraper
+
+PAGE = 'tests/offers_page_2024-09-25.html'
+
+def replay_process(url):
+    """Stand-in for process_url that scrapes and cleans the saved page for every URL."""
+    cleaned_data = DataCleaner(Scraper(url, replay_from=PAGE).scrape()).clean()
+    cleaned_data['Name'] = cleaned_data['Name'] + ' ' + url
+    return cleaned_data
+
+def crashing_process(url):
+    """Stand-in for a worker host that dies in the middle of a job."""
+    os._exit(1)
+
+def start_workers(queue_url, count, process, **options):
+    workers = [multiprocessing.Process(target=run_worker, args=(queue_url,),
+                                       kwargs={'worker_id': f'worker-{i}', 'process': process, **options})
+               for i in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+class TestJobQueue:
+
+    def setup_method(self):
+        self.urls = ['https://example.com/a', 'https://example.com/b']
+
+    def test_claim_is_exclusive(self, tmp_path):
+        """Test that every job is handed to one worker only and that enqueuing a URL twice adds one job."""
+        queue = JobQueue(f'sqlite:///{tmp_path / "queue.db"}')
+        run_id = queue.enqueue(self.urls + self.urls[:1])
+        assert queue.counts(run_id)['pending'] == 2
+        first, second = queue.claim('w1'), queue.claim('w2')
+        assert {first['url'], second['url']} == set(self.urls)
+        assert queue.claim('w3') is None
+
+        assert queue.complete(first['id'], 'w1', pd.DataFrame({'Name': ['x']}))
+        assert not queue.complete(second['id'], 'w1', pd.DataFrame())
+        assert queue.counts(run_id) == {'pending': 0, 'running': 1, 'done': 1, 'failed': 0}
+        assert queue.results(run_id)[first['url']]['Name'].tolist() == ['x']
+
+    def test_results_are_not_unpickled(self, tmp_path):
+        """Test that results are stored as JSON and that a pickle written to the queue is never loaded."""
+        queue = JobQueue(f'sqlite:///{tmp_path / "queue.db"}')
+        run_id = queue.enqueue(self.urls[:1])
+        job = queue.claim('w1')
+        df = pd.DataFrame({'Name': ['x'], 'Price': [19.9], 'ValidFrom': pd.to_datetime(['2024-09-23'])})
+        assert queue.complete(job['id'], 'w1', df)
+        pd.testing.assert_frame_equal(queue.results(run_id)[job['url']], df)
+
+        with queue.engine.begin() as connection:
+            connection.execute(update(queue.jobs).values(result=pickle.dumps(df)))
+        with pytest.raises(ValueError):
+            queue.results(run_id)
+
+    def test_failed_jobs_are_retried_then_given_up(self, tmp_path):
+        """Test that a failed job goes back to the queue until it used all its attempts."""
+        queue = JobQueue(f'sqlite:///{tmp_path / "queue.db"}', max_attempts=2)
+        run_id = queue.enqueue(self.urls[:1])
+        for _ in range(2):
+            job = queue.claim('w1')
+            queue.fail(job['id'], 'w1', RuntimeError('Chrome crashed'))
+        assert queue.claim('w1') is None
+        assert queue.failures(run_id) == {self.urls[0]: 'Chrome crashed'}
+
+    def test_expired_lease(self, tmp_path):
+        """Test that a job whose lease ran out goes to the next worker and the late result is dropped."""
+        queue = JobQueue(f'sqlite:///{tmp_path / "queue.db"}')
+        queue.enqueue(self.urls[:1])
+        job = queue.claim('w1', lease=0.1)
+        assert queue.claim('w2') is None
+        time.sleep(0.2)
+        retry = queue.claim('w2')
+        assert retry['id'] == job['id'] and retry['attempts'] == 2
+        assert not queue.heartbeat(job['id'], 'w1')
+        assert not queue.complete(job['id'], 'w1', pd.DataFrame())
+
+class TestWorkers:
+
+    def setup_method(self):
+        self.urls = [f'https://example.com/store-{i}' for i in range(4)]
+        self.saved = []
+
+    def test_several_worker_processes(self, tmp_path):
+        """Test that worker processes share the jobs and the coordinator saves all results at once."""
+        queue_url = f'sqlite:///{tmp_path / "queue.db"}'
+        run_id = JobQueue(queue_url).enqueue(self.urls)
+        workers = start_workers(queue_url, 3, replay_process, run_id=run_id, poll_interval=0.1)
+        counts = coordinate(self.urls, queue_url=queue_url, run_id=run_id, poll_interval=0.1, timeout=60,
+                            writer=self.saved.append)
+        for worker in workers:
+            worker.join()
+        assert counts['done'] == 4 and counts['failed'] == 0
+        assert len(self.saved) == 1
+        assert len(self.saved[0]) == 4 * 37
+        assert str(self.saved[0]['Store'].dtype) == 'category'
+        assert JobQueue(queue_url).results(run_id) == {}
+
+    def test_crashed_worker(self, tmp_path):
+        """Test that the job of a crashed worker is finished by another worker once its lease runs out."""
+        queue_url = f'sqlite:///{tmp_path / "queue.db"}'
+        run_id = JobQueue(queue_url).enqueue(self.urls[:2])
+        crashed = start_workers(queue_url, 1, crashing_process, run_id=run_id, lease=1.0)[0]
+        crashed.join()
+        assert crashed.exitcode == 1
+        assert JobQueue(queue_url).counts(run_id)['running'] == 1
+
+        workers = start_workers(queue_url, 2, replay_process, run_id=run_id, lease=1.0, poll_interval=0.1,
+                                max_idle=5.0)
+        counts = coordinate(self.urls[:2], queue_url=queue_url, run_id=run_id, poll_interval=0.1, timeout=60,
+                            writer=self.saved.append)
+        for worker in workers:
+            worker.join()
+        assert counts['done'] == 2
+        assert len(self.saved[0]) == 2 * 37
+
+    def test_wait_timeout(self, tmp_path):
+        """Test that the coordinator gives up when no worker takes the jobs."""
+        with pytest.raises(TimeoutError):
+            coordinate(self.urls, queue_url=f'sqlite:///{tmp_path / "queue.db"}', poll_interval=0.1, timeout=0.3,
+                       writer=self.saved.append)
+        assert self.saved == []
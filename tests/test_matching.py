@@ -0,0 +1,84 @@
+"""Module providing tests for the cross-store product matching."""
+
+import pandas as pd
+from fetch_weekly_offers.utils.cleaner import DataCleaner
+from fetch_weekly_offers.utils.matching import ProductIndex, normalize_name, cheapest_store, price_changes
+
+def offers(rows):
+    """Returns cleaned offers for (name, price, details, store, valid from) tuples."""
+    return DataCleaner([{'Name': name, 'Price': price, 'Details': details, 'Store': store, 'ValidFrom': valid_from,
+                         'ValidThrough': valid_from, 'ValidUntil': valid_from}
+                        for name, price, details, store, valid_from in rows]).clean()
+
+class TestMatching:
+
+    def test_normalize_name(self):
+        """Test that sizes, packaging words, punctuation, case and word order do not change the key."""
+        assert normalize_name('Kaffe Gevalia 450 g') == normalize_name('gevalia, KAFFE')
+        assert normalize_name('Läsk 4x1,5 l') == 'läsk'
+        assert normalize_name('Grönkålsblad i påse') == 'grönkålsblad'
+
+    def test_match_across_stores(self):
+        """Test that name variants get one ID, and that names that only share a word do not."""
+        index = ProductIndex(None)
+        kaffe = index.match('Kaffe Gevalia 450 g')
+        assert index.match('Gevalia kaffe') == kaffe
+        assert index.match('Gevalia kafe') == kaffe
+        assert index.match('Kaffebryggare') != kaffe
+        assert index.lookup('Dammsugare') is None
+        assert len(index) == 2
+
+    def test_blocking(self):
+        """Test that a name is only compared with the products it shares trigrams with."""
+        index = ProductIndex(None)
+        for name in pd.read_csv('tests/offers_2024-09-25.csv')['Name'].unique():
+            index.match(name)
+        candidates = index.candidates(normalize_name('Kaffe'))
+        assert 0 < len(candidates) < len(index) / 4
+
+    def test_ids_persist_across_runs(self, tmp_path):
+        """Test that a saved index gives the same IDs on the next run and keeps numbering after them."""
+        path = str(tmp_path / 'products.json')
+        index = ProductIndex(path)
+        ids = [index.match(name) for name in ['Rostbiff', 'Bacon', 'Lövbiff']]
+        index.save()
+        reloaded = ProductIndex(path)
+        assert [reloaded.match(name) for name in ['Lövbiff', 'Bacon', 'Rostbiff']] == ids[::-1]
+        assert reloaded.match('Kockkniv') == max(ids) + 1
+
+class TestQueries:
+
+    def setup_method(self):
+        self.index = ProductIndex(None)
+        self.history = self.index.assign(offers([
+            ('Kaffe Gevalia 450 g', '49,90 kr', '450 g•110,89 kr/kg', 'ICA Maxi Stormarknad', '2024-09-23'),
+            ('Gevalia kaffe', '54 kr', '500 g•108 kr/kg', 'Hemköp', '2024-09-23'),
+            ('Gevalia Kaffe', '59 kr', '450 g•131,11 kr/kg', 'ICA Supermarket', '2024-09-23'),
+            ('Kaffe Gevalia 450 g', '55 kr', '450 g•122,22 kr/kg', 'ICA Maxi Stormarknad', '2024-09-16'),
+            ('Bacon', '25 kr', '140 g', 'Hemköp', '2024-09-23'),
+        ]))
+
+    def test_cheapest_store(self):
+        """Test that the latest offers are ranked on the comparison price."""
+        result = cheapest_store(self.history, 'kaffe gevalia', index=self.index)
+        assert result['Store'].tolist() == ['Hemköp', 'ICA Maxi Stormarknad', 'ICA Supermarket']
+        assert cheapest_store(self.history, 999).empty
+
+    def test_cheapest_store_with_different_start_days(self):
+        """Test that every store's latest offer is compared, also when the stores start them on different days."""
+        history = self.index.assign(offers([
+            ('Kaffe Gevalia 450 g', '20 kr', '', 'Hemköp', '2024-09-22'),
+            ('Kaffe Gevalia 450 g', '30 kr', '', 'ICA Maxi Stormarknad', '2024-09-23'),
+            ('Kaffe Gevalia 450 g', '25 kr', '', 'ICA Maxi Stormarknad', '2024-09-16'),
+        ]))
+        result = cheapest_store(history, 'kaffe gevalia', index=self.index)
+        assert result['Store'].tolist() == ['Hemköp', 'ICA Maxi Stormarknad']
+        assert result['Price'].tolist() == [20.0, 30.0]
+
+    def test_price_changes(self):
+        """Test the week-over-week price change per product and store."""
+        changes = price_changes(self.history)
+        maxi = changes[(changes['Store'] == 'ICA Maxi Stormarknad')]
+        assert maxi['Price'].tolist() == [55.0, 49.9]
+        assert pd.isna(maxi['PriceChange'].iloc[0])
+        assert round(maxi['PriceChange'].iloc[1], 2) == -5.1
@@ -0,0 +1,81 @@
+"""Module providing tests for the metrics instrumentation."""
+
+import json
+import threading
+import pandas as pd
+from fetch_weekly_offers.utils.metrics import Metrics, metrics
+from fetch_weekly_offers.utils.cleaner import DataCleaner, CLEANING_STEPS
+
+class TestMetrics:
+
+    def test_disabled_is_no_op(self, tmp_path):
+        """Test that nothing is recorded while metrics are disabled."""
+        recorder = Metrics()
+        with recorder.stage('scrape.parse') as stage:
+            stage.set(rows=10)
+        recorder.record('scrape.extract', rows=10)
+        assert recorder.records == []
+        assert recorder.write_summary() == {}
+
+    def test_stages_are_written(self, tmp_path):
+        """Test that stages are written as JSON lines, nested stages inherit the url and a summary is added."""
+        path = tmp_path / 'metrics.jsonl'
+        recorder = Metrics()
+        recorder.enable(str(path))
+        try:
+            with recorder.stage('process_url', url='https://example.com/a'):
+                with recorder.stage('scrape.parse') as stage:
+                    data = [bytearray(1024 ** 2)]
+                    stage.set(rows=len(data))
+            summary = recorder.write_summary()
+        finally:
+            recorder.disable()
+
+        lines = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+        assert [line['stage'] for line in lines] == ['scrape.parse', 'process_url', 'summary']
+        assert lines[0]['url'] == 'https://example.com/a'
+        assert lines[0]['rows'] == 1
+        assert lines[0]['peak_mb'] >= 1
+        assert lines[1]['peak_mb'] >= lines[0]['peak_mb']
+        assert summary['scrape.parse']['count'] == 1
+
+    def test_memory_of_concurrent_stages(self):
+        """Test that no peak memory is recorded for stages that overlap with a stage in another thread,
+        since tracemalloc measures the whole process, and that it is recorded again once they are done.
+        """
+        recorder = Metrics()
+        recorder.enable(None)
+        both_started = threading.Barrier(2)
+
+        def scrape(url):
+            with recorder.stage('process_url', url=url):
+                with recorder.stage('scrape.parse'):
+                    both_started.wait(timeout=10)
+                    bytearray(1024 ** 2)
+
+        try:
+            threads = [threading.Thread(target=scrape, args=(f'https://example.com/{i}',)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with recorder.stage('save_to_sql'):
+                bytearray(1024 ** 2)
+        finally:
+            recorder.disable()
+
+        assert len(recorder.records) == 5
+        assert all('peak_mb' not in record for record in recorder.records[:4])
+        assert recorder.records[4]['peak_mb'] >= 1
+
+    def test_cleaner_is_instrumented(self, tmp_path):
+        """Test that every cleaning step is recorded with its row count."""
+        raw_data = pd.read_csv('tests/offers_2024-09-25.csv').to_dict(orient='records')
+        metrics.enable(str(tmp_path / 'metrics.jsonl'), track_memory=False)
+        try:
+            DataCleaner(raw_data).clean()
+            summary = metrics.summary()
+        finally:
+            metrics.disable()
+        assert [f'clean.{step}' for step in CLEANING_STEPS] == list(summary)
+        assert summary['clean.convert_to_df']['rows'] == len(raw_data)
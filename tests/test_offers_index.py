@@ -0,0 +1,140 @@
+"""Module providing tests for the in-memory offers index."""
+
+import json
+from datetime import date
+import threading
+import urllib.error
+import urllib.request
+import pandas as pd
+import pytest
+from fetch_weekly_offers.utils.cleaner import DataCleaner, concat_offers
+from fetch_weekly_offers.utils.funcs import save_to_sql
+from fetch_weekly_offers.utils.offers_index import OffersIndex, archive_loader, make_server, sql_loader
+
+def next_week(df, days=7):
+    """Returns the offers moved one week ahead, as the next run would scrape them."""
+    df = df.copy()
+    for column in ['ValidFrom', 'ValidThrough', 'ValidUntil']:
+        df[column] = df[column] + pd.Timedelta(days=days)
+    return df
+
+class TestOffersIndex:
+
+    def setup_method(self):
+        raw_data = pd.read_csv('tests/offers_2024-09-25.csv', keep_default_na=False).to_dict(orient='records')
+        self.df = DataCleaner(raw_data).clean()
+        self.index = OffersIndex(history=True)
+        self.index.add(self.df)
+
+    def test_keeps_offers_sharing_a_name(self):
+        """Test that every cleaned offer is indexed, also the offers a store lists under the same name."""
+        assert len(self.index) == len(self.df)
+        assert len(self.index.query(keyword='dammsugare')) == 3
+        assert sorted(self.index.query(keyword='airfryer')['Price']) == [799, 999]
+
+    def test_replaces_duplicates(self):
+        """Test that an offer added again replaces the indexed one, like the upsert updates it."""
+        changed = self.df.copy()
+        changed['ValidThrough'] = changed['ValidThrough'] + pd.Timedelta(days=7)
+        self.index.add(changed)
+        assert len(self.index) == len(self.df)
+        assert self.index.query()['ValidThrough'].tolist() == changed['ValidThrough'].tolist()
+
+    def test_unit_price_at_store(self):
+        """Test a query for all offers under a price per kg at a store, cheapest first."""
+        result = self.index.query(store='ica maxi stormarknad', unit='kg', max_unit_price=100)
+        expected = self.df[(self.df['ComparisonUnit'] == 'kg') & (self.df['ComparisonPriceAmount'] <= 100)]
+        assert len(result) == len(expected) > 0
+        assert result['ComparisonPriceAmount'].is_monotonic_increasing
+        assert self.index.query(store='Hemköp', unit='kg', max_unit_price=100).empty
+
+    def test_keyword(self):
+        """Test that a keyword finds the names with words that contain it, also in compound words."""
+        names = set(self.index.query(keyword='KAFFE')['Name'])
+        assert names == {'Kaffebryggare', 'Kaffe', 'Iskaffe', 'Snabbkaffe refill'}
+        assert set(self.index.query(keyword='snabbkaffe refill')['Name']) == {'Snabbkaffe refill'}
+        assert self.index.query(keyword='gräsklippare').empty
+
+    def test_price_filter_needs_unit(self):
+        """Test that a unit price filter without a unit is reported instead of mixing kg, l and pieces."""
+        with pytest.raises(ValueError, match='unit'):
+            self.index.query(max_unit_price=100)
+
+    def test_expire(self):
+        """Test that offers that are no longer valid are dropped and the rest is still found."""
+        self.index.add(next_week(self.df))
+        both_weeks = pd.concat([self.df, next_week(self.df)])
+        assert self.index.expire(day='2024-10-01') == (both_weeks['ValidThrough'] < '2024-10-01').sum()
+        assert len(self.index) == (both_weeks['ValidThrough'] >= '2024-10-01').sum()
+        assert (self.index.query(unit='kg')['ValidThrough'] >= pd.Timestamp('2024-10-01')).all()
+        active = (both_weeks['ValidFrom'] <= '2024-10-02') & (both_weeks['ValidThrough'] >= '2024-10-02')
+        assert len(self.index.query(active_on='2024-10-02')) == active.sum()
+
+    def test_incremental_refresh(self, tmp_path):
+        """Test that a refresh only loads the offers saved since the previous refresh."""
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        history = next_week(self.df, days=-28)
+        assert save_to_sql(concat_offers([history, self.df]), db_url=db_url, mode='replace')
+        index = OffersIndex(sql_loader(db_url), history=True)
+        assert index.refresh(day='2024-09-25') == len(self.df) * 2
+        assert str(index.offers['Store'].dtype) == 'category'
+        first_watermark = index.watermark
+        assert first_watermark is not None
+
+        new_run = next_week(self.df)
+        assert save_to_sql(new_run, db_url=db_url, mode='upsert')
+        assert index.refresh(day='2024-10-02') == len(new_run)
+        assert len(index) == len(self.df) * 3
+        assert index.watermark > first_watermark
+        assert len(index.query(keyword='kaffe', active_on='2024-10-02')) > 0
+
+        # Saving the same run again changes no rows, so there is nothing new to load
+        assert save_to_sql(new_run, db_url=db_url, mode='upsert')
+        assert index.refresh(day='2024-10-02') == 0
+
+        # Only the offer that changed is loaded and it replaces the indexed one
+        new_run.loc[0, 'ValidThrough'] = pd.Timestamp('2024-10-20')
+        assert save_to_sql(new_run, db_url=db_url, mode='upsert')
+        assert index.refresh(day='2024-10-02') == 1
+        assert len(index) == len(self.df) * 3
+        assert (index.query(active_on='2024-10-20')['Name'] == new_run.loc[0, 'Name']).any()
+
+    def test_refresh_without_history(self, tmp_path):
+        """Test that without history only the offers still valid are loaded and expired ones are dropped."""
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        both_runs = concat_offers([next_week(self.df, days=-28), self.df])
+        assert save_to_sql(both_runs, db_url=db_url)
+        index = OffersIndex(sql_loader(db_url))
+        assert index.refresh(day='2024-09-25') == (both_runs['ValidThrough'] >= '2024-09-25').sum() < len(both_runs)
+        assert (index.query()['ValidThrough'] >= pd.Timestamp('2024-09-25')).all()
+
+    def test_refresh_from_archive(self, tmp_path):
+        """Test that a refresh from the archive only opens the partitions written since the previous refresh."""
+        pytest.importorskip('pyarrow')
+        from fetch_weekly_offers.utils.archive import read_archive, write_archive
+        root = str(tmp_path / 'archive')
+        write_archive(self.df, root=root, run_date=date(2024, 9, 25))
+        index = OffersIndex(archive_loader(root), history=True)
+        assert index.refresh() == len(self.df)
+        assert index.refresh() == 0
+        # The partitions of the new offers are rewritten together with the offers archived in them before
+        weeks = write_archive(next_week(self.df), root=root, run_date=date(2024, 10, 2))
+        assert index.refresh() == len(read_archive(root, weeks=weeks)) < len(self.df) * 2
+        assert len(index) == len(self.df) * 2
+
+    def test_http_service(self):
+        """Test that the service answers offer queries as JSON and reports bad queries."""
+        server = make_server(self.index, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        try:
+            with urllib.request.urlopen(f'{base_url}/offers?keyword=kaffe&unit=kg&max_unit_price=1000') as response:
+                offers = json.load(response)
+            assert [offer['Name'] for offer in offers] == ['Kaffe', 'Snabbkaffe refill']
+            with urllib.request.urlopen(f'{base_url}/stores') as response:
+                assert json.load(response) == ['ICA Maxi Stormarknad']
+            with pytest.raises(urllib.error.HTTPError, match='400'):
+                urllib.request.urlopen(f'{base_url}/offers?max_unit_price=100')
+        finally:
+            server.shutdown()
+            server.server_close()
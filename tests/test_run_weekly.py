@@ -0,0 +1,134 @@
+"""Module providing tests for the orchestration in run_weekly.
+
+The Scraper is replaced by a simple stand-in function, so that no browser is needed.
+"""
+
+import json
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from fetch_weekly_offers import run_weekly
+from fetch_weekly_offers.run_weekly import scrape_all, run_streaming, run, process_with_retries
+from fetch_weekly_offers.utils.checkpoint import RunCheckpoint
+from fetch_weekly_offers.utils.cleaner import DataCleaner
+from fetch_weekly_offers.utils.scraper import Scraper
+
+def fake_process(url):
+    """Stand-in for process_url that fails for one URL and returns a small DataFrame for the others."""
+    if 'broken' in url:
+        raise RuntimeError('Chrome crashed')
+    return pd.DataFrame({'Name': [url], 'Price': [10.0]})
+
+class TestScrapeAll:
+
+    def setup_method(self):
+        self.urls = ['https://example.com/a', 'https://example.com/broken', 'https://example.com/b']
+
+    def test_sequential(self):
+        """Test that every URL gets a result and that a failing URL does not stop the run."""
+        results = scrape_all(self.urls, max_workers=1, process=fake_process)
+        assert list(results) == self.urls
+        assert results['https://example.com/broken'].empty
+        assert results['https://example.com/a']['Name'].iloc[0] == 'https://example.com/a'
+
+    def test_concurrent(self):
+        """Test that the concurrent mode collects the same results in the input order."""
+        results = scrape_all(self.urls, max_workers=3, process=fake_process)
+        assert list(results) == self.urls
+        assert results['https://example.com/broken'].empty
+        assert not results['https://example.com/b'].empty
+
+def replay_scraper(url, pool=None, snapshot_dir=None, fetch_mode='browser', fetcher=None):
+    """Stand-in scraper factory that replays the saved test page, or fails for one URL."""
+    if 'broken' in url:
+        raise RuntimeError('Chrome crashed')
+    return Scraper(url, pool=pool, replay_from='tests/offers_page_2024-09-25.html')
+
+class TestRunStreaming:
+
+    def test_writes_every_chunk(self):
+        """Test that offers are written in fixed-size chunks and that a failing store does not stop the run."""
+        chunks = []
+        urls = ['https://example.com/a', 'https://example.com/broken', 'https://example.com/b']
+        rows = run_streaming(urls, chunk_size=15, writer=chunks.append, scraper_factory=replay_scraper)
+        # 37 offers per store, as when the page is cleaned at once, the duplicates are removed across chunks
+        assert rows == 74
+        assert [len(chunk) for chunk in chunks] == [15, 15, 7, 15, 15, 7]
+        assert 'ComparisonPriceAmount' in chunks[0].columns
+
+    def test_failed_save_is_not_counted(self, tmp_path):
+        """Test that rows save_to_sql could not save are not counted and the store is given up."""
+        db_url = f'sqlite:///{tmp_path / "missing" / "offers.db"}'
+        assert run_streaming(['https://example.com/a'], chunk_size=15, db_url=db_url, scraper_factory=replay_scraper) == 0
+
+        written = []
+        def writer(chunk):
+            written.append(len(chunk))
+            return len(written) < 2
+        assert run_streaming(['https://example.com/a'], chunk_size=15, writer=writer, scraper_factory=replay_scraper) == 15
+        assert written == [15, 15]
+
+class TestRetriesAndResume:
+
+    def test_retries_with_checkpoint(self, tmp_path):
+        """Test that a flaky URL is retried and its result and number of attempts are checkpointed."""
+        attempts = []
+
+        def flaky(url):
+            attempts.append(url)
+            if len(attempts) < 3:
+                raise TimeoutError('Page load timed out')
+            return pd.DataFrame({'Name': [url]})
+
+        checkpoint = RunCheckpoint(str(tmp_path / 'run'))
+        result = process_with_retries(flaky, 'https://example.com/a', retries=2, retry_backoff=0, checkpoint=checkpoint)
+        assert len(attempts) == 3
+        assert checkpoint.state['urls']['https://example.com/a']['attempts'] == 3
+        assert checkpoint.load_result('https://example.com/a').equals(result)
+        with pytest.raises(RuntimeError):
+            process_with_retries(fake_process, 'https://example.com/broken', retries=1, retry_backoff=0, 
+                                 checkpoint=checkpoint)
+        assert checkpoint.status('https://example.com/broken') == 'failed'
+        assert checkpoint.pending(['https://example.com/a', 'https://example.com/broken']) == ['https://example.com/broken']
+
+    def test_resume_redoes_only_failed_stores(self, tmp_path, monkeypatch):
+        """Test that a resumed run only processes the store that failed and saves the offers of all stores."""
+        records = pd.read_csv('tests/offers_2024-09-25.csv', keep_default_na=False).to_dict(orient='records')
+        stores = {'https://example.com/a': 'ICA', 'https://example.com/b': 'Hemköp', 'https://example.com/c': 'Coop'}
+        processed = []
+        broken = {'https://example.com/b'}
+
+        def fake_process_url(url, **kwargs):
+            processed.append(url)
+            if url in broken:
+                raise RuntimeError('Chrome crashed')
+            return DataCleaner([dict(record, Store=stores[url]) for record in records[:20]]).clean()
+
+        monkeypatch.setattr(run_weekly, 'process_url', fake_process_url)
+        db_url = f'sqlite:///{tmp_path / "offers.db"}'
+        checkpoint_dir = str(tmp_path / 'checkpoints')
+
+        assert run(list(stores), db_url=db_url, checkpoint_dir=checkpoint_dir, retry_backoff=0)
+        assert processed == list(stores)
+        with open(RunCheckpoint.open(checkpoint_dir, resume=True).state_path, encoding='utf-8') as file:
+            assert json.load(file)['urls']['https://example.com/b']['status'] == 'failed'
+
+        broken.clear()
+        processed.clear()
+        run(list(stores), db_url=db_url, checkpoint_dir=checkpoint_dir, resume=True, retry_backoff=0)
+        assert processed == ['https://example.com/b']
+        saved = pd.read_sql('SELECT DISTINCT Store FROM offers', create_engine(db_url))
+        assert set(saved['Store']) == set(stores.values())
+        assert not os.path.exists(checkpoint_dir)
+
+    def test_finished_run_nothing_to_resume(self, tmp_path, monkeypatch):
+        """Test that a finished run whose checkpoint is still there is not done again, and that it is removed."""
+        processed = []
+        monkeypatch.setattr(run_weekly, 'process_url', lambda url, **kwargs: processed.append(url))
+        checkpoint = RunCheckpoint(str(tmp_path / 'checkpoints' / 'run'))
+        checkpoint.save_result('https://example.com/a', pd.DataFrame())
+        checkpoint.mark_saved()
+        assert run(['https://example.com/a'], checkpoint_dir=str(tmp_path / 'checkpoints'), resume=True)
+        assert processed == []
+        assert not os.path.exists(tmp_path / 'checkpoints')
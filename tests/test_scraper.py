@@ -0,0 +1,142 @@
+"""Module providing tests for the Scraper that do not need a browser or network access."""
+
+import pandas as pd
+import pytest
+from fetch_weekly_offers.utils.scraper import Scraper, PAGE_STATE_JS
+from fetch_weekly_offers.utils.extractor import EXTRACTORS, FIELD_SELECTORS, FastExtractor
+from fetch_weekly_offers.utils.snapshot import save_snapshot, load_snapshot, list_snapshots
+
+class FakeScrollDriver:
+    """Stand-in for a WebDriver on an infinite-scroll page that loads 10 more offers per scroll."""
+
+    def __init__(self, pages=3, pending=0):
+        self.pages = pages
+        self.pending = pending
+        self.scrolls = 0
+        self.page_source = '<html></html>'
+
+    def execute_script(self, script):
+        if script == PAGE_STATE_JS:
+            loaded = min(self.scrolls, self.pages)
+            return [10 * (loaded + 1), 1000 * (loaded + 1), self.pending]
+        if script.startswith('window.scrollTo'):
+            self.scrolls += 1
+        return None
+
+class TestScrollToBottom:
+
+    def test_stops_when_no_new_offers(self):
+        """Test that scrolling continues while offers are added and stops once the list stops growing."""
+        scraper = Scraper('https://example.com')
+        scraper.driver = FakeScrollDriver(pages=3)
+        scraper.scroll_to_bottom(settle_time=0.01, initial_wait=0.005)
+        assert scraper.scroll_stats['iterations'] == 4
+        assert scraper.scroll_stats['offer_count'] == 40
+        assert len(scraper.scroll_stats['iteration_times']) == 4
+        assert not scraper.scroll_stats['timed_out']
+        assert scraper.full_content == '<html></html>'
+
+    def test_waits_while_requests_are_pending(self):
+        """Test that an in-flight request keeps the loader waiting until the idle timeout."""
+        scraper = Scraper('https://example.com')
+        scraper.driver = FakeScrollDriver(pages=0, pending=1)
+        scraper.scroll_to_bottom(settle_time=0.01, idle_timeout=0.05, initial_wait=0.005)
+        assert scraper.scroll_stats['iterations'] == 1
+        assert scraper.scroll_stats['iteration_times'][0] >= 0.05
+
+    def test_hard_deadline(self):
+        """Test that the loader gives up at the deadline on a page that never stops growing."""
+        scraper = Scraper('https://example.com')
+        scraper.driver = FakeScrollDriver(pages=10**6)
+        scraper.scroll_to_bottom(deadline=0.05, initial_wait=0.005)
+        assert scraper.scroll_stats['timed_out']
+        assert scraper.full_content is not None
+
+    def test_url_timeout(self):
+        """Test that a page that outlasts the per-URL timeout raises and is not handed back to the pool."""
+        driver = FakeScrollDriver(pages=10**6)
+        driver.get = lambda url: None
+        driver.set_page_load_timeout = lambda seconds: None
+        released = []
+
+        class FakePool:
+            def acquire(self):
+                return driver
+
+            def release(self, driver, broken=False):
+                released.append(broken)
+
+        scraper = Scraper('https://example.com', pool=FakePool(), timeout=0.8)
+        with pytest.raises(TimeoutError):
+            scraper.fetch_page()
+        assert scraper.full_content is None
+        assert released == [True]
+
+class TestExtraction:
+
+    def setup_method(self):
+        """Loading a saved offer page with 40 real offers and one broken offer without a price."""
+        with open('tests/offers_page_2024-09-25.html', encoding='utf-8') as file:
+            self.html = file.read()
+        self.expected = pd.read_csv('tests/offers_2024-09-25.csv', keep_default_na=False).head(40)
+
+    @pytest.mark.parametrize('extractor', list(EXTRACTORS))
+    def test_extract_data(self, extractor):
+        """Test that every backend finds all offers, skips the broken one and returns the same records."""
+        scraper = Scraper('https://example.com', extractor=extractor)
+        scraper.full_content = self.html
+        scraper.find_elements()
+        data = scraper.extract_data()
+        assert len(scraper.offers) == 41
+        assert len(data) == 40
+        assert list(data[0]) == list(FIELD_SELECTORS)
+        assert pd.DataFrame(data).equals(self.expected)
+
+    @pytest.mark.parametrize('extractor', list(EXTRACTORS))
+    def test_missing_attribute(self, extractor):
+        """Test that every backend rejects an offer whose meta tag has no content, instead of returning None."""
+        backend = EXTRACTORS[extractor]()
+        offer = backend.find_offers(self.html)[0]
+        del offer.find('meta', itemprop='validFrom')['content']
+        with pytest.raises(ValueError, match='content of field ValidFrom'):
+            backend.extract_offer(offer)
+
+    def test_fast_extractor_without_lxml(self):
+        """Test that the fast backend gives the same records with the built-in parser."""
+        extractor = FastExtractor(parser='html.parser')
+        records = []
+        for offer in extractor.find_offers(self.html):
+            try:
+                records.append(extractor.extract_offer(offer))
+            except ValueError:
+                pass
+        assert pd.DataFrame(records).equals(self.expected)
+
+    def test_unknown_extractor(self):
+        """Test that a misspelled backend name is reported."""
+        with pytest.raises(ValueError):
+            Scraper('https://example.com', extractor='regex')
+
+class TestSnapshots:
+
+    def setup_method(self):
+        with open('tests/offers_page_2024-09-25.html', encoding='utf-8') as file:
+            self.html = file.read()
+
+    def test_save_and_load(self, tmp_path):
+        """Test that a snapshot is stored once per unique page and every capture is in the manifest."""
+        first = save_snapshot(self.html, str(tmp_path), url='https://example.com/a')
+        second = save_snapshot(self.html, str(tmp_path), url='https://example.com/b')
+        assert first == second
+        assert first.endswith('.html.gz')
+        assert load_snapshot(first) == self.html
+        assert [entry['url'] for entry in list_snapshots(str(tmp_path))] == ['https://example.com/a', 'https://example.com/b']
+        assert list_snapshots(str(tmp_path), url='https://example.com/b')[0]['path'] == first
+
+    def test_replay(self, tmp_path):
+        """Test that a scraper in replay mode parses the snapshot without setting up a driver."""
+        path = save_snapshot(self.html, str(tmp_path))
+        scraper = Scraper('https://example.com', replay_from=path)
+        data = scraper.scrape()
+        assert scraper.driver is None
+        assert len(data) == 40